@@ -0,0 +1,112 @@
+"""Compare the BaseHTTPServer and native helloworld servers
+
+Both servers and the clients run in the same process, so the numbers include
+the client overhead. Usage: benchmark.py [requests] [concurrency]
+
+The stats runs use a server with collectStats set, to show the cost of the
+latency histograms.
+
+Example run with 5000 requests and 10 clients on linux/epoll:
+
+    BaseHTTPServer, connection per request       2834 requests/s
+    native, connection per request               3140 requests/s
+    native, keep-alive                           4082 requests/s
+    native, pipelined                            4559 requests/s
+
+and a later run with 20000 requests on a faster machine:
+
+    BaseHTTPServer, connection per request       2820 requests/s
+    native, connection per request               3691 requests/s
+    native, connection per request, stats        3397 requests/s
+    native, keep-alive                           8055 requests/s
+    native, pipelined, stats                    15216 requests/s
+    native, pipelined                           15953 requests/s
+"""
+
+import os
+import sys
+import time
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import naglfar
+from naglfar import http
+from helloworld import HelloWorldHandler
+from helloworld_native import hello
+
+def request(client, path='/', version='HTTP/1.1'):
+    client.write('GET %s %s\r\nHost: localhost\r\n\r\n' % (path, version))
+
+def readResponse(client):
+    head = http.readDelimited(client, '\r\n\r\n', 65536)
+    headers = http.parseHeaders(head.split('\r\n')[1:])
+    if 'content-length' not in headers and 'transfer-encoding' not in headers:
+        return client.read()
+    return http.readBody(client, headers, 2**20)
+
+def connectionPerRequest(address, n):
+    for i in xrange(n):
+        client = naglfar.ScheduledFile.connectTcp(address)
+        request(client, version='HTTP/1.0')
+        assert client.read().endswith('Hello, world')
+        client.close()
+
+def keepAlive(address, n):
+    client = naglfar.ScheduledFile.connectTcp(address)
+    for i in xrange(n):
+        request(client)
+        assert readResponse(client) == 'Hello, world'
+    client.close()
+
+def pipelined(address, n, depth=16):
+    client = naglfar.ScheduledFile.connectTcp(address)
+    client.autoflush = False
+    for i in xrange(0, n, depth):
+        m = min(depth, n - i)
+        for j in xrange(m):
+            request(client)
+        client.flush()
+        for j in xrange(m):
+            assert readResponse(client) == 'Hello, world'
+    client.close()
+
+def run(name, address, client, total, concurrency):
+    done = naglfar.Channel()
+    def runner():
+        client(address, total // concurrency)
+        done.write(True)
+    start = time.time()
+    for i in xrange(concurrency):
+        naglfar.go(runner)
+    for i in xrange(concurrency):
+        done.read()
+    elapsed = time.time() - start
+    print '%-40s %8.0f requests/s' % (name, (total // concurrency * concurrency) / elapsed)
+
+def main(total, concurrency):
+    class ScheduledHTTPServer(naglfar.ScheduledMixIn, BaseHTTPServer.HTTPServer):
+        pass
+    class QuietHandler(HelloWorldHandler):
+        def log_message(self, *args):
+            pass
+    base = ScheduledHTTPServer(('127.0.0.1', 0), QuietHandler)
+    native = http.HTTPServer(('127.0.0.1', 0), hello)
+    class StatsServer(http.HTTPServer):
+        collectStats = True
+    stats = StatsServer(('127.0.0.1', 0), hello)
+    naglfar.go(base.serve_forever)
+    naglfar.go(native.serve_forever)
+    naglfar.go(stats.serve_forever)
+
+    run('BaseHTTPServer, connection per request', base.server_address, connectionPerRequest, total, concurrency)
+    run('native, connection per request', native.server_address, connectionPerRequest, total, concurrency)
+    run('native, connection per request, stats', stats.server_address, connectionPerRequest, total, concurrency)
+    run('native, keep-alive', native.server_address, keepAlive, total, concurrency)
+    run('native, pipelined, stats', stats.server_address, pipelined, total, concurrency)
+    run('native, pipelined', native.server_address, pipelined, total, concurrency)
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    main(total, concurrency)
@@ -0,0 +1,14 @@
+import naglfar
+from naglfar.http import HTTPServer
+
+def hello(request):
+    if request.path == '/':
+        return 200, [('Content-type', 'text/plain')], 'Hello, world'
+    return 404, [], ''
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    httpd = HTTPServer(('', port), hello)
+    print 'Serving HTTP on port', port, '...'
+    httpd.serve_forever()
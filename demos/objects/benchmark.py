@@ -0,0 +1,245 @@
+"""Speed of each TYPE_* encoding, and of unmarshal as the number of elements grows
+
+Usage: benchmark.py [encodings] [scaling] [columnar] [cache] [stream]
+
+A stream of n small integer elements is parsed both as a single chunk, which is
+how loads and ObjectFile.readObject call unmarshal, and in 64k chunks as read
+from a socket. The copying unmarshal is the previous implementation, which
+converted the whole buffer to a str for every element.
+
+Example run of the encodings on linux, microseconds per call:
+
+    encoding                        marshal    unmarshal
+    bytes, 100                         0.31         0.91
+    integer, small                     1.31         1.77
+    integer, 64 bit                    1.39         1.96
+    integer, 200 bit                   2.17         2.80
+    tuple, 100 1 byte ids             10.42         3.31
+    tuple, 100 2 byte ids             11.13         4.08
+    tuple, 100 4 byte ids             10.02         3.62
+    tuple, 100 8 byte ids             11.00         4.64
+    tuple, 10000 2 byte ids          888.53       161.16
+
+and of the scaling, microseconds per element:
+
+      elements          one chunk         64k chunks       copying, one       copying, 64k
+          1000               4.98               5.00               4.62               4.83
+         10000               5.56               5.34               7.08               6.65
+        100000               7.12               6.16              30.34               9.59
+       1000000               6.75               6.64                  -               8.87
+
+The cost per element stays flat. The copying version grows with the size of
+the buffer, and the single chunk case at a million elements would take hours.
+
+Columnar mode on 100k rows, seconds:
+
+    rows          columnar      bytes      dumps      loads
+    tuples           False    5755000      4.862      3.596
+    tuples            True    2488938      0.229      0.031
+    namedtuples      False    5755000      4.126      2.902
+    namedtuples       True    2488938      0.235      0.023
+    dicts            False    8255033      8.848      5.979
+    dicts             True    4051993      3.647      2.251
+
+The dicts have a column of lists, which is written as references to each list
+the way it is without columnar mode. loads of a table only unpacks the columns,
+and rows are built as they're used.
+
+Messages embedding a constant tuple with an EncodingCache, milliseconds per
+dumps:
+
+    config size       cache        bytes        dumps
+    10                False          545        0.978
+    10                 True          917        0.143
+    100               False         5540        8.645
+    100                True         8658        0.222
+    1000              False        62630       86.700
+    1000               True        88730        1.075
+
+What's left with the cache is mostly copying the kept bytes. They're bigger
+because the ids of cached tuples are above EncodingCache.idBase, which takes 4
+bytes per id instead of 1 or 2.
+
+Reading objects written in advance to a socketpair, objects per second:
+
+    reader                      small int       rpc dict
+    unbatched                       49134           9571
+    readObject                      61286          12393
+    readObjectStream                77716          13646
+
+unbatched is readObject as it was, with three reads per frame and unmarshal
+parsing the payload as if it could come in chunks. Now every frame which is
+complete is decoded from one copy of incoming, and how much faster that is
+depends on how much of the time goes to decoding the object itself.
+"""
+
+import sys
+import time
+import socket
+import struct
+import collections
+
+from naglfar import objects, go, ObjectFile
+from naglfar.objects import unpackHeader1, unpackHeader2, unmarshalData, Element
+
+def unmarshalCopying(stream):
+    stream = iter(stream)
+    buffer = bytearray()
+    while True:
+        if not buffer:
+            buffer += stream.next()
+
+        id_size, length_size, type = unpackHeader1(buffer[0])
+        headerSize = 1 + ((id_size+length_size)>>3)
+        while len(buffer) < headerSize:
+            buffer += stream.next()
+
+        id, length = unpackHeader2(buffer, id_size, length_size, 1)
+
+        while len(buffer) < headerSize + length:
+            buffer += stream.next()
+
+        data = unmarshalData(type, str(buffer), headerSize, length)
+        del buffer[:headerSize+length]
+        yield Element(id, type, data)
+
+def timed(unmarshal, chunks, n):
+    start = time.time()
+    count = 0
+    for element in unmarshal(chunks):
+        count += 1
+    assert count == n
+    return (time.time() - start) / n * 1e6
+
+encodings = [
+    ('bytes, 100', objects.TYPE_BYTES, 'x' * 100),
+    ('integer, small', objects.TYPE_INTEGER, 42),
+    ('integer, 64 bit', objects.TYPE_INTEGER, -(1 << 62)),
+    ('integer, 200 bit', objects.TYPE_INTEGER, 1 << 200),
+    ('tuple, 100 1 byte ids', objects.TYPE_TUPLE, tuple(range(100))),
+    ('tuple, 100 2 byte ids', objects.TYPE_TUPLE, tuple(range(1000, 1100))),
+    ('tuple, 100 4 byte ids', objects.TYPE_TUPLE, tuple(range(70000, 70100))),
+    ('tuple, 100 8 byte ids', objects.TYPE_TUPLE, tuple(range(1 << 40, (1 << 40) + 100))),
+    ('tuple, 10000 2 byte ids', objects.TYPE_TUPLE, tuple(range(10000))),
+]
+
+def encodingSpeed(n=20000):
+    "Microseconds per marshalData and unmarshalData for each TYPE_*"
+    print '%-26s %12s %12s' % ('encoding', 'marshal', 'unmarshal')
+    for name, type, value in encodings:
+        repeat = max(10, n // max(1, len(value) // 100 if isinstance(value, tuple) else 1))
+        start = time.time()
+        for i in xrange(repeat):
+            data = objects.marshalData(type, value)
+        marshal = (time.time() - start) / repeat * 1e6
+        start = time.time()
+        for i in xrange(repeat):
+            result = objects.unmarshalData(type, data, 0, len(data))
+        unmarshal = (time.time() - start) / repeat * 1e6
+        assert result == value
+        print '%-26s %12.2f %12.2f' % (name, marshal, unmarshal)
+
+def scaling():
+    print '%10s %18s %18s %18s %18s' % ('elements', 'one chunk', '64k chunks', 'copying, one', 'copying, 64k')
+    for n in 1000, 10000, 100000, 1000000:
+        data = ''.join(objects.marshal((i, objects.TYPE_INTEGER, i) for i in xrange(n)))
+        chunks = [data[i:i+65536] for i in xrange(0, len(data), 65536)]
+        row = [timed(objects.unmarshal, [data], n), timed(objects.unmarshal, chunks, n)]
+        if n <= 100000: # quadratic, so only the small ones
+            row.append(timed(unmarshalCopying, [data], n))
+        else:
+            row.append(None)
+        row.append(timed(unmarshalCopying, chunks, n))
+        print '%10d' % n + ''.join('%18s' % ('%.2f' % t if t is not None else '-') for t in row)
+        sys.stdout.flush()
+
+def columnar(n=100000):
+    "Size, dumps and loads seconds for n rows, with and without columnar mode"
+    Row = collections.namedtuple('Row', 'id name score')
+    tables = [
+        ('tuples', [(i, 'name%d' % i, i * 0.5) for i in xrange(n)]),
+        ('namedtuples', [Row(i, 'name%d' % i, i * 0.5) for i in xrange(n)]),
+        ('dicts', [{'id': i, 'name': u'name%d' % i, 'flags': [i]} for i in xrange(n)]),
+    ]
+    print '%-12s %9s %10s %10s %10s' % ('rows', 'columnar', 'bytes', 'dumps', 'loads')
+    for name, rows in tables:
+        for mode in False, True:
+            start = time.time()
+            data = objects.dumps(rows, columnar=mode)
+            dumps = time.time() - start
+            start = time.time()
+            result = objects.loads(data)
+            loads = time.time() - start
+            assert result == rows
+            print '%-12s %9s %10d %10.3f %10.3f' % (name, mode, len(data), dumps, loads)
+        sys.stdout.flush()
+
+def cache(n=100):
+    "Milliseconds per dumps of messages embedding a constant tuple, with and without an EncodingCache"
+    print '%-14s %8s %12s %12s' % ('config size', 'cache', 'bytes', 'dumps')
+    for size in 10, 100, 1000:
+        config = tuple(('key%d' % i, i, (i * 0.5, 'value%d' % i)) for i in xrange(size))
+        messages = [{'request': i, 'config': config, 'args': ['a', i]} for i in xrange(n)]
+        for encodingCache in None, objects.EncodingCache():
+            start = time.time()
+            for message in messages:
+                data = objects.dumps(message, cache=encodingCache)
+            dumps = (time.time() - start) / n * 1e3
+            assert objects.loads(data) == messages[-1]
+            print '%-14d %8s %12d %12.3f' % (size, encodingCache is not None, len(data), dumps)
+        sys.stdout.flush()
+
+def readObjectUnbatched(f):
+    "ObjectFile.readObject as it was, with a read for each part of a frame"
+    preHeader = unpackHeader1(ord(f.read(1)))
+    headerData = f.read((preHeader.id_size+preHeader.length_size)>>3)
+    id, length = unpackHeader2(headerData, preHeader.id_size, preHeader.length_size)
+    return objects.load(objects.unmarshal([f.read(length)]))
+
+def stream(n=200000):
+    "Objects per second read from a socketpair, one frame at a time as before and batched"
+    print '%-22s %14s %14s' % ('reader', 'small int', 'rpc dict')
+    for name in 'unbatched', 'readObject', 'readObjectStream':
+        row = []
+        for message in 1, {'id': 1, 'method': 'ping', 'args': ('a', 2)}:
+            # written in advance, so only the reading is measured
+            data = objects.dumps(message) * 1000
+            a, b = socket.socketpair()
+            a.setblocking(False)
+            b.setblocking(False)
+            writer, reader = ObjectFile.fromSocket(a), ObjectFile.fromSocket(b)
+            a.close()
+            b.close()
+
+            @go
+            def write():
+                for i in xrange(n // 1000):
+                    writer.write(data)
+                writer.close()
+
+            start = time.time()
+            if name == 'unbatched':
+                for i in xrange(n):
+                    readObjectUnbatched(reader)
+            elif name == 'readObject':
+                for i in xrange(n):
+                    reader.readObject()
+            else:
+                assert sum(1 for i in reader.readObjectStream()) == n
+            row.append(n / (time.time() - start))
+            reader.close()
+        print '%-22s %14d %14d' % ((name,) + tuple(row))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    what = sys.argv[1:] or ['encodings', 'scaling', 'columnar', 'cache', 'stream']
+    if 'encodings' in what:
+        encodingSpeed()
+    if 'scaling' in what:
+        scaling()
+    if 'columnar' in what:
+        columnar()
+    if 'cache' in what:
+        cache()
+    if 'stream' in what:
+        stream()
@@ -0,0 +1,38 @@
+"""
+The comet example from naglfar.core with WebSockets: every message a client
+sends is pushed to all connected clients. The frame is encoded once, whatever
+the number of clients.
+
+Try it with a browser console:
+
+    ws = new WebSocket('ws://localhost:8000/'); ws.onmessage = function(e) { console.log(e.data) }
+    ws.send('hello')
+"""
+import naglfar
+from naglfar import websocket
+from naglfar.http import HTTPServer
+
+subscribers = set()
+
+def subscriber(ws):
+    subscribers.add(ws)
+    try:
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            websocket.broadcast(subscribers, message)
+    finally:
+        subscribers.discard(ws)
+
+def handler(request):
+    if request.path == '/':
+        return websocket.accept(request, subscriber)
+    return 404, [], ''
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    httpd = HTTPServer(('', port), handler)
+    print 'Serving WebSockets on port', port, '...'
+    httpd.serve_forever()
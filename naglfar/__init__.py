@@ -22,34 +22,100 @@ ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
-from core import go, goRead, goWrite, goClose, Channel, ScheduledFile, ScheduledMixIn, scheduler, queue, testScheduledServer
+from core import go, goRead, goWrite, goClose, goAfter, goCancel, goSleep, Timeout, Channel, ScheduledFile, ScheduledDatagram, ScheduledMixIn, ScheduledUnixMixIn, scheduler, queue, testScheduledServer
 
 import objects
+import http
+import wsgi
+import dns
+import tls
+import websocket
+import sync
+import pipeline
+from pipeline import goPool
+import aio
+import profiler
+import stats
 
 class ObjectFile(ScheduledFile):
+    compression = None # an objects.Compression to compress written frames with
+    compressionStats = None # where to count compression, objects.compressionStats if None
+    useSession = False # refer to strings sent in earlier objects, which the reader must support
+    sessionSize = 1024 # atoms in the sessions, which has to be the same on both sides
+    readSession = writeSession = None
+    encodingCache = None # an objects.EncodingCache for constant tuples in written objects
+
+    def _frames(self, limit=None):
+        "Decode up to limit of the complete frames at the start of incoming"
+        incoming = self.incoming
+        frames = []
+        offset = 0
+        while len(frames) != limit and offset < len(incoming):
+            id_size, length_size, type = objects.unpackHeader1(incoming[offset])
+            headerSize = 1 + ((id_size+length_size)>>3)
+            if len(incoming) - offset < headerSize:
+                break
+            id, length = objects.unpackHeader2(incoming, id_size, length_size, offset + 1)
+            if type != objects.TYPE_BYTES or id > (objects.CODEC_ZSTD | objects.FRAME_SESSION):
+                if frames:
+                    break # return what came before, and fail the next time
+                raise ValueError('not an object frame')
+            end = offset + headerSize + length
+            if end > len(incoming):
+                break
+            frames.append((id, offset + headerSize, length))
+            offset = end
+        if not frames:
+            return []
+
+        # one copy for all of them, so that what's decoded can refer to it
+        block = str(incoming[:offset])
+        del incoming[:offset]
+        if self.readSession is None and any(id & objects.FRAME_SESSION for id, start, length in frames):
+            self.readSession = objects.Session(self.sessionSize)
+        return [objects.loadFrame(id, buffer(block, start, length), self.compressionStats, self.readSession)
+            for id, start, length in frames]
+
+    def _readFrames(self, limit=None):
+        while True:
+            objs = self._frames(limit)
+            if objs:
+                return objs
+            chunk = self._read()
+            if not chunk:
+                if self.incoming:
+                    raise EOFError('eof in the middle of an object')
+                return []
+            self.incoming += chunk
+
     def readObject(self):
-        preHeaderData = self.read(1)
-        preHeader = objects.unpackHeader1(ord(preHeaderData))
-        headerSize = (preHeader.id_size+preHeader.length_size)>>3
-        headerData = self.read(headerSize)
-        assert len(headerData) == headerSize
-        id, length = objects.unpackHeader2(headerData, preHeader.id_size, preHeader.length_size)
-        assert id == 0 and preHeader.type == objects.TYPE_BYTES
+        objs = self._readFrames(1)
+        if not objs:
+            raise EOFError('eof')
+        return objs[0]
 
-        data = self.read(length)
-        assert len(data) == length
-        return objects.load(objects.unmarshal([data]))
+    def readObjects(self):
+        "Read until an object is complete, and return every complete one, or [] at eof"
+        return self._readFrames()
 
-    def writeObject(self, obj):
-        self.write(objects.dumps(obj))
+    def writeObject(self, obj, columnar=False):
+        if self.useSession and self.writeSession is None:
+            self.writeSession = objects.Session(self.sessionSize)
+        self.write(objects.dumps(obj, columnar, self.compression, self.writeSession, self.encodingCache))
 
     def readObjectStream(self):
         while True:
             try:
-                yield self.readObject()
+                objs = self.readObjects()
             except:
                 # FIXME: check exceptions
                 return
+            if not objs:
+                return
+            for obj in objs:
+                yield obj
+
 
+import rpc
 
-__all__ = 'go, goRead, goWrite, goClose, Channel, ScheduledFile, ScheduledMixIn, scheduler, queue, testScheduledServer, objects, ObjectFile'.split(', ')
+__all__ = 'go, goPool, goRead, goWrite, goClose, goAfter, goCancel, goSleep, Timeout, Channel, ScheduledFile, ScheduledDatagram, ScheduledMixIn, ScheduledUnixMixIn, scheduler, queue, testScheduledServer, objects, http, wsgi, dns, tls, websocket, sync, pipeline, aio, profiler, stats, ObjectFile, rpc'.split(', ')
@@ -0,0 +1,75 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"wrapper for the accept4 call"
+
+import os
+import sys
+import fcntl
+import ctypes
+import ctypes.util
+import socket
+import struct
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+def parseAddress(data, length):
+    "decode a struct sockaddr into the same address format as socket.accept"
+    family, = struct.unpack_from('H', data)
+    if family == socket.AF_INET:
+        port, = struct.unpack_from('!H', data, 2)
+        return socket.inet_ntoa(data[4:8]), port
+    elif family == socket.AF_INET6:
+        port, flowinfo = struct.unpack_from('!HI', data, 2)
+        scopeid, = struct.unpack_from('I', data, 24)
+        return socket.inet_ntop(socket.AF_INET6, data[8:24]), port, flowinfo, scopeid
+    elif family == socket.AF_UNIX:
+        return data[2:length].split('\x00', 1)[0]
+    return data[:length]
+
+if sys.platform.startswith('linux') and hasattr(_libc, 'accept4'):
+    # int accept4(int sockfd, struct sockaddr *addr, socklen_t *addrlen, int flags);
+    _accept4 = _libc.accept4
+    _accept4.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(ctypes.c_uint32), ctypes.c_int]
+
+    SOCK_NONBLOCK = os.O_NONBLOCK
+    SOCK_CLOEXEC = 02000000
+
+    def accept4(sock):
+        "Accept a connection as a non-blocking, close-on-exec fd in one syscall"
+        address = ctypes.create_string_buffer(128) # sizeof(struct sockaddr_storage)
+        length = ctypes.c_uint32(len(address))
+        fd = _accept4(sock.fileno(), address, length, SOCK_NONBLOCK | SOCK_CLOEXEC)
+        if fd == -1:
+            number = ctypes.get_errno()
+            raise socket.error(number, os.strerror(number))
+        return fd, parseAddress(address.raw, length.value)
+
+else:
+    def accept4(sock):
+        "Accept a connection as a non-blocking, close-on-exec fd"
+        client, address = sock.accept()
+        try:
+            client.setblocking(False)
+            # python closes the socket under deallocation, so we need our own fd
+            fd = os.dup(client.fileno())
+        finally:
+            client.close()
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        return fd, address
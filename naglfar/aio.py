@@ -0,0 +1,220 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"Run naglfar on an asyncio event loop, and pass values between naglfar and asyncio coroutines"
+
+import sys
+import select
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio # the python 2 backport
+    except ImportError:
+        asyncio = None
+
+from greenlet import getcurrent
+import core
+from core import go, scheduler, queue, Channel
+
+"""
+Once installed, the bridge replaces the IO backend of naglfar: _goRead and
+_goWrite become loop.add_reader and loop.add_writer, and timers are scheduled
+with loop.call_later. Both sides then share the event loop and its epoll set.
+
+The scheduler still runs naglfar coroutines, but instead of polling when it
+runs out of work it switches back to the greenlet running the event loop. It's
+switched to again from a loop callback whenever IO, a timer or the asyncio
+side has given it something to do.
+
+Calls from asyncio code into naglfar must go through the bridge, so the
+scheduler knows there's work:
+
+    bridge = aio.install(loop)
+    bridge.go(server.serve_forever)
+    value = yield From(bridge.read(channel)) # await bridge.read(channel) in python 3
+
+and naglfar coroutines can wait for asyncio futures and coroutines with
+bridge.wait(awaitable).
+
+Installing rebinds the backend functions as globals of core, and of the other
+modules in the package that import them by name, listed in Bridge.rebound.
+Code outside the package which did "from naglfar.core import _goRead" keeps
+naglfar's own poller, and must look them up through core instead.
+"""
+
+def _registered():
+    "What naglfar's own poller is waiting for, as (fd, register function name, callback)"
+    if hasattr(core, 'ioRead'):
+        return ([(fd, '_goRead', callback) for fd, callback in core.ioRead.items()] +
+            [(fd, '_goWrite', callback) for fd, callback in core.ioWrite.items()])
+    reads = getattr(select, 'EPOLLIN', None), getattr(select, 'KQ_FILTER_READ', None)
+    return [(fd, '_goRead' if kind in reads else '_goWrite', callback)
+        for (fd, kind), callback in core.io.items()]
+
+class Bridge(object):
+    "Runs the naglfar scheduler from callbacks of an asyncio event loop"
+    backend = ('_goRead', '_goWrite', '_goClose', '_ioCore')
+    rebound = ('core', 'dns', 'tls') # the modules with backend functions as globals
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.readers = {} # fd -> naglfar io callback
+        self.writers = {}
+        self.loopGreenlet = None # where the event loop is running
+        self.kicked = False
+        self.timer = None
+        self.originals = self.replacements = None
+
+    def install(self):
+        "Move naglfar's IO onto the event loop, including what it's already waiting for"
+        pending = _registered()
+        for fd, register, callback in pending:
+            core._goClose(fd)
+        self.originals = dict((name, getattr(core, name)) for name in self.backend)
+        self.replacements = dict((name, getattr(self, name)) for name in self.backend)
+        self._rebind(self.originals, self.replacements)
+        for fd, register, callback in pending:
+            getattr(self, register)(fd, callback)
+        core._ioRunner.activate()
+        self.kick()
+
+    def uninstall(self):
+        "Give naglfar its own poller back, with the IO still registered on the loop"
+        pending = [(fd, '_goRead', callback) for fd, callback in self.readers.items()]
+        pending.extend((fd, '_goWrite', callback) for fd, callback in self.writers.items())
+        for fd, register, callback in pending:
+            self._goClose(fd)
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self._rebind(self.replacements, self.originals)
+        for fd, register, callback in pending:
+            getattr(core, register)(fd, callback)
+
+    def _rebind(self, old, new):
+        "Swap the backend functions in the modules of rebound, where they are still old"
+        package = core.__name__.rpartition('.')[0]
+        for moduleName in self.rebound:
+            module = sys.modules.get('%s.%s' % (package, moduleName) if package else moduleName)
+            if module is None:
+                continue
+            for name, function in old.items():
+                if getattr(module, name, None) is function:
+                    setattr(module, name, new[name])
+
+    def kick(self):
+        "Make sure the scheduler runs soon, needed after doing naglfar work from the loop"
+        if not self.kicked:
+            self.kicked = True
+            self.loop.call_soon(self._run)
+
+    def _run(self):
+        self.kicked = False
+        self.loopGreenlet = getcurrent()
+        scheduler.switch()
+
+    def _ioCore(self):
+        "Run by the scheduler when it's idle, returns to the event loop until there's work"
+        core._runTimers()
+        if not queue:
+            timeout = core._pollTimeout()
+            if timeout is not None:
+                self.timer = self.loop.call_later(timeout, self.kick)
+            (self.loopGreenlet or scheduler.parent).switch()
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            core._runTimers()
+        return True
+
+    def _ready(self, callbacks, remove, fd):
+        callback = callbacks.pop(fd)(32768, False)
+        if callback:
+            callbacks[fd] = callback
+        elif fd not in callbacks:
+            remove(fd)
+        self.kick()
+
+    def _goRead(self, fd, callback):
+        if fd not in self.readers:
+            self.loop.add_reader(fd, self._ready, self.readers, self.loop.remove_reader, fd)
+        self.readers[fd] = callback
+
+    def _goWrite(self, fd, callback):
+        if fd not in self.writers:
+            self.loop.add_writer(fd, self._ready, self.writers, self.loop.remove_writer, fd)
+        self.writers[fd] = callback
+
+    def _goClose(self, fd):
+        if self.readers.pop(fd, None):
+            self.loop.remove_reader(fd)
+        if self.writers.pop(fd, None):
+            self.loop.remove_writer(fd)
+
+    def go(self, callable, *args, **vargs):
+        "Start a naglfar coroutine from asyncio code"
+        go(callable, *args, **vargs)
+        self.kick()
+
+    def _future(self, callable, *args):
+        "A future for the result of callable run in a naglfar coroutine"
+        future = asyncio.Future(loop=self.loop)
+        def runner():
+            try:
+                result = callable(*args)
+            except Exception, e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+        self.go(runner)
+        return future
+
+    def read(self, channel, timeout=None):
+        "A future for channel.read, for asyncio coroutines"
+        return self._future(channel.read, timeout)
+
+    def write(self, channel, msg):
+        "A future which is done when msg has been written to channel, which may be bounded"
+        return self._future(channel.write, msg)
+
+    def wait(self, awaitable):
+        "Block the current naglfar coroutine until a asyncio future or coroutine is done"
+        ensureFuture = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+        future = ensureFuture(awaitable, loop=self.loop)
+        if not future.done():
+            c = Channel()
+            def done(future):
+                c.write(None)
+                self.kick()
+            future.add_done_callback(done)
+            c.read()
+        return future.result()
+
+def install(loop=None):
+    "Run naglfar on loop, or the current event loop, returning the Bridge"
+    if asyncio is None:
+        raise ImportError('asyncio, or trollius for python 2, is required')
+    bridge = Bridge(loop or asyncio.get_event_loop())
+    bridge.install()
+    return bridge
@@ -73,43 +73,197 @@ put the magic, and is comperable to ThreadingMixIn and ForkingMixIn.
 class ScheduledMixIn:
     "Mix-in class to handle each request in a new coroutine"
 
+    # Load shedding. Once maxConnections requests are being handled the
+    # listening socket is paused, or if rejectResponse is set, new clients are
+    # accepted and immediately given the prebuilt response (e.g. a 503).
+    # npending counts the connections accepted whose coroutine hasn't started
+    # yet. The scheduler runs every queued coroutine before it polls again, so
+    # these are the ones taken earlier in the same wakeup, and the part of a
+    # backlog burst beyond maxAcceptQueue is shed the same way. None means
+    # unlimited.
+    maxConnections = None
+    maxAcceptQueue = None
+    rejectResponse = None
+
+    # Record latency histograms and byte counts in self.stats, see statsSnapshot
+    collectStats = False
+
     def process_request(self, request, client_address):
         # the BaseHTTPServer framework uses only the "file protocol" for a file
         # descriptors, so we put the request in an object which will wrap all
         # IO calls using kqueue/epoll and schedule/Channel.
-        request = ScheduledFile.fromSocket(request)
-        @go
+        self._process(ScheduledFile.fromSocket(request), client_address)
+
+    def _process(self, request, client_address):
+        self.nconnections += 1
+        self.npending += 1
+        stats = self.stats
+        if stats is not None:
+            accepted = time.time()
         def runner():
-            self.finish_request(request, client_address)
-            self.close_request(request)
+            self.npending -= 1
+            if stats is not None:
+                started = time.time()
+            try:
+                if stats is not None:
+                    stats.queueTime.record(started - accepted)
+                # like ThreadingMixIn, a failing request is reported without
+                # taking the server down
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                self.close_request(request)
+            finally:
+                if stats is not None:
+                    stats.connectionDone(time.time() - started, request.nread, request.nwrite)
+                self._connectionDone()
+        try:
+            go(runner)
+        except:
+            self.npending -= 1
+            self._connectionDone()
+            raise
+        for c in self._acceptWaiters:
+            c.write((request, client_address))
+        self._acceptWaiters = []
+
+    def serve_forever(self, poll_interval=0.5):
+        """Wait until shutdown is called. Connections are dispatched directly
+        from the accept callback, so there's nothing to poll for and
+        poll_interval is only taken for compatibility"""
+        try:
+            self._shutdownChannel.read()
+        except EOFError:
+            pass
+
+    def shutdown(self):
+        """Stop accepting connections and make serve_forever return, without
+        waiting for it. Requests already being handled carry on"""
+        if not self._shutdownChannel.closed:
+            self._shutdownChannel.close()
+            self._acceptPaused = False # so a finished connection won't resume it
+            _goClose(self.socket.fileno())
+
+    def _nextRequest(self, timeout=None):
+        c = Channel()
+        self._acceptWaiters.append(c)
+        try:
+            return c.read(timeout)
+        except Timeout:
+            self._acceptWaiters.remove(c)
+            raise
 
     def handle_request(self):
-        return self._handle_request_noblock()
+        """Wait until the next connection has been handed to its coroutine, or
+        for timeout seconds. The accept callback does the work, not us"""
+        try:
+            self._nextRequest(self.timeout)
+        except Timeout:
+            self.handle_timeout()
 
-    def serve_forever(self):
-        while True:
-            self.handle_request()
+    def get_request(self):
+        """Wait for the next connection, returning (request, client_address).
+        The accept callback has already handed it to its coroutine"""
+        return self._nextRequest()
 
     def server_activate(self):
         self.socket.listen(self.request_queue_size)
         self.socket.setblocking(False)
-        self.acceptStream = Channel() # use a channel for new connections
-        def runner(n, eof):
-            for i in xrange(n): # kqueue will provide the number of connections waiting
-                try:
-                    client = self.socket.accept()
-                except socket.error, e:
-                    if e.errno == errno.EAGAIN: # either epoll, a kernel bug or a race condition
-                        break
-                    # FIXME: more error handling?
-                    raise
-                self.acceptStream.write(client)
-            if not eof:
-                return runner
-        _goRead(self.socket.fileno(), runner)
+        self.nconnections = self.npending = self.naccepted = self.nrejected = self.nshed = 0
+        self.stats = ServerStats() if self.collectStats else None
+        self._acceptPaused = False
+        self._acceptWaiters = [] # Channels of handle_request and get_request calls
+        self._shutdownChannel = Channel() # closed by shutdown
+        _goRead(self.socket.fileno(), self._acceptReady)
+
+    def statsSnapshot(self):
+        "Connection counters, and the histograms and byte counts if collectStats is set"
+        snapshot = dict(open=self.nconnections, pending=self.npending, accepted=self.naccepted,
+            rejected=self.nrejected, shed=self.nshed)
+        if self.stats is not None:
+            snapshot.update(self.stats.snapshot())
+        return snapshot
+
+    def _atCapacity(self):
+        return self.maxConnections is not None and self.nconnections >= self.maxConnections
+
+    def _acceptReady(self, n, eof):
+        # drain the backlog. kqueue will provide the number of connections
+        # waiting, epoll/select will stop at EAGAIN
+        for i in xrange(n):
+            if self._atCapacity() and self.rejectResponse is None:
+                # leave the rest in the listen backlog until a connection is done
+                self._acceptPaused = True
+                return
+            try:
+                # accept4 gives us a non-blocking fd directly, without the
+                # extra dup needed to detach it from a python socket object
+                fd, client_address = accept4(self.socket)
+            except socket.error, e:
+                if e.errno == errno.EAGAIN: # either epoll, a kernel bug or a race condition
+                    break
+                elif e.errno == errno.ECONNABORTED:
+                    continue
+                # FIXME: more error handling?
+                raise
+            request = self.makeFile(fd)
+            if self._atCapacity():
+                self.nrejected += 1
+                self._reject(request)
+            elif self.maxAcceptQueue is not None and self.npending >= self.maxAcceptQueue:
+                self.nshed += 1
+                self._reject(request)
+            elif not self.verify_request(request, client_address):
+                request.close(flush=False)
+            else:
+                self.naccepted += 1
+                self._process(request, client_address)
+        if not eof:
+            return self._acceptReady
 
-    def get_request(self):
-        return self.acceptStream.read()
+    def makeFile(self, fd):
+        "Wrap an accepted fd in a file object for the handler"
+        return ScheduledFile(fd)
+
+    def _reject(self, request):
+        "Give the client the reject response, if any, and close it without blocking"
+        try:
+            if self.rejectResponse is not None:
+                os.write(request.fd, self.rejectResponse) # best effort, the send buffer is empty
+        except OSError:
+            pass
+        request.close(flush=False)
+
+    def _connectionDone(self):
+        self.nconnections -= 1
+        if self._acceptPaused:
+            self._acceptPaused = False
+            _goRead(self.socket.fileno(), self._acceptReady)
+
+class ScheduledUnixMixIn(ScheduledMixIn):
+    "Mix-in class for SocketServer.UnixStreamServer, removing the socket file when done"
+
+    socketMode = None # permissions for the socket file, e.g. 0660
+
+    def server_bind(self):
+        # a socket file left behind by a previous process would make bind fail
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.unlink(self.server_address)
+        except OSError:
+            pass
+        SocketServer.UnixStreamServer.server_bind(self)
+        if self.socketMode is not None:
+            os.chmod(self.server_address, self.socketMode)
+
+    def server_close(self):
+        _goClose(self.socket.fileno())
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
 
 """
 To test this we will first start the server, create N clients that will
@@ -186,13 +340,19 @@ Finally, the code to make it all work:
 """
 
 import os
+import sys
+import stat
 import errno
 import select
+import time
+import heapq
 import socket
 import traceback
+import SocketServer
 
 from greenlet import greenlet, getcurrent
 from functools import partial
+from itertools import count
 from collections import deque, namedtuple
 
 # This is just a job queue which we routinely pop to do more work. There's no
@@ -216,43 +376,160 @@ def scheduler():
 scheduler = greenlet(scheduler)
 
 class Channel(object):
-    "An asynchronous channel"
-    def __init__(self):
+    """An asynchronous channel. Writers block while maxsize messages are queued,
+    and readers get EOFError once it's closed and empty"""
+    def __init__(self, maxsize=0):
         self.q = deque()
         self.waiting = []
+        self.maxsize = maxsize
+        self.writers = [] # blocked until there's room in q
+        self.closed = False
 
     def write(self, msg):
         "Write to the channel"
+        if self.closed:
+            raise ValueError('write to closed channel')
+        while self.maxsize and len(self.q) >= self.maxsize:
+            self.writers.append(getcurrent().switch)
+            scheduler.switch()
+            if self.closed:
+                raise ValueError('write to closed channel')
         self.q.append(msg)
         # notify everyone
         queue.extend(self.waiting)
         self.waiting = []
 
-    def wait(self):
-        while not self.q:
-            # block until we have data
-            self.waiting.append(getcurrent().switch)
-            scheduler.switch()
+    def close(self):
+        "Wake up all readers and writers, nothing more can be written"
+        self.closed = True
+        queue.extend(self.waiting)
+        queue.extend(self.writers)
+        self.waiting = []
+        self.writers = []
+
+    def _taken(self, n=1):
+        # there's room for n of the blocked writers now. waking more would
+        # only have them find the channel full again
+        queue.extend(self.writers[:n])
+        del self.writers[:n]
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            while not self.q and not self.closed:
+                # block until we have data
+                self.waiting.append(getcurrent().switch)
+                scheduler.switch()
+            return
 
-    def read(self):
-        "Read from the channel, blocking if it's empty"
-        self.wait()
+        deadline = time.time() + timeout
+        while not self.q and not self.closed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Timeout()
+            # both the timer and a writer might wake us up, so only the first
+            # one is allowed to switch
+            wakeup = _wakeup(getcurrent())
+            self.waiting.append(wakeup)
+            timer = goAfter(remaining, wakeup)
+            scheduler.switch()
+            goCancel(timer)
+            if wakeup in self.waiting:
+                self.waiting.remove(wakeup)
+
+    def read(self, timeout=None):
+        """Read from the channel, blocking if it's empty. Raises Timeout after
+        timeout seconds, and EOFError if the channel is closed"""
+        self.wait(timeout)
+        if not self.q:
+            raise EOFError('channel closed')
+        if self.writers:
+            self._taken()
         return self.q.popleft()
 
-    def readWaiting(self, block=False):
+    def readWaiting(self, block=False, limit=None):
+        "Read up to limit queued messages, [] if block is set means it's closed"
         if block:
             self.wait()
-        result = list(self.q)
-        self.q.clear()
+        if limit is None or limit >= len(self.q):
+            result = list(self.q)
+            self.q.clear()
+        else:
+            result = [self.q.popleft() for i in xrange(limit)]
+        if self.writers:
+            self._taken(len(result))
         return result
 
-    def iterateWaiting(self):
+    def iterateWaiting(self, limit=None):
         while True:
-            yield self.readWaiting(True)
+            result = self.readWaiting(True, limit)
+            if not result:
+                break
+            yield result
 
     def __iter__(self):
         while True:
-            yield self.read()
+            try:
+                yield self.read()
+            except EOFError:
+                break
+
+class Timeout(Exception):
+    "Raised when a blocking call didn't complete in time"
+
+def _wakeup(g):
+    "Make a callable which switches to g the first time it's called"
+    state = []
+    def wakeup():
+        if not state:
+            state.append(True)
+            g.switch()
+    return wakeup
+
+"""
+Timers are kept in a heap which is checked every time we poll for IO. The
+poll timeout is the time until the next timer expires. Cancelled timers are
+left in the heap with their callback cleared.
+"""
+
+timers = []
+timerSequence = count() # keep the heap stable for timers with the same deadline
+
+def goAfter(seconds, callback):
+    "Call callback in the scheduler after seconds, returning a timer for goCancel"
+    timer = [time.time() + seconds, timerSequence.next(), callback]
+    heapq.heappush(timers, timer)
+    _ioRunner.activate()
+    return timer
+
+def goCancel(timer):
+    timer[2] = None
+
+def goSleep(seconds):
+    "Block the current coroutine for seconds"
+    c = Channel()
+    goAfter(seconds, partial(c.write, None))
+    c.read()
+
+def _pollTimeout():
+    "How long to block in poll: 0 if there is other work, None for forever"
+    if queue:
+        return 0
+    if _liveTimers():
+        return max(0, timers[0][0] - time.time())
+    return None
+
+def _liveTimers():
+    "Drop the cancelled timers at the head of the heap, returning True if any are left"
+    while timers and timers[0][2] is None:
+        heapq.heappop(timers)
+    return bool(timers)
+
+def _runTimers():
+    now = time.time()
+    while timers and timers[0][0] <= now:
+        deadline, sequence, callback = heapq.heappop(timers)
+        if callback is not None:
+            queue.append(callback)
 
 def goRead(fd, n=None):
     "Read n bytes, or the next chunk if n is None"
@@ -287,9 +564,8 @@ def goWrite(fd, data):
             try:
                 offset += os.write(fd, str(data[offset:offset+bytesReady]))
             except OSError, e:
-                if e.errno == errno.EAGAIN:
-                    pass
-                eof = True # treat all other errors as eof
+                if e.errno != errno.EAGAIN:
+                    eof = True # treat all other errors as eof
             if not eof and offset < len(data):
                 o['offset'] = offset
                 return writer
@@ -321,6 +597,115 @@ def goSendfile(fdFile, fd, offset, nbytes):
     _goWrite(fd, writer)
     return c.read
 
+def goConnect(family, address, timeout=None, cancel=None):
+    """Connect a new stream socket to address and return its fd. Closing the
+    cancel Channel aborts the attempt with EOFError"""
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        error = sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS): # EINPROGRESS means we need to wait for the socket to become writable
+            raise socket.error(error, os.strerror(error))
+        # python closes the socket under deallocation, so we need our own fd
+        fd = os.dup(sock.fileno())
+    finally:
+        sock.close()
+
+    c = Channel() if cancel is None else cancel
+    _goWrite(fd, lambda bytesReady, eof:c.closed or c.write(None))
+    try:
+        c.read(timeout)
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        try:
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        finally:
+            sock.close()
+        if error:
+            raise socket.error(error, os.strerror(error))
+    except:
+        goClose(fd)
+        raise
+    return fd
+
+SO_DOMAIN = getattr(socket, 'SO_DOMAIN', 39 if sys.platform.startswith('linux') else None)
+
+def socketFamily(fd):
+    "The address family of the socket fd"
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if SO_DOMAIN is not None:
+            return sock.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        # the address is decoded by the family the kernel puts in it
+        address = sock.getsockname()
+    finally:
+        sock.close()
+    if isinstance(address, str):
+        return socket.AF_UNIX
+    return socket.AF_INET6 if len(address) == 4 else socket.AF_INET
+
+def goConnectFirst(addresses, port, timeout=None, delay=0.25):
+    """Connect to the first [(family, address)] to answer, starting a new
+    attempt every delay seconds or when one fails (happy eyeballs)"""
+    # alternate between the families, starting with the first one
+    byFamily = {}
+    for family, address in addresses:
+        byFamily.setdefault(family, []).append(address)
+    order = []
+    for family, address in addresses:
+        if family not in order:
+            order.append(family)
+    pending = []
+    while any(byFamily.values()):
+        for family in order:
+            if byFamily[family]:
+                pending.append((family, byFamily[family].pop(0)))
+
+    results = Channel()
+    state = dict(done=False)
+    connecting = [] # the cancel channels of the attempts in flight
+    def attempt(family, address):
+        if state['done']:
+            return
+        cancel = Channel()
+        connecting.append(cancel)
+        try:
+            fd = goConnect(family, (address, port), timeout, cancel)
+        except EOFError: # someone else won
+            pass
+        except (socket.error, Timeout), e:
+            results.write((None, e))
+        else:
+            if state['done']: # someone else won at the same time
+                goClose(fd)
+            else:
+                results.write((fd, None))
+        finally:
+            connecting.remove(cancel)
+
+    running = 0
+    error = socket.error(errno.EHOSTUNREACH, 'no addresses')
+    while pending or running:
+        if pending and not running:
+            go(attempt, *pending.pop(0))
+            running += 1
+        try:
+            fd, error = results.read(delay if pending else None)
+        except Timeout:
+            go(attempt, *pending.pop(0))
+            running += 1
+            continue
+        running -= 1
+        if fd is not None:
+            # stop the other attempts, and close the ones that also connected
+            state['done'] = True
+            for cancel in list(connecting):
+                cancel.close()
+            for other, e in results.readWaiting():
+                if other is not None:
+                    goClose(other)
+            return fd
+    raise error
+
 def goClose(fd):
     "Close the fd and do kqueue cleanup"
     assert fd != -1 and fd is not None
@@ -334,7 +719,16 @@ if hasattr(select, 'epoll'):
     ioState = {}
 
     def _ioCore():
-        for fd, eventmask in epoll.poll(0 if queue else -1):
+        timeout = _pollTimeout()
+        if timeout is None and not io:
+            return False # nothing could ever wake us up
+        try:
+            events = epoll.poll(-1 if timeout is None else timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR: # a signal handler ran, just poll again
+                raise
+            events = ()
+        for fd, eventmask in events:
             assert not eventmask & select.EPOLLPRI
             removeMask = 0
             for mask in (select.EPOLLIN, select.EPOLLOUT):
@@ -349,7 +743,8 @@ if hasattr(select, 'epoll'):
             if removeMask:
                 ioState[fd] ^= removeMask
                 epoll.modify(fd, ioState[fd])
-        return bool(io)
+        _runTimers()
+        return bool(io) or _liveTimers()
 
     def _goEpoll(ident, mask, m):
         if ident not in ioState:
@@ -367,6 +762,12 @@ if hasattr(select, 'epoll'):
     def _goClose(fd):
         if fd in ioState:
             del ioState[fd]
+            # closing the fd only removes it from the epoll set if there are
+            # no dups of it left
+            try:
+                epoll.unregister(fd)
+            except IOError:
+                pass
             for key in (fd, select.EPOLLIN), (fd, select.EPOLLOUT):
                 if key in io:
                     del io[key]
@@ -380,9 +781,18 @@ elif hasattr(select, 'kqueue'):
 
     def _ioCore():
         "Add changes and poll for events, blocking if scheduler queue is empty"
+        timeout = _pollTimeout()
+        if timeout is None and not io:
+            return False # nothing could ever wake us up
         changes = ioChanges.values()
         ioChanges.clear()
-        for event in kq.control(changes, len(io), 0 if queue else None):
+        try:
+            events = kq.control(changes, max(1, len(io)), timeout)
+        except EnvironmentError, e:
+            if e.errno != errno.EINTR: # a signal handler ran, just poll again
+                raise
+            events = ()
+        for event in events:
             assert not event.flags & select.KQ_EV_ERROR
             key = event.ident, event.filter
             callback = io.pop(key)(event.data, bool(event.flags & select.KQ_EV_EOF))
@@ -391,7 +801,8 @@ elif hasattr(select, 'kqueue'):
                 io[key] = callback
             else:
                 ioChanges[key] = select.kevent(event.ident, event.filter, select.KQ_EV_DELETE)
-        return bool(io)
+        _runTimers()
+        return bool(io) or _liveTimers()
     def _goRead(fd, m):
         ioChanges[fd, select.KQ_FILTER_READ] = select.kevent(fd, select.KQ_FILTER_READ, select.KQ_EV_ADD | select.KQ_EV_ENABLE)
         io[fd, select.KQ_FILTER_READ] = m
@@ -412,14 +823,23 @@ else: # fallback to select
     ioWrite = {}
     
     def _ioCore():
-        x, y, z = select.select(list(ioRead), list(ioWrite), [], 0 if queue else None)
+        timeout = _pollTimeout()
+        if timeout is None and not ioRead and not ioWrite:
+            return False # nothing could ever wake us up
+        try:
+            x, y, z = select.select(list(ioRead), list(ioWrite), [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR: # a signal handler ran, just poll again
+                raise
+            x = y = ()
         for fds, l in ((x, ioRead), (y, ioWrite)):
             for fd in fds:
                 callback = l.pop(fd)(32768, False)
                 if callback:
                     assert fd not in l
                     l[fd] = callback
-        return bool(ioRead or ioWrite)
+        _runTimers()
+        return bool(ioRead or ioWrite) or _liveTimers()
     def _goRead(fd, m):
         ioRead[fd] = m
         _ioRunner.activate()
@@ -433,6 +853,10 @@ else: # fallback to select
             del ioRead[fd]
 
 from sendfile import sendfile
+from accept4 import accept4
+from mmsg import recvmmsg, sendmmsg
+import fdpass
+from stats import ServerStats
 
 def _ioRunner():
     try:
@@ -481,20 +905,17 @@ class ScheduledFile(object):
         return cls(os.dup(sock.fileno()), *args, **vargs)
 
     @classmethod
-    def connectTcp(cls, address):
-        sock = socket.socket()
-        try:
-            sock.setblocking(False)
-            try:
-                sock.connect(address)
-            except socket.error, e:
-                if e.errno != errno.EINPROGRESS: # means we need to wait for the socket to become writable
-                    raise
-            s = cls.fromSocket(sock, autoflush=True)
-            goWrite(s.fd, '')() # we need to make sure it's writable before doing anything
-            return s
-        finally:
-            sock.close()
+    def connectTcp(cls, address, timeout=None, resolver=None):
+        "Connect to (host, port), racing the IPv6 and IPv4 addresses of host"
+        import dns
+        host, port = address[:2]
+        addresses = (resolver or dns.getResolver()).resolve(host)
+        return cls(goConnectFirst(addresses, port, timeout), autoflush=True)
+
+    @classmethod
+    def connectUnix(cls, path, timeout=None):
+        "Connect to a unix stream socket"
+        return cls(goConnect(socket.AF_UNIX, path, timeout), autoflush=True)
 
     @property
     def closed(self):
@@ -618,6 +1039,128 @@ class ScheduledFile(object):
         self.flush()
         return goSendfile(fd, self.fd, offset, nbytes)()
 
+    def sendFds(self, fds, data='\x00'):
+        "Send fds over a unix socket, attached to data which must not be empty"
+        self.flush() # the fds must arrive after what has already been written
+        while True:
+            try:
+                n = fdpass.sendFds(self.fd, data, fds)
+                break
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _waitFor(_goWrite, self.fd)
+        self.nwrite += n
+        if n < len(data):
+            self.write(data[n:])
+            self.flush()
+
+    def recvFds(self, maxfds=16):
+        """Receive fds sent with sendFds, or [] on eof. The data they were
+        attached to is added to incoming and can be read as usual. Fds attached
+        to data which has already been read with read/readline are lost."""
+        while True:
+            try:
+                data, fds = fdpass.recvFds(self.fd, self.bufferSize, maxfds)
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _waitFor(_goRead, self.fd)
+                continue
+            self.nread += len(data)
+            self.incoming += data
+            if fds or not data:
+                return fds
+
+
+"""
+Datagram sockets don't fit the file protocol, so they get their own wrapper.
+The syscall is tried first, and we only wait for the fd when it would block.
+The batch methods drain up to batchSize datagrams per readiness event using
+recvmmsg/sendmmsg where available.
+"""
+
+def _waitFor(register, fd):
+    c = Channel()
+    register(fd, lambda bytesReady, eof:c.write(eof))
+    return c.read()
+
+class ScheduledDatagram(object):
+    "A datagram socket using the scheduler/Channel framework to do asynchronous nonblocking IO"
+    def __init__(self, sock, batchSize=32, bufferSize=65536):
+        sock.setblocking(False)
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.batchSize = batchSize
+        self.bufferSize = bufferSize
+        self.nwrite = self.nread = 0
+
+    @classmethod
+    def bind(cls, address, family=socket.AF_INET, *args, **vargs):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.bind(address)
+        return cls(sock, *args, **vargs)
+
+    @property
+    def closed(self):
+        return self.fd is None
+
+    def recvfrom(self):
+        "Receive the next datagram as (data, address)"
+        while True:
+            try:
+                data, address = self.sock.recvfrom(self.bufferSize)
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _waitFor(_goRead, self.fd)
+            else:
+                self.nread += len(data)
+                return data, address
+
+    def sendto(self, data, address):
+        while True:
+            try:
+                n = self.sock.sendto(data, address)
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _waitFor(_goWrite, self.fd)
+            else:
+                self.nwrite += n
+                return n
+
+    def recvBatch(self):
+        "Receive all waiting datagrams, up to batchSize, blocking until there's at least one"
+        while True:
+            try:
+                messages = recvmmsg(self.sock, self.batchSize, self.bufferSize)
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _waitFor(_goRead, self.fd)
+            else:
+                self.nread += sum(len(i[0]) for i in messages)
+                return messages
+
+    def sendBatch(self, messages):
+        "Send all [(data, address)], blocking while the socket buffer is full"
+        offset = 0
+        while offset < len(messages):
+            try:
+                offset += sendmmsg(self.sock, messages[offset:offset+self.batchSize])
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                _waitFor(_goWrite, self.fd)
+        self.nwrite += sum(len(i[0]) for i in messages)
+
+    def close(self):
+        if self.fd is None:
+            return
+        _goClose(self.fd)
+        self.sock.close()
+        self.fd = None
 
 
 def readUntil(next, pushback, separator):
@@ -0,0 +1,354 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"a non-blocking DNS stub resolver"
+
+import os
+import time
+import errno
+import random
+import socket
+import struct
+
+from core import Channel, Timeout, go, goConnect, goClose, _goRead, _goClose
+
+"""
+Hostnames are looked up in /etc/hosts, then in a cache, and finally by asking
+the nameservers from /etc/resolv.conf over UDP, retrying over TCP if the reply
+was truncated. The reply is waited for with _goRead, so a lookup only blocks
+the calling coroutine. Names are tried with the search domains the same way
+getaddrinfo does, depending on ndots. Answers are cached for their TTL, and
+names that don't exist (NXDOMAIN, or no records of the type) for negativeTTL.
+Other failures, like timeouts and SERVFAIL, aren't cached.
+"""
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_AAAA = 28
+CLASS_IN = 1
+
+FLAG_TC = 0x0200 # the reply was truncated
+RCODE_NXDOMAIN = 3
+
+families = {TYPE_A: socket.AF_INET, TYPE_AAAA: socket.AF_INET6}
+
+class DNSError(socket.gaierror):
+    "A failed lookup"
+
+def packQuery(ident, name, qtype):
+    "Make a recursive query packet for name"
+    labels = ''.join(chr(len(i)) + i for i in name.rstrip('.').split('.') if i)
+    return struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0) + labels + '\x00' + struct.pack('!HH', qtype, CLASS_IN)
+
+def skipName(data, offset):
+    "Return the offset after the (possibly compressed) name at offset"
+    while True:
+        length = ord(data[offset])
+        if length >= 0xc0: # pointer, which always ends the name
+            return offset + 2
+        offset += length + 1
+        if not length:
+            return offset
+
+def parseResponse(data, ident, qtype):
+    "Return (rcode, [(address, ttl)]) for the records of type qtype"
+    if len(data) < 12:
+        raise DNSError('short reply')
+    rid, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHHH', data)
+    if rid != ident or not flags & 0x8000:
+        raise DNSError('unexpected reply')
+    offset = 12
+    for i in xrange(qdcount):
+        offset = skipName(data, offset) + 4
+    answers = []
+    for i in xrange(ancount):
+        offset = skipName(data, offset)
+        rtype, rclass, ttl, length = struct.unpack_from('!HHIH', data, offset)
+        offset += 10
+        if rtype == qtype and rclass == CLASS_IN:
+            answers.append((socket.inet_ntop(families[qtype], data[offset:offset+length]), ttl))
+        offset += length
+    return flags & 15, answers
+
+def parseHosts(filename='/etc/hosts'):
+    "Read a hosts file into {name: [(family, address)]}"
+    hosts = {}
+    try:
+        lines = open(filename).readlines()
+    except IOError:
+        return hosts
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if len(fields) < 2:
+            continue
+        family = socket.AF_INET6 if ':' in fields[0] else socket.AF_INET
+        for name in fields[1:]:
+            hosts.setdefault(name.lower(), []).append((family, fields[0]))
+    return hosts
+
+def parseResolvConf(filename='/etc/resolv.conf'):
+    "Read the nameservers from resolv.conf"
+    nameservers = []
+    try:
+        lines = open(filename).readlines()
+    except IOError:
+        lines = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == 'nameserver':
+            nameservers.append(fields[1])
+    return nameservers or ['127.0.0.1']
+
+def parseSearch(filename='/etc/resolv.conf'):
+    "Read (search domains, ndots) from resolv.conf, where the last search or domain line wins"
+    search, ndots = None, 1
+    try:
+        lines = open(filename).readlines()
+    except IOError:
+        lines = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] in ('search', 'domain'):
+            search = [i.rstrip('.').lower() for i in fields[1:] if i != '.']
+        elif fields and fields[0] == 'options':
+            for option in fields[1:]:
+                if option.startswith('ndots:') and option[6:].isdigit():
+                    ndots = min(int(option[6:]), 15)
+    if search is None:
+        # like the resolver in libc, default to the domain of the hostname
+        hostname = socket.gethostname().lower()
+        search = [hostname.split('.', 1)[1]] if '.' in hostname.strip('.') else []
+    return search, ndots
+
+def addressFamily(address):
+    "The family of a literal address, or None if it's a hostname"
+    for family in socket.AF_INET, socket.AF_INET6:
+        try:
+            socket.inet_pton(family, address)
+            return family
+        except (socket.error, ValueError):
+            pass
+    return None
+
+def _recvfrom(sock, timeout=None):
+    "Wait for a datagram on a non-blocking socket, returning (data, address)"
+    c = Channel()
+    def reader(bytesReady, eof):
+        try:
+            c.write(sock.recvfrom(65535))
+        except socket.error, e:
+            if e.errno == errno.EAGAIN:
+                return reader
+            c.write(('', None))
+    _goRead(sock.fileno(), reader)
+    try:
+        return c.read(timeout)
+    except Timeout:
+        _goClose(sock.fileno())
+        raise
+
+def _recvExactly(sock, n, deadline):
+    "Read n bytes from a non-blocking stream socket before deadline"
+    data = ''
+    while len(data) < n:
+        c = Channel()
+        def reader(bytesReady, eof):
+            try:
+                c.write(sock.recv(n - len(data)))
+            except socket.error, e:
+                if e.errno == errno.EAGAIN:
+                    return reader
+                c.write('')
+        _goRead(sock.fileno(), reader)
+        try:
+            chunk = c.read(max(0, deadline - time.time()))
+        except Timeout:
+            _goClose(sock.fileno())
+            raise
+        if not chunk:
+            raise DNSError('short reply')
+        data += chunk
+    return data
+
+class Resolver(object):
+    "Resolve hostnames without blocking the scheduler"
+    def __init__(self, nameservers=None, hosts=None, timeout=2.0, attempts=2, negativeTTL=30, port=53, search=None, ndots=None):
+        self.nameservers = parseResolvConf() if nameservers is None else nameservers
+        self.hosts = parseHosts() if hosts is None else hosts
+        if search is None or ndots is None:
+            defaultSearch, defaultNdots = parseSearch()
+            search = defaultSearch if search is None else search
+            ndots = defaultNdots if ndots is None else ndots
+        self.search = search
+        self.ndots = ndots
+        self.timeout = timeout # per query and nameserver
+        self.attempts = attempts
+        self.negativeTTL = negativeTTL
+        self.port = port
+        self.cache = {} # (name, qtype) -> (expires, [address])
+        self.pending = {} # (name, qtype) -> [Channel] for queries in flight
+
+    def query(self, name, qtype):
+        """Return the addresses of type qtype for name, using the cache. Raises
+        DNSError if no nameserver gave an answer"""
+        key = name, qtype
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+        # concurrent lookups of the same name share one query, and its error
+        if key in self.pending:
+            c = Channel()
+            self.pending[key].append(c)
+            addresses, error = c.read()
+            if error is not None:
+                raise error
+            return addresses
+        self.pending[key] = waiters = []
+        try:
+            addresses, ttl = self._query(name, qtype)
+        except Exception, error:
+            for c in waiters:
+                c.write((None, error))
+            raise
+        finally:
+            del self.pending[key]
+        self.cache[key] = time.time() + ttl, addresses
+        for c in waiters:
+            c.write((addresses, None))
+        return addresses
+
+    def _query(self, name, qtype):
+        for attempt in xrange(self.attempts):
+            for nameserver in self.nameservers:
+                family = addressFamily(nameserver) or socket.AF_INET
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                try:
+                    sock.setblocking(False)
+                    ident = random.randint(0, 65535)
+                    sock.sendto(packQuery(ident, name, qtype), (nameserver, self.port))
+                    deadline = time.time() + self.timeout
+                    while True:
+                        data, address = _recvfrom(sock, max(0, deadline - time.time()))
+                        if address and address[0] == nameserver:
+                            try:
+                                rcode, answers = parseResponse(data, ident, qtype)
+                                break
+                            except (DNSError, struct.error, IndexError, KeyError, ValueError):
+                                pass # spoofed or garbage, keep waiting
+                except (Timeout, socket.error):
+                    continue
+                finally:
+                    _goClose(sock.fileno())
+                    sock.close()
+                if struct.unpack_from('!H', data, 2)[0] & FLAG_TC:
+                    try:
+                        rcode, answers = self._queryTcp(nameserver, name, qtype)
+                    except (Timeout, socket.error, DNSError, struct.error, IndexError, KeyError, ValueError):
+                        continue
+                if rcode == RCODE_NXDOMAIN:
+                    return [], self.negativeTTL
+                elif rcode == 0:
+                    if not answers:
+                        return [], self.negativeTTL
+                    return [i[0] for i in answers], min(i[1] for i in answers)
+        raise DNSError(socket.EAI_AGAIN, 'no answer for %s' % name)
+
+    def _queryTcp(self, nameserver, name, qtype):
+        "Ask nameserver over TCP, for replies too big for UDP"
+        family = addressFamily(nameserver) or socket.AF_INET
+        deadline = time.time() + self.timeout
+        fd = goConnect(family, (nameserver, self.port), self.timeout)
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        goClose(fd)
+        try:
+            ident = random.randint(0, 65535)
+            query = packQuery(ident, name, qtype)
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            length, = struct.unpack('!H', _recvExactly(sock, 2, deadline))
+            return parseResponse(_recvExactly(sock, length, deadline), ident, qtype)
+        finally:
+            _goClose(sock.fileno())
+            sock.close()
+
+    def names(self, name):
+        "The names to look up for name, with the search domains in the order getaddrinfo would try them"
+        if name.endswith('.'):
+            return [name.rstrip('.')]
+        qualified = ['%s.%s' % (name, domain) for domain in self.search]
+        if name.count('.') >= self.ndots:
+            return [name] + qualified
+        return qualified + [name]
+
+    def _resolveName(self, name, qtypes):
+        "Look up all qtypes of name concurrently, returning [(family, address)]"
+        results = dict((qtype, Channel()) for qtype in qtypes)
+        def lookup(qtype):
+            try:
+                results[qtype].write((self.query(name, qtype), None))
+            except Exception, e:
+                results[qtype].write(([], e))
+        for qtype in qtypes:
+            go(lookup, qtype)
+        result, errors = [], []
+        for qtype in qtypes:
+            addresses, error = results[qtype].read()
+            result.extend((families[qtype], address) for address in addresses)
+            if error is not None:
+                errors.append(error)
+        if not result and errors:
+            raise errors[0]
+        return result
+
+    def resolve(self, host, family=socket.AF_UNSPEC):
+        "Return [(family, address)] for host, looking up IPv6 and IPv4 concurrently"
+        literal = addressFamily(host)
+        if literal:
+            return [(literal, host)]
+        if not host:
+            host = 'localhost'
+        name = host.lower()
+        if name in self.hosts:
+            result = [i for i in self.hosts[name] if family in (socket.AF_UNSPEC, i[0])]
+            if result:
+                return result
+
+        # a name that doesn't exist moves on to the next candidate, while
+        # a failure is only raised if none of them resolve
+        qtypes = [qtype for qtype in (TYPE_AAAA, TYPE_A) if family in (socket.AF_UNSPEC, families[qtype])]
+        error = None
+        for candidate in self.names(name):
+            try:
+                result = self._resolveName(candidate, qtypes)
+            except DNSError, e:
+                error = error or e
+                continue
+            if result:
+                return result
+        if error is not None:
+            raise DNSError(socket.EAI_AGAIN, 'Temporary failure in name resolution: %s (%s)' % (host, error))
+        raise DNSError(socket.EAI_NONAME, 'Name or service not known: %s' % host)
+
+resolver = None
+def getResolver():
+    "The default resolver, created on first use"
+    global resolver
+    if resolver is None:
+        resolver = Resolver()
+    return resolver
@@ -0,0 +1,129 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"wrappers for passing file descriptors over unix sockets with sendmsg/recvmsg"
+
+import os
+import sys
+import ctypes
+import ctypes.util
+import socket
+import struct
+
+from sendfile import Iovecs
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+SCM_RIGHTS = 1
+if sys.platform.startswith('linux'):
+    MSG_CTRUNC = 8
+    MSG_CMSG_CLOEXEC = 0x40000000 # received fds are close-on-exec
+    _iovlenType = _lengthType = ctypes.c_size_t
+    _align = ctypes.sizeof(ctypes.c_size_t)
+else:
+    # bsd
+    MSG_CTRUNC = 0x20
+    MSG_CMSG_CLOEXEC = 0
+    _iovlenType = ctypes.c_int
+    _lengthType = ctypes.c_uint32
+    _align = 4 if sys.platform == 'darwin' else ctypes.sizeof(ctypes.c_long)
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(Iovecs)),
+        ('msg_iovlen', _iovlenType),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', _lengthType),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+class CmsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('cmsg_len', _lengthType),
+        ('cmsg_level', ctypes.c_int),
+        ('cmsg_type', ctypes.c_int)
+    ]
+
+def _cmsgAlign(n):
+    return (n + _align - 1) & ~(_align - 1)
+
+def CMSG_LEN(n):
+    return _cmsgAlign(ctypes.sizeof(CmsgHdr)) + n
+
+def CMSG_SPACE(n):
+    return _cmsgAlign(ctypes.sizeof(CmsgHdr)) + _cmsgAlign(n)
+
+# ssize_t sendmsg(int sockfd, const struct msghdr *msg, int flags);
+_sendmsg = _libc.sendmsg
+_sendmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MsgHdr), ctypes.c_int]
+_sendmsg.restype = ctypes.c_ssize_t
+# ssize_t recvmsg(int sockfd, struct msghdr *msg, int flags);
+_recvmsg = _libc.recvmsg
+_recvmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MsgHdr), ctypes.c_int]
+_recvmsg.restype = ctypes.c_ssize_t
+
+def _raise():
+    number = ctypes.get_errno()
+    raise socket.error(number, os.strerror(number))
+
+def sendFds(fd, data, fds):
+    "Send data with fds attached, returning the number of bytes sent"
+    assert data, 'at least one byte must be sent with the fds'
+    payload = ctypes.create_string_buffer(data, len(data))
+    iovec = Iovecs(ctypes.addressof(payload), len(data))
+    header = CmsgHdr(CMSG_LEN(4*len(fds)), socket.SOL_SOCKET, SCM_RIGHTS)
+    control = ctypes.string_at(ctypes.addressof(header), ctypes.sizeof(header))
+    control = control.ljust(_cmsgAlign(len(control)), '\x00') + struct.pack('%si' % len(fds), *fds)
+    control = ctypes.create_string_buffer(control, CMSG_SPACE(4*len(fds)))
+    message = MsgHdr(None, 0, ctypes.pointer(iovec), 1, ctypes.addressof(control), len(control), 0)
+    r = _sendmsg(fd, message, 0)
+    if r == -1:
+        _raise()
+    return r
+
+def recvFds(fd, size, maxfds):
+    "Receive up to size bytes and maxfds fds, returning (data, fds)"
+    payload = ctypes.create_string_buffer(size)
+    iovec = Iovecs(ctypes.addressof(payload), size)
+    control = ctypes.create_string_buffer(CMSG_SPACE(4*maxfds))
+    message = MsgHdr(None, 0, ctypes.pointer(iovec), 1, ctypes.addressof(control), len(control), 0)
+    r = _recvmsg(fd, message, MSG_CMSG_CLOEXEC)
+    if r == -1:
+        _raise()
+
+    fds = []
+    raw = control.raw[:message.msg_controllen]
+    offset = 0
+    headerSize = ctypes.sizeof(CmsgHdr)
+    while offset + headerSize <= len(raw):
+        header = CmsgHdr.from_buffer_copy(raw[offset:offset+headerSize])
+        if header.cmsg_len < headerSize:
+            break
+        if header.cmsg_level == socket.SOL_SOCKET and header.cmsg_type == SCM_RIGHTS:
+            n = (header.cmsg_len - CMSG_LEN(0)) // 4
+            start = offset + CMSG_LEN(0)
+            fds.extend(struct.unpack_from('%si' % n, raw, start))
+        offset += _cmsgAlign(header.cmsg_len)
+    if message.msg_flags & MSG_CTRUNC:
+        for i in fds:
+            os.close(i)
+        raise socket.error('too many fds received, the rest were discarded')
+    return payload.raw[:r], fds
@@ -0,0 +1,514 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"a HTTP/1.1 server and client running directly on ScheduledFile"
+
+import os
+import json
+import time
+import errno
+import socket
+import traceback
+import SocketServer
+import BaseHTTPServer
+from collections import namedtuple
+
+from core import Channel, ScheduledFile, ScheduledMixIn, goAfter, goCancel, socketFamily
+
+"""
+BaseHTTPServer reads the request line and every header with its own readline
+call and parses the headers with mimetools. Here the whole request head is
+found with a single scan of ScheduledFile.incoming, and everything after it is
+left in the buffer. Pipelined requests are then parsed without touching the
+socket, and their responses are collected in the outgoing buffer and flushed
+with one write.
+
+A handler is a callable taking a Request and returning (status, headers, body).
+The body can be a string, a file object which will be sent using sendfile, or
+any other iterable which will be sent chunked. Bodies with a close method are
+closed once written. Framing and connection headers are added by the server,
+except for a Content-Length given by the handler, which is kept and then no
+more than that is sent. The status is a code or a string like '200 OK', and
+204, 304 and other 1xx responses are sent without a body.
+A 101 response switches protocols: its body is a callable which is given the
+ScheduledFile once the response is flushed, and owns the connection from then.
+"""
+
+Request = namedtuple('Request', 'method path version headers body keepAlive client_address')
+Response = namedtuple('Response', 'version status reason headers body keepAlive')
+
+statusLines = dict((code, 'HTTP/1.1 %s %s\r\n' % (code, reason))
+    for code, (reason, explanation) in BaseHTTPServer.BaseHTTPRequestHandler.responses.items())
+
+class HTTPError(Exception):
+    "A malformed or unacceptable message, status is the response to give"
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+def readDelimited(f, separator, maxSize):
+    "Read from f until separator, returning the data before it or None on eof"
+    start = 0
+    while True:
+        pos = f.incoming.find(separator, start)
+        if pos != -1:
+            data = str(f.incoming[:pos])
+            del f.incoming[:pos+len(separator)]
+            return data
+        if len(f.incoming) > maxSize:
+            raise HTTPError(431 if len(separator) == 4 else 400)
+        # only scan the new data, but the separator might straddle the chunks
+        start = max(0, len(f.incoming) - len(separator) + 1)
+        chunk = f._read()
+        if not chunk:
+            if f.incoming:
+                raise HTTPError(400)
+            return None
+        f.incoming += chunk
+
+def parseHeaders(lines):
+    "Parse header lines into a dict with lower case names"
+    headers = {}
+    for line in lines:
+        name, separator, value = line.partition(':')
+        if not separator:
+            raise HTTPError(400)
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = headers[name] + ', ' + value if name in headers else value
+    return headers
+
+def readChunked(f, maxSize):
+    "Read a chunked body, including any trailers"
+    body = bytearray()
+    while True:
+        line = readDelimited(f, '\r\n', 1024)
+        if line is None:
+            raise HTTPError(400)
+        try:
+            size = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise HTTPError(400)
+        if not size:
+            break
+        if len(body) + size > maxSize:
+            raise HTTPError(413)
+        data = f.read(size + 2)
+        if len(data) != size + 2 or not data.endswith('\r\n'):
+            raise HTTPError(400)
+        body += buffer(data, 0, size)
+    while readDelimited(f, '\r\n', 65536): # trailers are ignored
+        pass
+    return str(body)
+
+def readBody(f, headers, maxSize):
+    "Read a body framed by transfer-encoding or content-length"
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return readChunked(f, maxSize)
+    elif 'content-length' in headers:
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise HTTPError(400)
+        if length > maxSize:
+            raise HTTPError(413)
+        elif length < 0:
+            raise HTTPError(400)
+        data = f.read(length)
+        if len(data) != length:
+            raise HTTPError(400)
+        return data
+    return ''
+
+def readRequest(f, client_address=None, maxHeaderSize=65536, maxBodySize=2**20):
+    "Read the next request from f, or None if the client closed the connection"
+    head = readDelimited(f, '\r\n\r\n', maxHeaderSize)
+    if head is None:
+        return None
+    lines = head.lstrip('\r\n').split('\r\n') # tolerate empty lines between requests
+    try:
+        method, path, version = lines[0].split()
+    except ValueError:
+        raise HTTPError(400)
+    if version not in ('HTTP/1.1', 'HTTP/1.0'):
+        raise HTTPError(505)
+    headers = parseHeaders(lines[1:])
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        keepAlive = 'close' not in connection
+        if headers.get('expect', '').lower() == '100-continue':
+            f.write('HTTP/1.1 100 Continue\r\n\r\n')
+            f.flush()
+    else:
+        keepAlive = 'keep-alive' in connection
+
+    body = readBody(f, headers, maxBodySize)
+    return Request(method, path, version, headers, body, keepAlive, client_address)
+
+def statusCode(status):
+    "The code of a status given as a code or as a string like '200 OK'"
+    return status if isinstance(status, (int, long)) else int(status.split(None, 1)[0])
+
+def writeError(f, status):
+    "Write an empty response which will close the connection"
+    f.write(statusLines.get(status, 'HTTP/1.1 %s\r\n' % status) + 'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+def writeResponse(f, request, status, headers, body):
+    "Write a response to request, returning True if the connection can be kept alive"
+    keepAlive = request.keepAlive
+    code = statusCode(status)
+    head = [statusLines.get(status) or 'HTTP/1.1 %s\r\n' % status]
+    head.extend('%s: %s\r\n' % i for i in headers)
+
+    if code == 101:
+        head.append('\r\n')
+        f.write(''.join(head))
+        return False
+
+    length = None # given by the handler
+    for name, value in headers:
+        if name.lower() == 'content-length':
+            length = int(value)
+    if hasattr(body, 'fileno'):
+        offset = body.tell()
+        nbytes = os.fstat(body.fileno()).st_size - offset
+        if length is not None:
+            nbytes = min(nbytes, length)
+    bodiless = code in (204, 304) or code < 200
+    if length is not None or bodiless: # no body, so no framing either
+        streamed = False
+    elif isinstance(body, (str, bytearray, buffer)):
+        head.append('Content-Length: %d\r\n' % len(body))
+        streamed = False
+    elif hasattr(body, 'fileno'):
+        head.append('Content-Length: %d\r\n' % nbytes)
+        streamed = False
+    elif request.version == 'HTTP/1.1':
+        head.append('Transfer-Encoding: chunked\r\n')
+        streamed = True
+    else:
+        keepAlive = False # the body is delimited by closing the connection
+        streamed = False
+
+    if not keepAlive:
+        head.append('Connection: close\r\n')
+    elif request.version == 'HTTP/1.0':
+        head.append('Connection: keep-alive\r\n')
+    head.append('\r\n')
+    f.write(''.join(head))
+
+    if request.method == 'HEAD' or bodiless:
+        pass
+    elif hasattr(body, 'fileno'):
+        if nbytes:
+            sent = f.sendfile(body.fileno(), offset, nbytes)
+            if sent != nbytes:
+                return False
+        if length is not None and nbytes < length:
+            return False # the client is waiting for more than there is
+    elif length is not None:
+        # like the file, a body shorter than the length means closing
+        for chunk in [body] if isinstance(body, (str, bytearray, buffer)) else body:
+            if len(chunk) > length:
+                chunk = chunk[:length]
+            f.write(chunk)
+            length -= len(chunk)
+        if length:
+            return False
+    elif isinstance(body, (str, bytearray, buffer)):
+        f.write(body)
+    elif streamed:
+        for chunk in body:
+            if chunk:
+                f.write('%x\r\n' % len(chunk))
+                f.write(chunk)
+                f.write('\r\n')
+        f.write('0\r\n\r\n')
+    else:
+        for chunk in body:
+            f.write(chunk)
+    return keepAlive
+
+def _shutdownRead(f):
+    # wakes up a reader blocked on f with eof
+    if f.fd is not None:
+        try:
+            socket.fromfd(f.fd, socketFamily(f.fd), socket.SOCK_STREAM).shutdown(socket.SHUT_RD)
+        except socket.error:
+            pass
+
+def serveConnection(f, handler, client_address=None, maxHeaderSize=65536, maxBodySize=2**20, stats=None,
+        idleTimeout=None):
+    """Handle requests on f until the connection is closed, timing them in stats
+    if given. The connection is closed if no request starts within idleTimeout"""
+    # a request is timed until its response has been written to the socket,
+    # which for pipelined requests is when the batch is flushed
+    unflushed = [] # (started, status code) of the responses in f.outgoing
+    def flush():
+        f.flush()
+        if unflushed and f.outgoing is not None:
+            now = time.time()
+            for started, code in unflushed:
+                stats.requestDone(now - started, code)
+        del unflushed[:]
+
+    while True:
+        if idleTimeout is not None and not f.incoming:
+            timer = goAfter(idleTimeout, lambda:_shutdownRead(f))
+            chunk = f._read()
+            goCancel(timer)
+            if not chunk:
+                break
+            f.incoming += chunk
+        try:
+            request = readRequest(f, client_address, maxHeaderSize, maxBodySize)
+        except HTTPError, e:
+            writeError(f, e.status)
+            break
+        if request is None:
+            break
+
+        body = None
+        if stats is not None:
+            started = time.time()
+        # where this response starts in the stream, so a failure only discards
+        # its own bytes and not pipelined responses still waiting to be sent
+        mark = f.nwrite + len(f.outgoing)
+        try:
+            status, headers, body = handler(request)
+            code = statusCode(status)
+            keepAlive = writeResponse(f, request, status, headers, body)
+            if stats is not None:
+                unflushed.append((started, code))
+        except Exception:
+            if f.outgoing is None: # the client went away
+                break
+            # the handler or body iterator failed, so replace the response
+            # with an error, unless part of it has already been sent
+            traceback.print_exc()
+            if f.nwrite > mark:
+                del f.outgoing[:]
+            else:
+                del f.outgoing[mark - f.nwrite:]
+                writeError(f, 500)
+                if stats is not None:
+                    unflushed.append((started, 500))
+            break
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        if code == 101:
+            flush()
+            body(f)
+            break
+        elif not keepAlive:
+            break
+        elif f.incoming.find('\r\n\r\n') == -1:
+            # flush unless the next request is already here (pipelining), so
+            # pipelined responses go out in one write
+            flush()
+    flush()
+
+class HTTPServer(ScheduledMixIn, SocketServer.TCPServer):
+    "HTTP/1.1 server calling handler(request) for each request"
+    allow_reuse_address = True
+    maxHeaderSize = 65536
+    maxBodySize = 2**20
+    statsPath = None # answer GET statsPath with statsSnapshot() as json
+    idleTimeout = 60.0 # seconds a connection may wait for its next request
+
+    def __init__(self, server_address, handler, bind_and_activate=True):
+        self.handler = handler
+        SocketServer.TCPServer.__init__(self, server_address, None, bind_and_activate)
+
+    def finish_request(self, request, client_address):
+        handler = self._statsHandler if self.statsPath else self.handler
+        serveConnection(request, handler, client_address, self.maxHeaderSize, self.maxBodySize, self.stats,
+            self.idleTimeout)
+
+    def _statsHandler(self, request):
+        if request.path != self.statsPath:
+            return self.handler(request)
+        return 200, [('Content-Type', 'application/json')], json.dumps(self.statsSnapshot(), sort_keys=True)
+
+"""
+The client side keeps connections alive in a pool per (host, port), so that
+only the first request to a peer pays for the handshake. Idle connections are
+checked with a non-blocking read before they're reused, since the server might
+have closed them in the meantime.
+"""
+
+def writeRequest(f, host, method, path, headers=(), body=''):
+    "Write a HTTP/1.1 request with a Content-Length framed body"
+    head = ['%s %s HTTP/1.1\r\nHost: %s\r\n' % (method, path, host)]
+    head.extend('%s: %s\r\n' % i for i in headers)
+    if body or method in ('POST', 'PUT'):
+        head.append('Content-Length: %d\r\n' % len(body))
+    head.append('\r\n')
+    f.write(''.join(head))
+    if body:
+        f.write(body)
+
+def readResponse(f, method='GET', maxHeaderSize=65536, maxBodySize=2**30):
+    "Read the next response from f, raising EOFError if the connection is closed"
+    while True:
+        head = readDelimited(f, '\r\n\r\n', maxHeaderSize)
+        if head is None:
+            raise EOFError('connection closed')
+        lines = head.split('\r\n')
+        try:
+            version, status, reason = (lines[0].split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise HTTPError(502)
+        if status >= 200 or status == 101:
+            break # skip 100 continue and other interim responses
+    headers = parseHeaders(lines[1:])
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        keepAlive = 'close' not in connection
+    else:
+        keepAlive = 'keep-alive' in connection
+
+    if method == 'HEAD' or status in (204, 304) or status < 200:
+        body = ''
+    elif 'transfer-encoding' in headers or 'content-length' in headers:
+        body = readBody(f, headers, maxBodySize)
+    else:
+        body = f.read() # delimited by the server closing the connection
+        keepAlive = False
+    return Response(version, status, reason, headers, body, keepAlive)
+
+idempotent = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+class ConnectionPool(object):
+    "Keep-alive HTTP/1.1 connections shared by all coroutines"
+    def __init__(self, maxIdle=8, maxPerHost=32, maxIdleTime=30.0):
+        self.maxIdle = maxIdle # idle connections kept per host
+        self.maxPerHost = maxPerHost # open connections per host, callers wait above this
+        self.maxIdleTime = maxIdleTime # seconds before an idle connection is discarded
+        self.idle = {} # address -> [(ScheduledFile, idle since)]
+        self.connections = {} # address -> number of open connections
+        self.waiters = {} # address -> [Channel]
+        self.nconnect = self.nreuse = 0
+
+    def _healthy(self, f):
+        "Check that an idle connection hasn't been closed or received garbage"
+        if f.closed or f.outgoing is None or f.incoming:
+            return False
+        try:
+            os.read(f.fd, 1)
+        except OSError, e:
+            return e.errno == errno.EAGAIN
+        return False # eof or unexpected data
+
+    def acquire(self, address):
+        "Get an open connection to address, and whether it has been used before"
+        while True:
+            idle = self.idle.get(address)
+            while idle:
+                f, since = idle.pop()
+                if time.time() - since < self.maxIdleTime and self._healthy(f):
+                    self.nreuse += 1
+                    return f, True
+                self._discard(address, f)
+
+            if self.connections.get(address, 0) < self.maxPerHost:
+                self.connections[address] = self.connections.get(address, 0) + 1
+                try:
+                    f = ScheduledFile.connectTcp(address)
+                except:
+                    self._discard(address, None)
+                    raise
+                f.autoflush = False # requests are flushed explicitly to allow pipelining
+                self.nconnect += 1
+                return f, False
+
+            c = Channel()
+            self.waiters.setdefault(address, []).append(c)
+            c.read()
+
+    def release(self, address, f, reusable=True):
+        "Return a connection to the pool, or close it if it can't be reused"
+        idle = self.idle.setdefault(address, [])
+        if reusable and len(idle) < self.maxIdle and not f.closed and f.outgoing is not None and not f.incoming:
+            idle.append((f, time.time()))
+            self._wakeup(address)
+        else:
+            self._discard(address, f)
+
+    def _discard(self, address, f):
+        if f is not None:
+            f.close(flush=False)
+        self.connections[address] -= 1
+        self._wakeup(address)
+
+    def _wakeup(self, address):
+        waiters = self.waiters.get(address)
+        if waiters:
+            waiters.pop(0).write(None)
+
+    def _host(self, address):
+        return address[0] if address[1] == 80 else '%s:%s' % address
+
+    def pipeline(self, address, requests):
+        """Send (method, path, headers, body) requests on one connection
+        without waiting for each response, and return the responses"""
+        for retry in (True, False):
+            f, reused = self.acquire(address)
+            responses = []
+            try:
+                for method, path, headers, body in requests:
+                    writeRequest(f, self._host(address), method, path, headers, body)
+                f.flush()
+                for method, path, headers, body in requests:
+                    responses.append(readResponse(f, method))
+                    if not responses[-1].keepAlive:
+                        break
+            except (EOFError, ValueError):
+                self._discard(address, f)
+                # the server may close an idle connection at any time, so
+                # retry idempotent requests once with a new connection
+                if reused and retry and not responses and all(i[0] in idempotent for i in requests):
+                    continue
+                raise
+            except:
+                self._discard(address, f)
+                raise
+            self.release(address, f, responses[-1].keepAlive and len(responses) == len(requests))
+            if len(responses) < len(requests):
+                raise EOFError('connection closed after %s of %s responses' % (len(responses), len(requests)))
+            return responses
+
+    def request(self, address, method, path, headers=(), body=''):
+        "Send a request and return the Response"
+        response, = self.pipeline(address, [(method, path, headers, body)])
+        return response
+
+    def get(self, address, path, headers=()):
+        return self.request(address, 'GET', path, headers)
+
+    def close(self):
+        "Close all idle connections"
+        for address, idle in self.idle.items():
+            while idle:
+                self._discard(address, idle.pop()[0])
@@ -0,0 +1,184 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"wrappers for the recvmmsg and sendmmsg calls"
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+import socket
+import struct
+
+from sendfile import Iovecs
+from accept4 import parseAddress
+from fdpass import MsgHdr
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+MSG_DONTWAIT = 0x40
+SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+
+def packAddress(family, address):
+    "encode an address tuple as a struct sockaddr"
+    if family == socket.AF_INET:
+        return struct.pack('H', family) + struct.pack('!H', address[1]) + socket.inet_aton(address[0]) + '\x00'*8
+    elif family == socket.AF_INET6:
+        flowinfo, scopeid = (tuple(address[2:4]) + (0, 0))[:2]
+        return struct.pack('H', family) + struct.pack('!HI', address[1], flowinfo) + socket.inet_pton(family, address[0]) + struct.pack('I', scopeid)
+    elif family == socket.AF_UNIX:
+        return struct.pack('H', family) + address + '\x00'
+    raise ValueError('unsupported address family: %s' % family)
+
+def _recvLoop(sock, n, size):
+    result = []
+    for i in xrange(n):
+        try:
+            result.append(sock.recvfrom(size))
+        except socket.error, e:
+            if e.errno == errno.EAGAIN and result:
+                break
+            raise
+    return result
+
+def _sendLoop(sock, messages):
+    sent = 0
+    for data, address in messages:
+        try:
+            if address is None:
+                sock.send(data)
+            else:
+                sock.sendto(data, address)
+        except socket.error, e:
+            if e.errno == errno.EAGAIN and sent:
+                break
+            raise
+        sent += 1
+    return sent
+
+if sys.platform.startswith('linux') and hasattr(_libc, 'recvmmsg') and hasattr(_libc, 'sendmmsg'):
+    class MMsgHdr(ctypes.Structure):
+        _fields_ = [
+            ('msg_hdr', MsgHdr),
+            ('msg_len', ctypes.c_uint)
+        ]
+
+    # int recvmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen, int flags, struct timespec *timeout);
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    # int sendmmsg(int sockfd, struct mmsghdr *msgvec, unsigned int vlen, int flags);
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+
+    # the message headers and receive buffers are reused between calls.
+    # Nothing switches coroutine while they're in use, so they can be shared.
+    def _headers(n, size=0):
+        data = ctypes.create_string_buffer(n*size)
+        names = ctypes.create_string_buffer(n*SOCKADDR_SIZE)
+        iovecs = (Iovecs*n)()
+        messages = (MMsgHdr*n)()
+        for i in xrange(n):
+            iovecs[i].iov_base = ctypes.addressof(data) + i*size
+            iovecs[i].iov_len = size
+            header = messages[i].msg_hdr
+            header.msg_iov = ctypes.cast(ctypes.addressof(iovecs) + i*ctypes.sizeof(Iovecs), ctypes.POINTER(Iovecs))
+            header.msg_iovlen = 1
+            header.msg_name = ctypes.addressof(names) + i*SOCKADDR_SIZE
+            header.msg_namelen = SOCKADDR_SIZE
+        return data, names, iovecs, messages
+
+    # the results are read straight from the memory of the headers, which is
+    # much faster than going through the ctypes fields
+    _stride = ctypes.sizeof(MMsgHdr)
+    _namelenOffset = MMsgHdr.msg_hdr.offset + MsgHdr.msg_namelen.offset
+    _lenOffset = MMsgHdr.msg_len.offset
+    _unpackUint = struct.Struct('I').unpack_from
+
+    _receivers = {}
+    _addresses = {} # struct sockaddr -> address tuple
+
+    def recvmmsg(sock, n, size=65536):
+        "Receive up to n datagrams of at most size bytes, returning [(data, address)]"
+        key = n, size
+        if key not in _receivers:
+            data, names, iovecs, messages = _headers(n, size)
+            # the initial headers, used to reset msg_namelen after each call
+            template = ctypes.string_at(messages, ctypes.sizeof(messages))
+            _receivers[key] = buffer(data), buffer(names), buffer(messages), template, (data, names, iovecs, messages)
+        view, namesView, messagesView, template, (data, names, iovecs, messages) = _receivers[key]
+        r = _recvmmsg(sock.fileno(), messages, n, MSG_DONTWAIT, None)
+        if r == -1:
+            number = ctypes.get_errno()
+            raise socket.error(number, os.strerror(number))
+        result = []
+        for i in xrange(r):
+            offset = i*_stride
+            length, = _unpackUint(messagesView, offset + _namelenOffset)
+            messageLength, = _unpackUint(messagesView, offset + _lenOffset)
+            offset = i*SOCKADDR_SIZE
+            raw = namesView[offset:offset+length]
+            address = _addresses.get(raw)
+            if address is None:
+                if len(_addresses) > 1024:
+                    _addresses.clear()
+                address = _addresses[raw] = parseAddress(raw, length) if length else None
+            offset = i*size
+            result.append((view[offset:offset+messageLength], address))
+        ctypes.memmove(messages, template, r*_stride)
+        return result
+
+    _senders = {}
+
+    def sendmmsg(sock, messages):
+        """Send [(data, address)] with one call, returning the number sent. data
+        must be a str, and address is None for connected sockets"""
+        n = len(messages)
+        if n not in _senders:
+            _senders[n] = _headers(n)
+        unused, unused, iovecs, headers = _senders[n]
+        # copy the payloads into one string so we only need one pointer
+        blob = ''.join(i[0] for i in messages)
+        base = ctypes.cast(ctypes.c_char_p(blob), ctypes.c_void_p).value
+        names = {}
+        for i, (data, address) in enumerate(messages):
+            iovec = iovecs[i]
+            iovec.iov_base = base
+            iovec.iov_len = length = len(data)
+            base += length
+            header = headers[i].msg_hdr
+            if address is None:
+                header.msg_name = None
+                header.msg_namelen = 0
+            else:
+                if address not in names:
+                    name = packAddress(sock.family, address)
+                    names[address] = name, ctypes.cast(ctypes.c_char_p(name), ctypes.c_void_p).value
+                name, pointer = names[address]
+                header.msg_name = pointer
+                header.msg_namelen = len(name)
+        r = _sendmmsg(sock.fileno(), headers, n, MSG_DONTWAIT)
+        if r == -1:
+            number = ctypes.get_errno()
+            raise socket.error(number, os.strerror(number))
+        return r
+
+else:
+    recvmmsg = _recvLoop
+    sendmmsg = _sendLoop
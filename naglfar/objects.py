@@ -19,14 +19,49 @@
 
 "serialization of some python objects"
 
+import os
+import sys
+import mmap
+import time
+import zlib
 import struct
 import binascii
+from array import array
 from itertools import count, chain
-from collections import namedtuple
+from collections import namedtuple, Sequence, OrderedDict
+from stats import Histogram
 
 TYPE_TUPLE = 0
 TYPE_BYTES = 1
 TYPE_INTEGER = 2
+TYPE_EXTENDED = 3
+
+# the first byte of a TYPE_EXTENDED element
+EXT_NONE = 0
+EXT_FALSE = 1
+EXT_TRUE = 2
+EXT_FLOAT = 3
+EXT_BYTEARRAY = 4
+EXT_ARRAY = 5
+EXT_INTS = 6
+EXT_FLOATS = 7
+EXT_STRINGS = 8
+EXT_UNICODES = 9
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 Header = namedtuple('Header', 'id type length')
 PreHeader = namedtuple('PreHeader', 'id_size length_size type')
@@ -35,6 +70,16 @@ Element = namedtuple('Element', 'id type data')
 # id
 # (id_size:3)(length_size:3)(type:2)(id:id_size<<2)(length:length_size<<2)
 
+_uint64 = struct.Struct('<Q')
+_uint64be = struct.Struct('>Q')
+_double = struct.Struct('<d')
+
+# A TYPE_TUPLE starts with a byte giving the size of the big endian ids after
+# it, as a power of two. They're converted with a precompiled struct per size
+# and count, which is faster than going through array on python 2.
+idFormats = 'B', 'H', 'I', 'Q'
+_idStructs = {}
+
 def unpackHeader1(b):
     object_type = b & 3
     length_size = b & 28 or 32
@@ -44,12 +89,15 @@ def unpackHeader1(b):
         length_size += 2
     return PreHeader(id_size, length_size, object_type)
 
+# unpackHeader1 and the size of the whole header, for each first byte
+_preHeaders = [unpackHeader1(b) + (1 + (sum(unpackHeader1(b)[:2]) >> 3),) for b in xrange(256)]
+
 def unpackHeader2(data, id_size, length_size, offset=0):
     assert id_size + length_size <= 64
     if len(data) - offset < 8:
         data = str(data[offset:]) + '\x00\x00\x00\x00\x00\x00\x00\x00'
         offset = 0
-    n, = struct.unpack('>Q', str(data[offset:offset+8]))
+    n, = _uint64be.unpack_from(data, offset)
     return n>>(64-id_size), (n>>(64-id_size-length_size)) & ((1<<length_size)-1)
 
 table = [0, 1, None, 16, None, 2, 29, None, 17, None, None, None, 3, 22, 30, None, None, None, 20, 18, 11, None, 13, None, None, 4, None, 7, None, 23, 31, None, 15, None, 28, None, None, None, 21, None, 19, 10, 12, None, 6, None, None, 14, 27, None, None, 9, None, 5, None, 26, None, 8, 25, None, 24, None, 32, None]
@@ -91,7 +139,7 @@ def marshalHeader(id, type, length):
     n = 0
     n |= id<<(64-id_size) 
     n |= length<<(64-id_size-length_size) 
-    return chr(((id_size<<3)&224) | (length_size&28) | type) + struct.pack('>Q', n)[:(id_size+length_size) >> 3]
+    return chr(((id_size<<3)&224) | (length_size&28) | type) + _uint64be.pack(n)[:(id_size+length_size) >> 3]
 
 def parseHeader(data):
     id_size, length_size, type = unpackHeader1(ord(data[0]))
@@ -99,34 +147,299 @@ def parseHeader(data):
     return Header(id, type, length)
 
 def bytesToInt(data):
-    n = sum((ord(i) << (8*pos)) for pos, i in enumerate(data))
+    "Decode a little endian zigzag encoded integer"
+    if len(data) <= 8:
+        n, = _uint64.unpack(data + '\x00' * (8 - len(data)))
+    else:
+        n = int(binascii.hexlify(data[::-1]), 16)
     return -(n >> 1) if n & 1 else n >> 1
 
 def intToBytes(n):
-    if not n:
-        return ''
-    elif n < 0:
-        h = hex(((-n)<<1) | 1)
-    else:
-        h = hex(n<<1)
-
-    if h.endswith('L'):
-        h = h[2:-1]
-    else:
-        h = h[2:]
-
+    "Encode n zigzagged as little endian bytes, without trailing zeros"
+    n = ((-n) << 1) | 1 if n < 0 else n << 1
+    if n < 18446744073709551616:
+        return _uint64.pack(n).rstrip('\x00')
+    h = '%x' % n
     if len(h) & 1:
         h = '0' + h
     return binascii.unhexlify(h)[::-1]
 
-def load(stream):
-    objects = {}
+def idStruct(width, n):
+    "A struct for n ids of 1 << width bytes"
+    key = width, n
+    s = _idStructs.get(key)
+    if s is None:
+        if len(_idStructs) >= 4096:
+            _idStructs.clear()
+        s = _idStructs[key] = struct.Struct('>%d%s' % (n, idFormats[width]))
+    return s
+
+def packIds(width, ids):
+    return idStruct(width, len(ids)).pack(*ids)
+
+def unpackIds(width, block, offset, size):
+    "Unpack the ids packed with packIds in size bytes at offset in block"
+    return idStruct(width, size >> width).unpack_from(block, offset)
+
+"""
+Floats, bools and None are TYPE_EXTENDED elements, a tag byte followed by the
+little endian double for a float. Typed binary data, i.e. bytearray, buffer,
+memoryview, array.array, BufferView and numpy arrays, is written as a header
+with the dtype and shape followed by the contiguous bytes:
+
+(EXT_ARRAY:8)(dtype length:8)(dtype)(ndim:8)(dims:64*ndim)(bytes)
+
+The dtype is written the way numpy does it, e.g. '<f8' or '|u1'. Decoding
+doesn't copy the bytes. They become a numpy array when numpy is installed and a
+BufferView otherwise, either way looking into the data they were parsed from.
+A bytearray is mutable, so it's decoded to a bytearray of its own.
+"""
+
+class BufferView(namedtuple('BufferView', 'dtype shape data')):
+    "Typed binary data, without numpy"
+    def toarray(self):
+        "Copy the data to an array.array, for one dimensional dtypes array supports"
+        typecode = _typecodes.get(self.dtype[1:])
+        if typecode is None or len(self.shape) != 1:
+            raise TypeError('no array typecode for %s %s' % (self.dtype, self.shape))
+        a = array(typecode)
+        a.fromstring(self.data[:])
+        if self.dtype[0] not in '|' + _byteorder:
+            a.byteswap()
+        return a
+
+_byteorder = '<' if sys.byteorder == 'little' else '>'
+_kinds = dict([(c, 'i') for c in 'bhilq'] + [(c, 'u') for c in 'BHILQ'] + [('f', 'f'), ('d', 'f'), ('?', 'b'), ('c', 'S')])
+
+def _arrayTypecodes():
+    "Map dtypes to the typecodes array has for them, which leaves out q and Q before python 3.3"
+    typecodes = {}
+    for c in 'bBhHiIlLqQfd':
+        try:
+            typecodes.setdefault('%s%d' % (_kinds[c], array(c).itemsize), c)
+        except ValueError:
+            pass
+    return typecodes
+_typecodes = _arrayTypecodes()
+
+def _dtype(typecode, itemsize):
+    "The numpy style dtype for a struct or array typecode"
+    kind = _kinds.get(typecode.lstrip('@=<>!'))
+    if kind is None:
+        raise NotImplementedError('unsupported buffer format: %r' % typecode)
+    return '%s%s%d' % ('|' if itemsize == 1 else _byteorder, kind, itemsize)
+
+def _isBuffer(obj):
+    return isinstance(obj, (bytearray, buffer, memoryview, array, BufferView)) or \
+        numpy is not None and isinstance(obj, numpy.ndarray)
+
+def _arrayParts(obj):
+    "Return dtype, shape, bytes for typed binary data"
+    if isinstance(obj, BufferView):
+        return obj.dtype, obj.shape, obj.data[:]
+    elif isinstance(obj, buffer):
+        return '|u1', (len(obj),), obj[:]
+    elif isinstance(obj, memoryview):
+        return _dtype(obj.format, obj.itemsize), obj.shape, obj.tobytes()
+    elif isinstance(obj, array):
+        return _dtype(obj.typecode, obj.itemsize), (len(obj),), obj.tostring()
+    elif obj.dtype.hasobject:
+        raise NotImplementedError('unsupported array dtype: %s' % obj.dtype)
+    return obj.dtype.str, obj.shape, numpy.ascontiguousarray(obj).tostring()
+
+def extendedToBytes(obj):
+    "Encode None, a bool, a float or typed binary data as a TYPE_EXTENDED element"
+    if obj is None:
+        return chr(EXT_NONE)
+    elif obj is False:
+        return chr(EXT_FALSE)
+    elif obj is True:
+        return chr(EXT_TRUE)
+    elif type(obj) == float:
+        return chr(EXT_FLOAT) + _double.pack(obj)
+    elif type(obj) == bytearray:
+        return chr(EXT_BYTEARRAY) + str(obj)
+    elif isinstance(obj, _Column):
+        return columnToBytes(obj.tag, obj.values)
+    dtype, shape, data = _arrayParts(obj)
+    return ''.join([chr(EXT_ARRAY), chr(len(dtype)), dtype, chr(len(shape)),
+        struct.pack('<%dQ' % len(shape), *shape), data])
+
+def bytesToExtended(block, offset, size):
+    "Decode the TYPE_EXTENDED element of size bytes at offset in block"
+    tag = ord(block[offset:offset+1])
+    if tag == EXT_NONE:
+        return None
+    elif tag == EXT_FALSE:
+        return False
+    elif tag == EXT_TRUE:
+        return True
+    elif tag == EXT_FLOAT:
+        return _double.unpack_from(block, offset + 1)[0]
+    elif tag == EXT_BYTEARRAY:
+        return bytearray(buffer(block, offset + 1, size - 1))
+    elif tag >= EXT_INTS:
+        return bytesToColumn(tag, block, offset, size)
+    assert tag == EXT_ARRAY, tag
+    end = offset + size
+    n = ord(block[offset+1:offset+2])
+    offset += 2
+    dtype = str(block[offset:offset+n])
+    ndim = ord(block[offset+n:offset+n+1])
+    offset += n + 1
+    shape = struct.unpack_from('<%dQ' % ndim, block, offset)
+    offset += 8 * ndim
+    data = buffer(block, offset, end - offset)
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype).reshape(shape)
+    return BufferView(dtype, shape, data)
+
+"""
+In columnar mode, dump looks for lists of at least columnarThreshold rows which
+are tuples of the same type and length, or dicts with the same keys. Such a
+list becomes a table, a tuple of references like this:
+
+('table', number of keys, key..., column...)
+
+where the keys are those of the dicts, and none for tuples. A column of ints
+which fit in 64 bits, floats, strs or unicodes is a single TYPE_EXTENDED
+element with the values packed after each other. Strings are packed as the
+little endian end offsets followed by the concatenated data:
+
+(EXT_STRINGS:8)(width:8)(count:64)(ends:count<<width)(data)
+
+Other columns are lists of references, as if they had been dumped as lists.
+load returns a table as Rows, which only builds a row when it's asked for.
+"""
+
+columnarThreshold = 8
+_intFormats = 'b', 'h', 'i', 'q'
+_Column = namedtuple('_Column', 'tag values')
+
+class Rows(Sequence):
+    "A read only list of the rows of a table, built as they're accessed"
+    def __init__(self, keys=None, columns=()):
+        self.fill(keys, columns)
+
+    def fill(self, keys, columns):
+        self.keys = keys
+        self.columns = columns
+        self.rows = [None] * (len(columns[0]) if columns else 0)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        row = self.rows[i]
+        if row is None:
+            row = tuple([column[i] for column in self.columns])
+            if self.keys is not None:
+                row = dict(zip(self.keys, row))
+            self.rows[i] = row
+        return row
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, Rows)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Rows(%r)' % list(self)
+
+def _table(rows):
+    "Return keys, columns if rows are same shaped dicts or tuples, otherwise None"
+    first = rows[0]
+    t = type(first)
+    if t == dict and first:
+        keys = first.viewkeys()
+        for row in rows:
+            if type(row) != dict or row.viewkeys() != keys:
+                return None
+        keys = tuple(keys)
+        return keys, [tuple([row[key] for row in rows]) for key in keys]
+    elif isinstance(first, tuple) and first and not isinstance(first, BufferView):
+        n = len(first)
+        for row in rows:
+            if type(row) != t or len(row) != n:
+                return None
+        return (), zip(*rows)
+    return None
+
+def _columnTag(values):
+    "The EXT_* tag to pack a column of values with, or None"
+    types = set(map(type, values))
+    if types <= set([int, long]):
+        if -9223372036854775808 <= min(values) and max(values) < 9223372036854775808:
+            return EXT_INTS
+    elif types == set([float]):
+        return EXT_FLOATS
+    elif types == set([str]):
+        return EXT_STRINGS
+    elif types == set([unicode]):
+        return EXT_UNICODES
+    return None
+
+def _intWidth(low, high):
+    for width in 0, 1, 2:
+        limit = 1 << ((8 << width) - 1)
+        if -limit <= low and high < limit:
+            return width
+    return 3
+
+def columnToBytes(tag, values):
+    "Pack a column with the tag given by _columnTag"
+    n = len(values)
+    if tag == EXT_INTS:
+        width = _intWidth(min(values), max(values))
+        return chr(tag) + chr(width) + struct.pack('<%d%s' % (n, _intFormats[width]), *values)
+    elif tag == EXT_FLOATS:
+        return chr(tag) + struct.pack('<%dd' % n, *values)
+    if tag == EXT_UNICODES:
+        values = [i.encode('UTF-8') for i in values]
+    data = ''.join(values)
+    ends = []
+    end = 0
+    for i in values:
+        end += len(i)
+        ends.append(end)
+    width = _intWidth(0, end)
+    return ''.join([chr(tag), chr(width), _uint64.pack(n),
+        struct.pack('<%d%s' % (n, idFormats[width]), *ends), data])
+
+def bytesToColumn(tag, block, offset, size):
+    "Unpack a column packed by columnToBytes to a tuple or list of values"
+    if tag == EXT_FLOATS:
+        return struct.unpack_from('<%dd' % ((size - 1) >> 3), block, offset + 1)
+    width = ord(block[offset+1:offset+2])
+    if tag == EXT_INTS:
+        return struct.unpack_from('<%d%s' % ((size - 2) >> width, _intFormats[width]), block, offset + 2)
+    end = offset + size
+    n, = _uint64.unpack_from(block, offset + 2)
+    offset += 10
+    ends = struct.unpack_from('<%d%s' % (n, idFormats[width]), block, offset)
+    offset += n << width
+    data = buffer(block, offset, end - offset)
+    starts = (0,) + ends
+    values = [data[starts[i]:ends[i]] for i in xrange(n)]
+    if tag == EXT_UNICODES:
+        values = [unicode(i, 'UTF-8') for i in values]
+    return values
+
+def load(stream, known=None):
+    objects = dict(known) if known else {}
     deferred = {}
     for i in stream:
-        if i.type in (TYPE_INTEGER, TYPE_BYTES):
+        if i.type != TYPE_TUPLE:
             objects[i.id] = i.data
         else:
-            assert i.type == TYPE_TUPLE
             deferred[i.id] = i.data
 
     def get(identity):
@@ -149,6 +462,10 @@ def load(stream):
             data.update(get(i) for i in iterator)
         elif t == 'unicode':
             objects[identity] = data = unicode(get(iterator.next()), 'UTF-8')
+        elif t == 'table':
+            objects[identity] = data = Rows()
+            keys = [get(iterator.next()) for i in xrange(get(iterator.next()))]
+            data.fill(keys or None, [get(i) for i in iterator])
         else:
             assert False, (identity, t, references)
 
@@ -156,7 +473,7 @@ def load(stream):
 
     return get(0)
 
-def dump(root, objects=None, idMap=None, ids=None):
+def dump(root, objects=None, idMap=None, ids=None, columnar=False, known=(), cache=None):
     if objects is None:
         objects = {}
     if idMap is None:
@@ -166,7 +483,8 @@ def dump(root, objects=None, idMap=None, ids=None):
 
     def getIdentity(obj):
         try:
-            if type(obj) == unicode:
+            # these compare equal to objects of other types, e.g. 1 == 1.0 == True
+            if isinstance(obj, (unicode, float, bool, tuple)):
                 raise TypeError('boink')
             hash(obj)
         except TypeError:
@@ -191,7 +509,7 @@ def dump(root, objects=None, idMap=None, ids=None):
             return objects[obj]
 
     q = [root]
-    done = set()
+    done = set(known) # identities the reader already has
     while q:
         obj = q.pop()
         identity = getIdentity(obj)
@@ -199,10 +517,37 @@ def dump(root, objects=None, idMap=None, ids=None):
             continue
         done.add(identity)
 
+        if cache is not None and isinstance(obj, tuple) and len(obj) >= cache.minLength:
+            fragment = cache.fragment(obj, identity)
+            if fragment is not None:
+                yield identity, _SPLICED, fragment
+                continue
+
+        table = None
+        if columnar and type(obj) == list and len(obj) >= columnarThreshold:
+            table = _table(obj)
+
         if type(obj) in (int, long):
             yield identity, TYPE_INTEGER, obj
         elif type(obj) == bytes:
             yield identity, TYPE_BYTES, obj
+        elif obj is None or type(obj) in (bool, float) or _isBuffer(obj):
+            yield identity, TYPE_EXTENDED, obj
+        elif table is not None:
+            keys, columns = table
+            values = ('table', len(keys)) + keys
+            q.extend(values)
+            references = [getIdentity(i) for i in values]
+            for column in columns:
+                tag = _columnTag(column)
+                references.append(ids.next())
+                if tag is None:
+                    q.extend(column)
+                    q.append('list')
+                    yield references[-1], TYPE_TUPLE, tuple(getIdentity(i) for i in ('list',) + tuple(column))
+                else:
+                    yield references[-1], TYPE_EXTENDED, _Column(tag, column)
+            yield identity, TYPE_TUPLE, tuple(references)
         else:
             if isinstance(obj, dict):
                 values = ('dict', ) + tuple(chain(*obj.items()))
@@ -222,6 +567,10 @@ def dump(root, objects=None, idMap=None, ids=None):
 
 def marshal(stream):
     for id, t, data in stream:
+        if t is _SPLICED:
+            for i in data:
+                yield i
+            continue
         raw = marshalData(t, data)
         yield marshalHeader(id, t, len(raw))
         yield raw
@@ -236,88 +585,582 @@ def marshalData(t, data):
         if not data:
             return ''
         n = max(data)
-        if n<256:
-            h = '\x00'
-            format = 'B'
-        elif n<65536:
-            h = '\x01'
-            format = 'H'
-        elif n<4294967296:
-            h = '\x02'
-            format = 'I'
+        if n < 256:
+            width = 0
+        elif n < 65536:
+            width = 1
+        elif n < 4294967296:
+            width = 2
+        elif n < 18446744073709551616:
+            width = 3
         else:
-            assert False
-        return h + ''.join(struct.pack('>' + format*len(data), *data))
+            raise ValueError('id too large: %d' % n)
+        return chr(width) + packIds(width, data)
+    elif t == TYPE_EXTENDED:
+        return extendedToBytes(data)
     else:
         assert 0, (t, data)
 
 #def parseHeader(data):
 #    return Header._make(struct.unpack_from(headerFormat, data))
 
+"""
+unmarshal parses each element where it is in the chunk it arrived in, and only
+copies data when an element is split between chunks. Then the unparsed tail is
+moved to a new block along with as many chunks as the element needs, so every
+byte is copied at most once plus once for the element it belongs to.
+"""
+
+def _refill(stream, block, offset, needed):
+    "Keep the unparsed tail of block, and add chunks until it's at least needed bytes"
+    tail = bytearray(buffer(block, offset))
+    while len(tail) < needed:
+        tail += stream.next()
+    return tail
+
 def unmarshal(stream):
+    "Parse Elements from an iterable of chunks"
     stream = iter(stream)
-    buffer = bytearray()
+    block = ''
+    offset = 0
     while True:
-        if not buffer:
-            buffer += stream.next()
+        if offset == len(block):
+            block = stream.next()
+            offset = 0
+            continue
 
-        id_size, length_size, type = unpackHeader1(buffer[0])
+        id_size, length_size, type = unpackHeader1(ord(block[offset:offset+1]))
         headerSize = 1 + ((id_size+length_size)>>3)
-        while len(buffer) < headerSize:
-            buffer += stream.next()
+        if len(block) - offset < headerSize:
+            block, offset = _refill(stream, block, offset, headerSize), 0
+            continue
 
-        id, length = unpackHeader2(buffer, id_size, length_size, 1)
+        id, length = unpackHeader2(block, id_size, length_size, offset + 1)
+        end = offset + headerSize + length
+        if len(block) < end:
+            block, offset = _refill(stream, block, offset, headerSize + length), 0
+            continue
 
-        while len(buffer) < headerSize + length:
-            buffer += stream.next()
+        yield Element(id, type, unmarshalData(type, block, offset + headerSize, length))
+        offset = end
 
-        data = unmarshalData(type, str(buffer), headerSize, length)
-        del buffer[:headerSize+length]
-        yield Element(id, type, data)
+def unmarshalBlock(block, offset=0, end=None):
+    "Parse the Elements in a block holding all of them, which is faster than unmarshal"
+    if end is None:
+        end = len(block)
+    elements = []
+    while offset < end:
+        id_size, length_size, type, headerSize = _preHeaders[ord(block[offset:offset+1])]
+        id, length = unpackHeader2(block, id_size, length_size, offset + 1)
+        offset += headerSize
+        if offset + length > end:
+            raise ValueError('element goes past the end of the block')
+        elements.append(Element(id, type, unmarshalData(type, block, offset, length)))
+        offset += length
+    return elements
 
 def unmarshalData(type, block, offset, size):
+    "Decode size bytes at offset in block, which is a str or a bytearray"
     assert len(block) >= offset + size, (len(block), offset, size)
     if type == TYPE_BYTES:
-        return block[offset:offset+size]
+        return buffer(block, offset, size)[:]
     elif type == TYPE_INTEGER:
-        return bytesToInt(block[offset:offset+size])
+        return bytesToInt(buffer(block, offset, size)[:])
     elif type == TYPE_TUPLE:
         if not size:
             return ()
-        h = ord(block[offset])
+        width = ord(block[offset:offset+1])
         size -= 1
-        if h == 0:
-            format = 'B'*size
-        elif h == 1:
-            assert not size & 1
-            format = 'H'*(size/2)
-        elif h == 2:
-            assert not size & 3, size
-            format == 'I'*(size/4)
-        return tuple(struct.unpack_from('>' + format, block, offset+1))
+        assert width < len(idFormats) and not size & ((1 << width) - 1), (width, size)
+        return unpackIds(width, block, offset+1, size)
+    elif type == TYPE_EXTENDED:
+        return bytesToExtended(block, offset, size)
     else:
         assert 0, type
 
-def dumpstream(stream):
+"""
+An EncodingCache keeps the marshaled elements of tuples which only hold
+immutable objects, so dump can write them again without walking them. A cached
+tuple is marshaled once, with its elements numbered in a range of ids of its
+own above idBase. Splicing it into a dump is then a header for its root, with
+the identity the dump gave it, followed by the bytes kept from the first time.
+The ids of the objects in a dump must stay below idBase.
+
+Tuples are looked up by identity, and the cache holds on to them so the id
+stays theirs. Looking them up by value would make (1,), (1.0,) and (True,) the
+same. The least recently used tuples are evicted when the marshaled bytes go
+above maxBytes, and tuples shorter than minLength aren't worth looking up.
+
+A tuple is only marshaled for the cache the second time it's seen, so tuples
+that are dumped once, like most of the ones built for a single message, cost no
+more than without the cache. The ones seen once are remembered in seen, up to
+maxSeen of them, by their id and a fingerprint rather than the tuple itself, so
+a one-off tuple isn't kept alive. A new tuple which happens to get the id and
+fingerprint of one seen before is only marshaled one sighting early. A tuple is marshaled with the cache itself, so the cached
+tuples inside it are spliced in, and its pieces share their bytes instead of
+holding a copy. Only lookups answered from the cache count as hits, while
+lookups of tuples holding mutable objects count as uncacheable.
+"""
+
+_SPLICED = -1 # dump yields elements of this type with the marshaled pieces as data
+_immutableTypes = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+_CacheEntry = namedtuple('_CacheEntry', 'obj root rest size')
+
+class EncodingCache(object):
+    "Marshaled elements of immutable tuples, to splice into later dumps"
+    idBase = 1 << 24
+
+    def __init__(self, maxBytes=16 << 20, minLength=8, maxSeen=65536):
+        self.maxBytes = maxBytes
+        self.minLength = minLength
+        self.maxSeen = maxSeen
+        self.entries = OrderedDict() # id(tuple) -> _CacheEntry, least recently used first
+        self.seen = OrderedDict() # id(tuple) -> _fingerprint(tuple), for the ones seen once
+        self.size = 0
+        self.ids = count(self.idBase)
+        self.building = set() # id(tuple) of the tuples being marshaled
+        self.hits = self.misses = self.uncacheable = self.evictions = 0
+
+    def fragment(self, obj, identity):
+        "The marshaled pieces of obj with the root as identity, or None if it isn't cached"
+        if id(obj) in self.building:
+            return None
+        entry = self.entries.pop(id(obj), None)
+        if entry is not None and entry.obj is obj:
+            if entry.root is None:
+                self.uncacheable += 1
+            else:
+                self.hits += 1
+        elif self.seen.pop(id(obj), None) != _fingerprint(obj):
+            self.misses += 1
+            self.seen[id(obj)] = _fingerprint(obj)
+            if len(self.seen) > self.maxSeen:
+                self.seen.popitem(last=False)
+            return None
+        else:
+            entry = self._build(obj)
+        self.entries[id(obj)] = entry
+        while self.size > self.maxBytes:
+            self.size -= self.entries.popitem(last=False)[1].size
+            self.evictions += 1
+        if entry.root is None:
+            return None
+        if identity >= self.idBase and not self.building:
+            raise ValueError('too many objects in one dump for the cache')
+        return (marshalHeader(identity, TYPE_TUPLE, len(entry.root)), entry.root) + entry.rest
+
+    def _build(self, obj):
+        if not _isImmutable(obj):
+            self.uncacheable += 1
+            entry = _CacheEntry(obj, None, None, 64)
+        else:
+            self.misses += 1
+            self.building.add(id(obj))
+            try:
+                elements = list(dump(obj, ids=self.ids, cache=self))
+            finally:
+                self.building.remove(id(obj))
+            # runs of our own elements are joined, while spliced tuples keep
+            # the pieces of their own entry, which are counted there
+            root = marshalData(TYPE_TUPLE, elements[0][2])
+            rest, run, size = [], [], 64 + len(root)
+            for element in elements[1:]:
+                if element[1] is _SPLICED:
+                    run.extend(element[2][:2])
+                    rest.append(''.join(run))
+                    size += len(rest[-1])
+                    rest.extend(element[2][2:])
+                    run = []
+                else:
+                    run.extend(marshal([element]))
+            if run:
+                rest.append(''.join(run))
+                size += len(rest[-1])
+            entry = _CacheEntry(obj, root, tuple(rest), size)
+        self.size += entry.size
+        return entry
+
+    def snapshot(self):
+        lookups = self.hits + self.misses + self.uncacheable
+        return dict(entries=len(self.entries), bytes=self.size, hits=self.hits, misses=self.misses,
+            uncacheable=self.uncacheable, evictions=self.evictions,
+            hitRate=float(self.hits) / lookups if lookups else 0.0)
+
+def _fingerprint(obj):
+    "Tell apart most tuples which got the same id, without holding on to them"
+    return len(obj), id(obj[0]), id(obj[-1])
+
+def _isImmutable(obj):
+    q = [obj]
+    while q:
+        obj = q.pop()
+        if isinstance(obj, tuple) and not isinstance(obj, (BufferView, _Column)):
+            q.extend(obj)
+        elif type(obj) not in _immutableTypes:
+            return False
+    return True
+
+"""
+The id of a frame says how its payload is compressed, and is 0 for frames which
+aren't. Readers of uncompressed frames are unchanged, so a peer only has to
+understand compression if it's sent compressed frames. A Compression only
+compresses payloads of at least threshold bytes, and sends the payload as it
+is when compressing doesn't make it smaller.
+
+A compressed payload is decompressed in chunks of decompressChunk bytes which
+unmarshal parses as they come, so the whole object is never held both
+compressed and decompressed. Time spent and bytes saved are counted in a
+CompressionStats, by default the module's compressionStats.
+"""
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_ZSTD = 3
+FRAME_SESSION = 4 # set in the id of frames which refer to a Session's atoms
+
+Codec = namedtuple('Codec', 'name level compress decompressor')
+
+codecs = {CODEC_ZLIB: Codec('zlib', 6, zlib.compress, zlib.decompressobj)}
+if lz4 is not None:
+    codecs[CODEC_LZ4] = Codec('lz4', 0,
+        lambda data, level: lz4.frame.compress(data, compression_level=level),
+        lz4.frame.LZ4FrameDecompressor)
+if zstandard is not None:
+    codecs[CODEC_ZSTD] = Codec('zstd', 3,
+        lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+        lambda: zstandard.ZstdDecompressor().decompressobj())
+
+decompressChunk = 65536
+
+class CompressionStats(object):
+    "How much compressing frames has saved, and what it cost"
+    def __init__(self):
+        self.frames = 0 # written, compressed or not
+        self.compressed = 0
+        self.bytesIn = self.bytesOut = 0 # payload bytes before and after compression
+        self.compressTime = Histogram() # per frame compression was tried on
+        self.decompressTime = Histogram() # per compressed frame read
+
+    def frameWritten(self, size, compressedSize, seconds=None):
+        self.frames += 1
+        self.bytesIn += size
+        self.bytesOut += compressedSize
+        if seconds is not None:
+            self.compressTime.record(seconds)
+        if compressedSize != size:
+            self.compressed += 1
+
+    def snapshot(self):
+        return dict(frames=self.frames, compressed=self.compressed, bytesIn=self.bytesIn,
+            bytesOut=self.bytesOut, ratio=float(self.bytesIn) / self.bytesOut if self.bytesOut else 1.0,
+            compressTime=self.compressTime.snapshot(), decompressTime=self.decompressTime.snapshot())
+
+compressionStats = CompressionStats()
+
+class Compression(object):
+    "How dumpstream compresses frames"
+    def __init__(self, codec='zlib', threshold=1024, level=None, stats=None):
+        available = dict((c.name, id) for id, c in codecs.items())
+        if codec not in available:
+            raise ValueError('codec not available: %s' % codec)
+        self.codec = available[codec]
+        self.threshold = threshold
+        self.level = codecs[self.codec].level if level is None else level
+        self.stats = stats or compressionStats
+
+    def frame(self, data):
+        "Return the frame id and payload for marshaled data"
+        if len(data) < self.threshold:
+            self.stats.frameWritten(len(data), len(data))
+            return CODEC_NONE, data
+        start = time.time()
+        compressed = codecs[self.codec].compress(data, self.level)
+        seconds = time.time() - start
+        if len(compressed) >= len(data):
+            self.stats.frameWritten(len(data), len(data), seconds)
+            return CODEC_NONE, data
+        self.stats.frameWritten(len(data), len(compressed), seconds)
+        return self.codec, compressed
+
+def decompressed(codec, data, stats=None):
+    "Decompress a frame payload, in chunks"
+    stats = stats or compressionStats
+    if codec not in codecs:
+        raise ValueError('unknown or unavailable frame codec: %d' % codec)
+    decompressor = codecs[codec].decompressor()
+    seconds = 0.0
+    for offset in xrange(0, len(data), decompressChunk):
+        start = time.time()
+        chunk = decompressor.decompress(data[offset:offset+decompressChunk])
+        seconds += time.time() - start
+        if chunk:
+            yield chunk
+    if hasattr(decompressor, 'flush'):
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+    stats.decompressTime.record(seconds)
+
+"""
+A Session lets a stream of objects refer to strings sent in earlier frames,
+like the keys of dicts and names of methods, instead of sending them again. The
+writer and the reader each have one, and keep the same table of up to size
+atoms, which are strings of at most maxLength bytes. Atoms have the ids 1 to
+size, and the elements of a frame are numbered from size + 1 on, except for the
+root which is 0. Atoms aren't written, the reader starts out knowing them.
+
+Both sides update their tables from the elements of each frame, and nothing
+else, so they stay the same. First the atoms the frame referred to become the
+most recently used, in the order of their ids. Then the new strings are added
+in the order their elements were written, each taking the id of the least
+recently used atom when the table is full. Frames which use a session have
+FRAME_SESSION set in their id, so a reader without one can't mistake them for
+plain frames.
+"""
+
+class Session(object):
+    "The atoms a writer and reader of a stream of objects share"
+    def __init__(self, size=1024, maxLength=128):
+        self.size = size
+        self.maxLength = maxLength
+        self.ids = {} # atom -> id
+        self.atoms = {} # id -> atom
+        self.used = OrderedDict() # ids, least recently used first
+
+    def dump(self, root, columnar=False):
+        "The elements of root, referring to atoms where it can"
+        objects = dict(self.ids)
+        try:
+            objects.pop(root, None) # the root must be element 0
+        except TypeError:
+            pass
+        elements = list(dump(root, objects, None, chain([0], count(self.size + 1)), columnar, self.atoms))
+        self.update(elements)
+        return elements
+
+    def load(self, elements):
+        "The object in elements written by the other side's Session.dump"
+        elements = list(elements)
+        obj = load(elements, self.atoms)
+        self.update(elements)
+        return obj
+
+    def update(self, elements):
+        referenced = set()
+        new = []
+        for id, type, data in elements:
+            if type == TYPE_TUPLE:
+                referenced.update(data)
+            elif type == TYPE_BYTES and len(data) <= self.maxLength and data not in self.ids:
+                new.append(data)
+        used = self.used
+        for id in sorted(referenced.intersection(self.atoms)):
+            del used[id]
+            used[id] = None
+        for atom in new:
+            if len(self.atoms) < self.size:
+                id = len(self.atoms) + 1
+            else:
+                id = used.popitem(last=False)[0]
+                del self.ids[self.atoms[id]]
+            self.ids[atom] = id
+            self.atoms[id] = atom
+            used[id] = None
+
+def loadFrame(frameId, data, stats=None, session=None):
+    "Load the object in the payload of a frame"
+    codec = frameId & ~FRAME_SESSION
+    if codec == CODEC_NONE:
+        elements = unmarshalBlock(data)
+    else:
+        elements = unmarshal(decompressed(codec, data, stats))
+    if not frameId & FRAME_SESSION:
+        return load(elements)
+    if session is None:
+        raise ValueError('frame refers to a session, but there is none')
+    return session.load(elements)
+
+def dumpstream(stream, columnar=False, compression=None, session=None, cache=None):
+    if session is not None and cache is not None:
+        raise ValueError("a session can't be used with an encoding cache")
     for i in stream:
-        data = ''.join(marshal(dump(i)))
-        for j in marshal([(0, TYPE_BYTES, data)]):
+        if session is None:
+            data = ''.join(marshal(dump(i, columnar=columnar, cache=cache)))
+        else:
+            data = ''.join(marshal(session.dump(i, columnar)))
+        frameId = CODEC_NONE
+        if compression is not None:
+            frameId, data = compression.frame(data)
+        if session is not None:
+            frameId |= FRAME_SESSION
+        for j in marshal([(frameId, TYPE_BYTES, data)]):
             yield j
 
-def loadstream(stream):
+def loadstream(stream, stats=None, session=None):
     for i in unmarshal(stream):
-        assert i.id == 0 and i.type == TYPE_BYTES
-        yield load(unmarshal([i.data]))
+        assert i.type == TYPE_BYTES
+        yield loadFrame(i.id, i.data, stats, session)
 
-def dumps(obj):
-    return ''.join(dumpstream([obj]))
+def dumps(obj, columnar=False, compression=None, session=None, cache=None):
+    return ''.join(dumpstream([obj], columnar, compression, session, cache))
 
 def loads(s):
     obj, = loadstream([s])
     return obj
 
+"""
+A file written with dumpstream is a sequence of frames, which are TYPE_BYTES
+elements holding one dumped object each, with the codec as their id. DumpFile
+maps the file and scans the frame headers once to find where each frame
+starts, so any object can be decoded without reading the ones before it.
+Decoding works on a buffer of the mapped frame, so only the object asked for is
+paged in and copied. Typed binary data in uncompressed frames is decoded to
+views of the mapping, which can't be used after the DumpFile is closed.
+
+The offsets can be kept in a sidecar index file, which records how much of the
+file it covers. When the dump has been appended to since, only the new frames
+are scanned. A frame which is cut short at the end of the file, e.g. by a
+writer which is still busy, is left out until it's complete.
+
+The index holds the inode of the dump and a crc32 of the last frame it covers,
+followed by the offsets as 8 byte little endian integers. An index that doesn't
+match, because the dump was replaced or rewritten, or that is cut short, is
+ignored and the dump is scanned again.
+"""
+
+indexMagic = 'NGLFIDX2'
+_indexHeader = struct.Struct('<8sQQI') # magic, end, inode, crc32 of the last frame
+
+def _packOffsets(offsets):
+    if offsets.itemsize != 8:
+        return struct.pack('<%dQ' % len(offsets), *offsets)
+    offsets = array(offsets.typecode, offsets)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return offsets.tostring()
+
+def _unpackOffsets(data):
+    offsets = array('L')
+    if offsets.itemsize != 8:
+        offsets.extend(struct.unpack('<%dQ' % (len(data) // 8), data))
+        return offsets
+    offsets.fromstring(data)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return offsets
+
+class DumpFile(object):
+    "Random access to the objects in a file written with dumpstream"
+    def __init__(self, path, indexPath=None):
+        self.path = path
+        self.indexPath = indexPath
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size else ''
+        self.offsets = array('L')
+        self.end = 0 # where the next frame would start
+        self.scanned = 0 # frames found by scanning rather than from the index
+
+        if indexPath is not None and os.path.exists(indexPath):
+            self._loadIndex(indexPath)
+        self._scan()
+        if indexPath is not None and self.scanned:
+            self.saveIndex(indexPath)
+
+    def _frame(self, offset):
+        "Return (payload offset, length, codec) for the frame at offset, or None if it isn't complete"
+        data = self.map
+        if offset >= len(data):
+            return None
+        id_size, length_size, type = unpackHeader1(ord(data[offset]))
+        headerSize = 1 + ((id_size+length_size)>>3)
+        if offset + headerSize > len(data):
+            return None
+        id, length = unpackHeader2(data, id_size, length_size, offset + 1)
+        if id > (CODEC_ZSTD | FRAME_SESSION) or type != TYPE_BYTES:
+            raise ValueError('not a dumpstream frame at offset %d' % offset)
+        if offset + headerSize + length > len(data):
+            return None
+        return offset + headerSize, length, id
+
+    def _scan(self):
+        offset = self.end
+        while True:
+            frame = self._frame(offset)
+            if frame is None:
+                break
+            self.offsets.append(offset)
+            self.scanned += 1
+            offset = frame[0] + frame[1]
+        self.end = offset
+
+    def _lastFrameCrc(self, offsets, end):
+        "The crc32 of the last frame in offsets, or None if it doesn't end at end"
+        if not offsets:
+            return 0 if end == 0 else None
+        try:
+            frame = self._frame(offsets[-1])
+        except (ValueError, IndexError):
+            return None
+        if frame is None or frame[0] + frame[1] != end:
+            return None
+        return zlib.crc32(buffer(self.map, offsets[-1], end - offsets[-1])) & 0xffffffff
+
+    def _loadIndex(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < _indexHeader.size or (len(data) - _indexHeader.size) % 8:
+            return # cut short
+        magic, end, inode, crc = _indexHeader.unpack_from(data)
+        if magic != indexMagic or end > len(self.map) or inode != os.fstat(self.file.fileno()).st_ino:
+            return # not ours, or the dump has been replaced
+        offsets = _unpackOffsets(data[_indexHeader.size:])
+        if self._lastFrameCrc(offsets, end) != crc:
+            return # the dump has been rewritten
+        self.offsets, self.end = offsets, end
+
+    def saveIndex(self, path=None):
+        "Write the frame offsets to path, by default the indexPath given when opening"
+        path = path or self.indexPath
+        inode = os.fstat(self.file.fileno()).st_ino
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_indexHeader.pack(indexMagic, self.end, inode, self._lastFrameCrc(self.offsets, self.end)))
+            f.write(_packOffsets(self.offsets))
+        os.rename(path + '.tmp', path)
+
+    def raw(self, i):
+        "The payload of frame i as a buffer of the mapping, and its codec"
+        offset, length, codec = self._frame(self.offsets[i])
+        return buffer(self.map, offset, length), codec
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        data, codec = self.raw(i)
+        return loadFrame(codec, data)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 if __name__ == '__main__':
-    import sys
     filename = sys.argv[1]
-    for i in loadstream(open(filename).read()):
-        print '--', [i]
+    with DumpFile(filename) as dump:
+        for i in dump:
+            print '--', [i]
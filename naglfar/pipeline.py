@@ -0,0 +1,146 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"Worker pools and multi-stage pipelines connecting coroutines with bounded Channels"
+
+import time
+import traceback
+
+from core import go, Channel
+
+"""
+A stage is a fixed number of coroutines reading batches from an input Channel
+with readWaiting, and writing results to an output Channel. Channels between
+stages are bounded, so a slow stage blocks the writers in front of it instead
+of letting its queue grow, all the way back to whoever feeds the pipeline.
+Closing the input ends the pipeline: each stage drains what is queued, and the
+last coroutine of a stage to finish closes its output.
+
+    pipeline = Pipeline().stage(parse, n=4).stage(store, n=2, batch=True)
+    for line in log:
+        pipeline.write(line)
+    pipeline.close()
+    pipeline.join()
+
+Results which are None are dropped, so a stage can filter, or be a sink which
+nobody has to read from.
+"""
+
+class Stage(object):
+    """n coroutines calling func for each message from input, or with a list of
+    up to batchSize messages if batch is set, in which case func returns a list
+    of results"""
+    def __init__(self, n, func, input, output=None, batch=False, batchSize=64, name=None):
+        self.func = func
+        self.input = input
+        self.output = output
+        self.batch = batch
+        self.batchSize = batchSize
+        self.name = name or getattr(func, '__name__', 'stage')
+        self.workers = n
+        self.running = n
+        self.finished = Channel()
+
+        self.started = time.time()
+        self.processed = self.batches = self.errors = 0
+        self.busy = 0.0 # seconds spent in func
+
+        for i in xrange(n):
+            go(self._worker)
+
+    def _worker(self):
+        try:
+            for items in self.input.iterateWaiting(self.batchSize):
+                start = time.time()
+                if self.batch:
+                    results = self._call(items) or ()
+                else:
+                    results = [self._call(i) for i in items]
+                self.busy += time.time() - start
+                self.processed += len(items)
+                self.batches += 1
+
+                if self.output is not None:
+                    for result in results:
+                        if result is not None:
+                            self.output.write(result) # blocks while the next stage is behind
+        finally:
+            self.running -= 1
+            if not self.running:
+                if self.output is not None:
+                    self.output.close()
+                self.finished.close()
+
+    def _call(self, arg):
+        "Call func, counting and printing errors instead of stopping the worker"
+        try:
+            return self.func(arg)
+        except Exception:
+            traceback.print_exc()
+            self.errors += 1
+
+    def join(self):
+        "Wait until the input is closed and everything in it has been processed"
+        self.finished.wait()
+
+    def stats(self):
+        "Throughput and queue depth of this stage"
+        elapsed = time.time() - self.started
+        return dict(name=self.name, workers=self.workers, running=self.running,
+            processed=self.processed, batches=self.batches, errors=self.errors,
+            queued=len(self.input.q), blockedWriters=len(self.input.writers),
+            rate=self.processed / elapsed if elapsed else 0.0,
+            utilization=self.busy / (elapsed * self.workers) if elapsed else 0.0)
+
+def goPool(n, func, input, output=None, batchSize=64):
+    "Start n coroutines calling func for each message from input, writing the results to output"
+    return Stage(n, func, input, output, batchSize=batchSize)
+
+class Pipeline(object):
+    "Stages connected by Channels holding up to maxsize messages"
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.input = self.output = Channel(maxsize)
+        self.stages = []
+
+    def stage(self, func, n=1, batch=False, batchSize=64, maxsize=None, name=None):
+        "Add a stage reading the output of the previous one, returning the pipeline"
+        output = Channel(maxsize or self.maxsize)
+        self.stages.append(Stage(n, func, self.output, output, batch, batchSize, name))
+        self.output = output
+        return self
+
+    def write(self, msg):
+        "Feed the first stage, blocking while it's behind"
+        self.input.write(msg)
+
+    def close(self):
+        self.input.close()
+
+    def join(self):
+        "Wait for every stage to finish after close"
+        for stage in self.stages:
+            stage.join()
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def __iter__(self):
+        return iter(self.output)
@@ -0,0 +1,214 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"A sampling profiler attributing time to the coroutine running, named by where it was started with go()"
+
+import os
+import sys
+import time
+import signal
+import thread
+import threading
+import weakref
+from functools import partial
+
+import greenlet
+import core
+
+"""
+cProfile and most stack samplers see a greenlet switch as a return into
+whatever frame is resumed, so the time ends up under scheduler or _ioCore. Here
+a thread samples the stack of the main thread every interval seconds. The stack
+of a coroutine ends in the runner frame made by go(), which knows the callable
+it was started with, so each sample is filed under the go() origin of the
+coroutine which was running. Samples taken while we're blocked in poll show up
+as idle time in _ioCore under the scheduler.
+
+Every sample counts as interval seconds of wall time, and gets the CPU time the
+process used since the previous sample. collapsed() gives the stacks in the
+format flamegraph.pl and speedscope read.
+
+greenlet.settrace is used to count switches and measure how long each origin
+runs between them, which is exact rather than sampled. It's one call per switch,
+and the sampler walks one stack per interval, so it can be left running on a
+loaded server. start/stop can be called at any time, or wired to a signal with
+toggleOnSignal.
+"""
+
+_runnerCode = [c for c in core.go.func_code.co_consts if getattr(c, 'co_name', None) == 'runner'][0]
+
+def describe(callable):
+    "A readable name for callable"
+    while isinstance(callable, partial):
+        callable = callable.func
+    name = getattr(callable, '__name__', None) or type(callable).__name__
+    owner = getattr(callable, 'im_class', None)
+    if owner is not None:
+        name = '%s.%s' % (owner.__name__, name)
+    module = getattr(callable, '__module__', None)
+    return '%s.%s' % (module, name) if module else name
+
+def frameName(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+def origin(frame):
+    "Name the coroutine frame belongs to, by the callable given to go()"
+    while frame.f_back is not None:
+        frame = frame.f_back
+    if frame.f_code is _runnerCode:
+        return 'go:' + describe(frame.f_locals['callable'])
+    return frameName(frame)
+
+def _cpu():
+    user, system = os.times()[:2]
+    return user + system
+
+class Profiler(object):
+    "Samples the main thread every interval seconds while started"
+    def __init__(self, interval=0.01, maxDepth=64):
+        self.interval = interval
+        self.maxDepth = maxDepth
+        self.stacks = {} # collapsed stack -> [samples, cpu seconds]
+        self.coroutines = {} # origin -> [switches, seconds running]
+        self.origins = weakref.WeakKeyDictionary() # greenlet -> origin
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.threadId = thread.get_ident()
+        self.since = time.time()
+        self.previousTrace = greenlet.settrace(self._trace)
+        self.thread = threading.Thread(target=self._sampler, name='naglfar profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        greenlet.settrace(self.previousTrace)
+        self.thread.join()
+
+    def _origin(self, g):
+        name = self.origins.get(g)
+        if name is None:
+            if g.parent is None:
+                name = 'main'
+            elif g.gr_frame is None:
+                return 'unknown'
+            else:
+                name = self.origins[g] = origin(g.gr_frame)
+        return name
+
+    def _trace(self, event, args):
+        if event == 'switch' or event == 'throw':
+            now = time.time()
+            name = self._origin(args[0]) # the greenlet switching out is suspended
+            stats = self.coroutines.get(name)
+            if stats is None:
+                stats = self.coroutines[name] = [0, 0.0]
+            stats[0] += 1
+            stats[1] += now - self.since
+            self.since = now
+        if self.previousTrace is not None:
+            self.previousTrace(event, args)
+
+    def _sampler(self):
+        last = _cpu()
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.threadId)
+            now = _cpu()
+            cpu, last = now - last, now
+            if frame is None:
+                continue
+            # only the innermost maxDepth frames are named, but the walk goes
+            # on to the bottom of the stack to find the origin
+            names = []
+            while frame.f_back is not None and len(names) < self.maxDepth:
+                names.append(frameName(frame))
+                frame = frame.f_back
+            if frame.f_back is not None:
+                names.append('...')
+            names.append(origin(frame))
+            key = ';'.join(reversed(names))
+            stats = self.stacks.get(key)
+            if stats is None:
+                stats = self.stacks[key] = [0, 0.0]
+            stats[0] += 1
+            stats[1] += cpu
+
+    def collapsed(self, cpu=False):
+        "Lines of 'stack count' for flame graphs, weighted by wall time samples or CPU milliseconds"
+        lines = []
+        for key, (samples, seconds) in sorted(self.stacks.items()):
+            weight = int(round(seconds * 1000)) if cpu else samples
+            if weight:
+                lines.append('%s %d' % (key, weight))
+        return lines
+
+    def write(self, path, cpu=False):
+        with open(path, 'w') as f:
+            for line in self.collapsed(cpu):
+                f.write(line + '\n')
+
+    def summary(self):
+        "(origin, switches, seconds running, wall seconds sampled, cpu seconds sampled), busiest first"
+        sampled = {}
+        for key, (samples, seconds) in self.stacks.items():
+            name = key.split(';', 1)[0]
+            wall, cpu = sampled.get(name, (0.0, 0.0))
+            sampled[name] = wall + samples * self.interval, cpu + seconds
+        names = set(self.coroutines) | set(sampled)
+        rows = [(name,) + tuple(self.coroutines.get(name, (0, 0.0))) + sampled.get(name, (0.0, 0.0))
+            for name in names]
+        return sorted(rows, key=lambda row:row[2], reverse=True)
+
+profiler = None
+
+def start(interval=0.01):
+    "Start profiling the process, returning the Profiler"
+    global profiler
+    if profiler is None:
+        profiler = Profiler(interval)
+    profiler.start()
+    return profiler
+
+def stop():
+    "Stop profiling, returning the Profiler with what was collected"
+    global profiler
+    p, profiler = profiler, None
+    if p is not None:
+        p.stop()
+    return p
+
+def toggleOnSignal(signum=signal.SIGUSR2, path='/tmp/naglfar-%d.collapsed', interval=0.01):
+    """Start profiling on signum, and stop and write the collapsed stacks to
+    path % pid the next time it's received"""
+    def handler(signum, frame):
+        if profiler is None:
+            start(interval)
+        else:
+            stop().write(path % os.getpid() if '%d' in path else path)
+    signal.signal(signum, handler)
@@ -0,0 +1,308 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"Multiplexed RPC over ObjectFile, with many calls in flight on one connection"
+
+import time
+import SocketServer
+from itertools import count
+
+from greenlet import getcurrent
+from core import go, Channel, Timeout, ScheduledMixIn
+from sync import WaitGroup
+from naglfar import ObjectFile
+
+"""
+Every request carries an id, and the response carries it back. A Client has one
+coroutine reading responses and handing each of them to the Channel of the call
+waiting for it, so any number of coroutines can have calls in flight on one
+connection and responses can come in any order. The messages are tuples:
+
+(REQUEST, id, method, args, kwargs, timeout)
+(RESULT, id, value)
+(ERROR, id, (exception name, message))
+(CANCEL, id)
+
+The server reads requests in batches and runs each one in a coroutine of its
+own, so a slow call doesn't hold up the ones behind it. A call which has been
+cancelled, or whose timeout has passed by the time it would start, isn't run.
+Calls which are already running can't be interrupted, since coroutines only
+give up control when they block, but they can check cancelled() and their
+result is thrown away.
+"""
+
+REQUEST, RESULT, ERROR, CANCEL = range(4)
+
+class RemoteError(Exception):
+    "The call raised an exception on the server"
+    def __init__(self, name, message):
+        Exception.__init__(self, name, message)
+        self.name = name
+        self.message = message
+
+class Cancelled(Exception):
+    "The call was cancelled"
+
+class ConnectionLost(EOFError):
+    "The connection closed before the call was answered"
+
+class Call(object):
+    "A call in flight, see Client.start"
+    def __init__(self, client, id, deadline):
+        self.client = client
+        self.id = id
+        self.deadline = deadline
+        self.channel = Channel()
+        self.response = None # (RESULT or ERROR, value) once it has come
+        self.cancelled = False
+
+    def result(self, timeout=None):
+        """Wait for the result, raising Timeout once timeout seconds or the
+        deadline of the call have passed, in which case the call is cancelled"""
+        if self.response is None:
+            if self.cancelled:
+                raise Cancelled()
+            deadline = self.deadline
+            if timeout is not None:
+                deadline = min(deadline or 1e300, time.time() + timeout)
+            try:
+                self.response = self.channel.read(None if deadline is None else max(0, deadline - time.time()))
+            except Timeout:
+                self.cancel()
+                raise
+            except EOFError:
+                raise Cancelled() if self.cancelled else ConnectionLost('connection lost')
+        kind, value = self.response
+        if kind == ERROR:
+            raise RemoteError(*value)
+        return value
+
+    def cancel(self):
+        "Stop waiting for the call, and tell the server it can skip it"
+        if self.response is None and not self.cancelled:
+            self.cancelled = True
+            self.channel.close()
+            if self.client.pending.pop(self.id, None) is not None:
+                self.client._send((CANCEL, self.id))
+
+class Client(object):
+    "Calls on a server over one connection, which all coroutines can share"
+    def __init__(self, f):
+        self.f = f
+        self.ids = count(1)
+        self.pending = {} # id -> Call
+        self.closed = False
+        self.ncalls = 0
+        go(self._receive)
+
+    @classmethod
+    def connect(cls, address, timeout=None):
+        return cls(ObjectFile.connectTcp(address, timeout))
+
+    def _receive(self):
+        try:
+            for response in self.f.readObjectStream():
+                if not _validResponse(response):
+                    break # a server we can't understand, so fail every call
+                call = self.pending.pop(response[1], None)
+                if call is not None: # otherwise it was cancelled or timed out
+                    call.channel.write((response[0], response[2]))
+        finally:
+            self.close()
+
+    def _send(self, message):
+        if self.closed:
+            return False
+        try:
+            self.f.writeObject(message)
+        except ValueError:
+            if not (self.f.closed or self.f.outgoing is None):
+                raise # not closed, but something which can't be encoded
+            self.close()
+            return False
+        return True
+
+    def start(self, method, args=(), kwargs=None, timeout=None):
+        "Send a call without waiting for it, returning a Call"
+        id = self.ids.next()
+        call = Call(self, id, None if timeout is None else time.time() + timeout)
+        self.pending[id] = call
+        self.ncalls += 1
+        try:
+            sent = self._send((REQUEST, id, method, tuple(args), kwargs or {}, timeout))
+        except:
+            del self.pending[id] # e.g. arguments which can't be encoded
+            raise
+        if not sent:
+            call.channel.close()
+        return call
+
+    def call(self, method, *args, **kwargs):
+        "Call method with args and kwargs on the server, timeout is taken out of kwargs"
+        timeout = kwargs.pop('timeout', None)
+        return self.start(method, args, kwargs, timeout).result()
+
+    def close(self):
+        "Close the connection, calls in flight get ConnectionLost"
+        if self.closed:
+            return
+        self.closed = True
+        if not self.f.closed:
+            self.f.close()
+        pending, self.pending = self.pending, {}
+        for call in pending.values():
+            call.channel.close()
+
+class ClientPool(object):
+    "One shared Client per server address, reconnecting once it has closed"
+    def __init__(self, timeout=None):
+        self.timeout = timeout # for connecting
+        self.clients = {} # address -> Client
+        self.nconnect = 0
+
+    def get(self, address):
+        client = self.clients.get(address)
+        if client is None or client.closed:
+            client = Client.connect(address, self.timeout)
+            self.nconnect += 1
+            other = self.clients.get(address)
+            if other is not None and not other.closed: # connected at the same time
+                client.close()
+                return other
+            self.clients[address] = client
+        return client
+
+    def call(self, address, method, *args, **kwargs):
+        return self.get(address).call(method, *args, **kwargs)
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+
+_running = {} # handling coroutine -> its _Request
+
+class _Request(object):
+    def __init__(self, id, deadline):
+        self.id = id
+        self.deadline = deadline
+        self.cancelled = False
+
+def cancelled():
+    "Whether the call the current coroutine is handling has been cancelled or timed out"
+    request = _running.get(getcurrent())
+    if request is None:
+        return False
+    return request.cancelled or request.deadline is not None and time.time() > request.deadline
+
+def _lookup(methods, name):
+    if isinstance(methods, dict):
+        return methods.get(name)
+    if not isinstance(name, str) or name.startswith('_'):
+        return None
+    return getattr(methods, name, None)
+
+def _isId(id):
+    return type(id) in (int, long)
+
+def _validRequest(message):
+    return type(message) == tuple and len(message) == 6 and message[0] == REQUEST and _isId(message[1]) \
+        and isinstance(message[3], (tuple, list)) and type(message[4]) == dict \
+        and (message[5] is None or type(message[5]) in (int, long, float))
+
+def _validResponse(message):
+    return type(message) == tuple and len(message) == 3 and message[0] in (RESULT, ERROR) and _isId(message[1]) \
+        and (message[0] == RESULT or type(message[2]) == tuple and len(message[2]) == 2)
+
+def _validCancel(message):
+    return type(message) == tuple and len(message) == 2 and message[0] == CANCEL and _isId(message[1])
+
+def serveConnection(f, methods):
+    """Answer calls read from the ObjectFile f with the callables in the dict
+    methods, or the public methods of an object, until the connection closes.
+    A message which isn't a request or a cancel closes the connection"""
+    f.autoflush = True
+    requests = {} # id -> _Request, while queued or running
+    running = WaitGroup()
+
+    def respond(response):
+        if f.closed or f.outgoing is None:
+            return
+        try:
+            f.writeObject(response)
+        except Exception, e:
+            if f.closed or f.outgoing is None:
+                return # closed while we were busy
+            # the result couldn't be encoded, and nothing has been written
+            f.writeObject((ERROR, response[1], (type(e).__name__, str(e))))
+
+    def dispatch(request, method, args, kwargs):
+        try:
+            if request.cancelled or request.deadline is not None and time.time() > request.deadline:
+                return
+            _running[getcurrent()] = request
+            try:
+                func = _lookup(methods, method)
+                if func is None:
+                    response = ERROR, request.id, ('NoSuchMethod', repr(method))
+                else:
+                    response = RESULT, request.id, func(*args, **kwargs)
+            except Exception, e:
+                response = ERROR, request.id, (type(e).__name__, str(e))
+            finally:
+                del _running[getcurrent()]
+            if not request.cancelled:
+                respond(response)
+        finally:
+            if requests.get(request.id) is request:
+                del requests[request.id]
+            running.done()
+
+    for message in f.readObjectStream():
+        if _validRequest(message):
+            kind, id, method, args, kwargs, timeout = message
+            request = requests[id] = _Request(id, None if timeout is None else time.time() + timeout)
+            running.add()
+            go(dispatch, request, method, args, kwargs)
+        elif _validCancel(message):
+            request = requests.pop(message[1], None)
+            if request is not None:
+                request.cancelled = True
+        else:
+            break
+
+    # the client may only have shut down its side, so answer what's in flight
+    running.wait()
+    if not f.closed and f.outgoing is not None:
+        f.flush()
+
+class RPCServer(ScheduledMixIn, SocketServer.TCPServer):
+    "Serve the callables in the dict methods, or the public methods of an object"
+    allow_reuse_address = True
+
+    def __init__(self, server_address, methods, bind_and_activate=True):
+        self.methods = methods
+        SocketServer.TCPServer.__init__(self, server_address, None, bind_and_activate)
+
+    def makeFile(self, fd):
+        return ObjectFile(fd)
+
+    def finish_request(self, request, client_address):
+        serveConnection(request, self.methods)
@@ -0,0 +1,131 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"Latency histograms and traffic counters for servers"
+
+import time
+from math import frexp
+
+"""
+Histogram works like HdrHistogram: values are counted in buckets which are
+exact for small values, and above that each power of two is split in
+subBuckets linear buckets. With the default of 32 every value is kept to within
+about 3%, from a microsecond to hours, in a list of less than a thousand
+counts. Recording a value is a frexp and a list increment, so it can be left
+on in production.
+"""
+
+class Histogram(object):
+    "Log-linear histogram of durations in seconds, with microsecond resolution"
+    def __init__(self, subBuckets=32):
+        assert subBuckets & (subBuckets - 1) == 0, 'subBuckets must be a power of two'
+        self.subBuckets = subBuckets
+        self.shift = subBuckets.bit_length() - 1
+        self.reset()
+
+    def reset(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        if value < self.subBuckets:
+            index = max(0, value)
+        else:
+            mantissa, exponent = frexp(value)
+            index = (exponent - 1 - self.shift) * self.subBuckets + int(mantissa * 2 * self.subBuckets)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def _upper(self, index):
+        "The largest value counted in bucket index, in microseconds"
+        if index < self.subBuckets:
+            return index
+        width = 1 << (index // self.subBuckets - 1)
+        return (self.subBuckets + index % self.subBuckets) * width + width - 1
+
+    def percentile(self, p):
+        "The value p percent of the recorded values are below, in seconds"
+        if not self.count:
+            return 0.0
+        target = max(1, self.count * p / 100.0)
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self._upper(index) / 1e6, self.max)
+        return self.max
+
+    def merge(self, other):
+        "Add the values recorded by other, which must have the same subBuckets"
+        assert other.subBuckets == self.subBuckets
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, n in enumerate(other.counts):
+            self.counts[index] += n
+        self.count += other.count
+        self.total += other.total
+        for value in other.min, other.max:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        return dict(count=self.count, mean=self.total / self.count if self.count else 0.0,
+            min=self.min or 0.0, max=self.max or 0.0, p50=self.percentile(50),
+            p90=self.percentile(90), p99=self.percentile(99), p999=self.percentile(99.9))
+
+class ServerStats(object):
+    "What a server has done since it started"
+    def __init__(self):
+        self.started = time.time()
+        self.queueTime = Histogram() # from accept until the connection's coroutine runs
+        self.connectionTime = Histogram()
+        self.requestTime = Histogram() # from a request being read until its response is written
+        self.connections = self.requests = 0
+        self.bytesIn = self.bytesOut = 0
+        self.statuses = {}
+
+    def connectionDone(self, seconds, nread, nwrite):
+        self.connections += 1
+        self.connectionTime.record(seconds)
+        self.bytesIn += nread
+        self.bytesOut += nwrite
+
+    def requestDone(self, seconds, status):
+        self.requests += 1
+        self.requestTime.record(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def snapshot(self):
+        return dict(uptime=time.time() - self.started, completedConnections=self.connections,
+            requests=self.requests, bytesIn=self.bytesIn, bytesOut=self.bytesOut,
+            statuses=dict(self.statuses), queueTime=self.queueTime.snapshot(),
+            connectionTime=self.connectionTime.snapshot(), requestTime=self.requestTime.snapshot())
@@ -0,0 +1,273 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"Coordination primitives for coroutines: Lock, Semaphore, Event, Condition and WaitGroup"
+
+import sys
+import time
+import weakref
+import traceback
+from collections import deque
+from functools import partial
+
+from greenlet import getcurrent
+from core import scheduler, queue, goAfter, goCancel
+
+"""
+Waiting coroutines are parked directly on a deque of waiters, instead of each
+waiting on a Channel of its own. A waiter is woken at most once, either by the
+primitive or by its timeout timer, and value tells which one it was. Lock and
+Semaphore hand themselves over to the first waiter on release, so a coroutine
+releasing and re-acquiring in a loop can't starve the ones already waiting.
+
+Methods taking a timeout return False if it expired, like the threading module.
+report() prints every held Lock and Semaphore with the stacks of the holders,
+which is useful to find out who is sitting on what when the server stalls.
+"""
+
+primitives = weakref.WeakSet() # held primitives are found here by report
+
+class _Waiter(object):
+    __slots__ = ('greenlet', 'value')
+    def __init__(self):
+        self.greenlet = getcurrent()
+        self.value = None
+
+def _wait(waiters, timeout=None):
+    "Park the current coroutine on waiters, returning True if woken by _wake and False on timeout"
+    waiter = _Waiter()
+    waiters.append(waiter)
+    if timeout is None:
+        scheduler.switch()
+        return waiter.value
+
+    timer = goAfter(max(0, timeout), partial(_wake, waiter, False))
+    scheduler.switch()
+    goCancel(timer)
+    if waiter.value is False and waiter in waiters:
+        waiters.remove(waiter)
+    return waiter.value
+
+def _wake(waiter, value=True):
+    "Schedule waiter to run, returning False if it was already woken"
+    if waiter.value is not None:
+        return False
+    waiter.value = value
+    queue.append(waiter.greenlet.switch)
+    return True
+
+def _wakeFirst(waiters):
+    "Wake the first waiter which hasn't timed out, returning its greenlet or None"
+    while waiters:
+        waiter = waiters.popleft()
+        if _wake(waiter):
+            return waiter.greenlet
+    return None
+
+class Lock(object):
+    "A mutual exclusion lock owned by the coroutine which acquired it"
+    def __init__(self):
+        self.owner = None
+        self.waiters = deque()
+        primitives.add(self)
+
+    def acquire(self, timeout=None):
+        "Acquire the lock, returning False if timeout seconds passed first"
+        current = getcurrent()
+        if self.owner is None:
+            self.owner = current
+            return True
+        if self.owner is current:
+            raise RuntimeError('deadlock, the lock is already held by this coroutine')
+        return _wait(self.waiters, timeout) # release made us the owner
+
+    def release(self):
+        if self.owner is not getcurrent():
+            raise RuntimeError('release of a lock not held by this coroutine')
+        self.owner = _wakeFirst(self.waiters)
+
+    def locked(self):
+        return self.owner is not None
+
+    @property
+    def holders(self):
+        return [self.owner] if self.owner is not None else []
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __repr__(self):
+        return '<%s held by %r, %d waiting>' % (type(self).__name__, self.owner, len(self.waiters))
+
+class Semaphore(object):
+    "Allow at most value coroutines at a time, releasing more than was acquired is an error"
+    def __init__(self, value=1):
+        if value < 0:
+            raise ValueError('semaphore initial value must be >= 0')
+        self.value = value # available slots
+        self.holders = []
+        self.waiters = deque()
+        primitives.add(self)
+
+    def acquire(self, timeout=None):
+        "Take a slot, returning False if timeout seconds passed first"
+        if self.value > 0:
+            self.value -= 1
+        elif not _wait(self.waiters, timeout):
+            return False
+        # released slots are handed over without touching value
+        self.holders.append(getcurrent())
+        return True
+
+    def release(self):
+        "Give back a slot, which may be acquired by another coroutine"
+        if not self.holders:
+            raise ValueError('semaphore released too many times')
+        current = getcurrent()
+        if current in self.holders:
+            self.holders.remove(current)
+        else:
+            del self.holders[0]
+        if _wakeFirst(self.waiters) is None:
+            self.value += 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __repr__(self):
+        return '<%s held by %r, %d free, %d waiting>' % (
+            type(self).__name__, self.holders, self.value, len(self.waiters))
+
+class Event(object):
+    "A flag coroutines can wait for"
+    def __init__(self):
+        self.flag = False
+        self.waiters = deque()
+
+    def isSet(self):
+        return self.flag
+
+    def set(self):
+        "Set the flag and wake everyone waiting for it"
+        self.flag = True
+        while self.waiters:
+            _wake(self.waiters.popleft())
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, timeout=None):
+        "Wait until the flag is set, returning False if timeout seconds passed first"
+        if self.flag:
+            return True
+        return _wait(self.waiters, timeout)
+
+class Condition(object):
+    "Wait for a notification while holding lock, a Lock of its own if not given"
+    def __init__(self, lock=None):
+        self.lock = lock or Lock()
+        self.waiters = deque()
+        self.acquire = self.lock.acquire
+        self.release = self.lock.release
+
+    def wait(self, timeout=None):
+        """Release the lock until notified, then acquire it again. Returns False
+        if timeout seconds passed without a notification."""
+        self.release()
+        try:
+            return _wait(self.waiters, timeout)
+        finally:
+            self.acquire()
+
+    def waitFor(self, predicate, timeout=None):
+        "Wait until predicate() is true, returning its last value"
+        if timeout is not None:
+            deadline = time.time() + timeout
+        result = predicate()
+        while not result:
+            if timeout is None:
+                self.wait()
+            elif not self.wait(deadline - time.time()):
+                return predicate()
+            result = predicate()
+        return result
+
+    def notify(self, n=1):
+        "Wake up to n waiting coroutines"
+        for i in xrange(n):
+            if _wakeFirst(self.waiters) is None:
+                break
+
+    def notifyAll(self):
+        self.notify(len(self.waiters))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class WaitGroup(object):
+    "Wait for a number of tasks to be done"
+    def __init__(self, count=0):
+        self.count = count
+        self.waiters = deque()
+
+    def add(self, n=1):
+        "Add n tasks, or mark -n tasks done if negative"
+        if self.count + n < 0:
+            raise ValueError('negative WaitGroup counter')
+        self.count += n
+        if not self.count:
+            while self.waiters:
+                _wake(self.waiters.popleft())
+
+    def done(self):
+        self.add(-1)
+
+    def wait(self, timeout=None):
+        "Wait until all tasks are done, returning False if timeout seconds passed first"
+        if not self.count:
+            return True
+        return _wait(self.waiters, timeout)
+
+def report(out=None):
+    "Print every held Lock and Semaphore, and where their holders are"
+    out = out or sys.stderr
+    for primitive in list(primitives):
+        if not primitive.holders:
+            continue
+        print >> out, repr(primitive)
+        for holder in primitive.holders:
+            if holder.gr_frame is not None:
+                out.write(''.join('    ' + line for line in traceback.format_stack(holder.gr_frame)))
+            elif holder.dead:
+                print >> out, '    (finished without releasing)'
+            else:
+                print >> out, '    (the current coroutine)'
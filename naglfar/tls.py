@@ -0,0 +1,193 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"TLS for ScheduledFile"
+
+import os
+import ssl
+import socket
+
+from core import Channel, ScheduledFile, ScheduledMixIn, goClose, goConnectFirst, socketFamily, _goRead, _goWrite, _goClose
+
+"""
+The ssl module in python 2 has no memory BIO, so the TLS socket itself is made
+non-blocking, and whenever OpenSSL wants to read or write we wait for the fd
+with _goRead/_goWrite and retry. The handshake is done on first use, which
+means a server does it in the connection's coroutine and not in the accept
+callback. A reader and the flusher can both be waiting for the same direction,
+e.g. during the handshake, and the backend keeps one callback per fd and
+direction, so the waiters share a registration which wakes them all.
+
+Servers should share one SSLContext, since that's where OpenSSL keeps the
+session cache. Session tickets are enabled by default, so resumed handshakes
+skip the key exchange. context.session_stats() reports the hits and misses.
+"""
+
+class SSLScheduledFile(ScheduledFile):
+    "A ScheduledFile speaking TLS, using the scheduler to wait for the socket"
+    def __init__(self, sslsock, autoflush=False, bufferSize=2**16):
+        ScheduledFile.__init__(self, sslsock.fileno(), autoflush, bufferSize)
+        self.sslsock = sslsock
+        self.handshakeDone = False
+        self.sslError = None # why the connection was treated as closed
+        self._waiters = {_goRead:[], _goWrite:[]} # Channels of _retry calls waiting for the fd
+
+    @classmethod
+    def wrap(cls, sock, context, server_side=False, server_hostname=None, *args, **vargs):
+        "Make an instance from a connected socket"
+        sock.setblocking(False)
+        sslsock = context.wrap_socket(sock, server_side=server_side,
+            do_handshake_on_connect=False, server_hostname=server_hostname)
+        return cls(sslsock, *args, **vargs)
+
+    @classmethod
+    def fromFd(cls, fd, context, server_side=False, server_hostname=None, *args, **vargs):
+        "Make an instance from a connected fd, which is closed"
+        sock = socket.socket(_sock=socket.fromfd(fd, socketFamily(fd), socket.SOCK_STREAM))
+        goClose(fd)
+        try:
+            return cls.wrap(sock, context, server_side, server_hostname, *args, **vargs)
+        finally:
+            sock.close()
+
+    @classmethod
+    def connectTls(cls, address, context=None, server_hostname=None, timeout=None, resolver=None):
+        "Connect to (host, port) and do the handshake"
+        import dns
+        host, port = address[:2]
+        fd = goConnectFirst((resolver or dns.getResolver()).resolve(host), port, timeout)
+        if server_hostname is None and not dns.addressFamily(host):
+            server_hostname = host
+        f = cls.fromFd(fd, context or ssl.create_default_context(), False, server_hostname, autoflush=True)
+        try:
+            f.handshake()
+        except:
+            f.close(flush=False)
+            raise
+        return f
+
+    def _retry(self, operation, *args):
+        "Call operation until OpenSSL stops asking for IO"
+        while True:
+            try:
+                return operation(*args)
+            except ssl.SSLWantReadError:
+                self._waitFor(_goRead)
+            except ssl.SSLWantWriteError:
+                self._waitFor(_goWrite)
+
+    def _waitFor(self, register):
+        waiters = self._waiters[register]
+        c = Channel()
+        waiters.append(c)
+        if len(waiters) == 1:
+            def ready(bytesReady, eof):
+                for i in waiters:
+                    i.write(eof)
+                del waiters[:]
+            register(self.fd, ready)
+        return c.read()
+
+    def handshake(self):
+        if not self.handshakeDone:
+            self._retry(self.sslsock.do_handshake)
+            self.handshakeDone = True
+
+    def _read(self, n=None):
+        assert self.fd is not None
+        try:
+            self.handshake()
+            chunk = self._retry(self.sslsock.recv, n or self.bufferSize)
+        except (ssl.SSLError, socket.error), e:
+            # a failed handshake or a broken connection looks like eof, so
+            # a bad client can't take down the server
+            self.sslError = e
+            chunk = ''
+        self.nread += len(chunk)
+        return chunk
+
+    def _flusher(self):
+        try:
+            self.handshake()
+        except (ssl.SSLError, socket.error), e:
+            self.sslError = e
+            self.outgoing = None
+        while self.outgoing and self.fd is not None:
+            try:
+                # a TLS record is at most 16k
+                n = self._retry(self.sslsock.send, buffer(self.outgoing, 0, 16384))
+            except (ssl.SSLError, socket.error), e:
+                self.sslError = e
+                n = 0
+            if n == 0:
+                self.outgoing = None
+            else:
+                del self.outgoing[:n]
+                self.nwrite += n
+        for i in self._flushers:
+            i.write(True)
+        self._flushers = None
+
+    def sendfile(self, fd, offset=0, nbytes=0):
+        "The kernel can't encrypt, so the file is read and written through TLS"
+        self.flush()
+        sent = 0
+        while not nbytes or sent < nbytes:
+            os.lseek(fd, offset + sent, os.SEEK_SET)
+            data = os.read(fd, min(self.bufferSize, nbytes - sent) if nbytes else self.bufferSize)
+            if not data:
+                break
+            try:
+                self.write(data)
+            except ValueError: # closed
+                break
+            sent += len(data)
+        self.flush()
+        return sent
+
+    def close(self, flush=True):
+        if self.fd is None:
+            return
+        if flush and self.outgoing:
+            self.flush()
+        if self.handshakeDone and self.outgoing is not None:
+            # send close_notify, but don't wait for the peer to answer
+            try:
+                self.sslsock.unwrap()
+            except (ssl.SSLError, socket.error):
+                pass
+        _goClose(self.fd)
+        self.sslsock.close()
+        self.fd = None
+
+def serverContext(certfile, keyfile=None, tickets=True):
+    "Make a server context suitable for sharing between all connections"
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    if not tickets:
+        context.options |= ssl.OP_NO_TICKET
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+class ScheduledSSLMixIn(ScheduledMixIn):
+    "Mix-in class for TLS servers, sslContext must be set before serving"
+    sslContext = None
+
+    def makeFile(self, fd):
+        return SSLScheduledFile.fromFd(fd, self.sslContext, server_side=True)
@@ -0,0 +1,271 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"WebSocket (RFC 6455) connections on ScheduledFile, upgraded from the native HTTP server"
+
+import os
+import socket
+import struct
+import base64
+import hashlib
+from binascii import hexlify, unhexlify
+
+from core import ScheduledFile, socketFamily
+from http import HTTPError, writeRequest, readResponse
+
+"""
+A WebSocket starts as a HTTP/1.1 GET with an Upgrade header. accept() checks it
+and returns a 101 response for the HTTP server, which then hands the connection
+to handler(websocket) for as long as it is open:
+
+    def handler(request):
+        if request.path == '/events':
+            return websocket.accept(request, subscriber)
+        ...
+
+Frames from clients are masked with a random key, frames from the server are
+not. So a server frame only depends on the message, and broadcast() encodes it
+once and appends the same string to the outgoing buffer of every connection.
+Connections whose buffer grows past maxBuffered are dropped rather than
+holding up the others.
+"""
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION, OP_TEXT, OP_BINARY = 0x0, 0x1, 0x2
+OP_CLOSE, OP_PING, OP_PONG = 0x8, 0x9, 0xa
+
+class WebSocketError(Exception):
+    "A protocol violation, code is the close code to send"
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+def acceptKey(key):
+    "The Sec-WebSocket-Accept value for a Sec-WebSocket-Key"
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+def mask(key, data):
+    "XOR data with the 4 byte masking key, done on whole numbers to stay in C"
+    n = len(data)
+    if not n:
+        return ''
+    keys = (key * (n // 4 + 1))[:n]
+    return unhexlify('%0*x' % (2 * n, int(hexlify(data), 16) ^ int(hexlify(keys), 16)))
+
+def encodeFrame(payload, opcode=OP_TEXT, key=None):
+    "Encode a single final frame, masked if key is given"
+    n = len(payload)
+    masked = 0x80 if key else 0
+    if n < 126:
+        head = struct.pack('!BB', 0x80 | opcode, masked | n)
+    elif n < 65536:
+        head = struct.pack('!BBH', 0x80 | opcode, masked | 126, n)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, masked | 127, n)
+    if key:
+        return head + key + mask(key, str(payload))
+    return head + payload
+
+def encodeMessage(message, binary=False, key=None):
+    "Encode a message as a text frame, or a binary frame if binary is set"
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    return encodeFrame(message, OP_BINARY if binary else OP_TEXT, key)
+
+class WebSocket(object):
+    "A WebSocket connection, client is True for connections made with connect"
+    maxMessageSize = 2**20 # larger messages close the connection with 1009
+    maxBuffered = 2**22 # connections with more unsent data are dropped by broadcast
+
+    def __init__(self, f, request=None, client=False):
+        self.f = f
+        self.request = request
+        self.client = client
+        self.closed = False # set once we have sent a close frame
+
+    def _key(self):
+        return os.urandom(4) if self.client else None
+
+    def _read(self, n):
+        data = self.f.read(n)
+        if len(data) < n:
+            raise EOFError('connection closed')
+        return data
+
+    def _readFrame(self):
+        "Read one frame, returning (fin, opcode, payload)"
+        b0, b1 = struct.unpack('!BB', self._read(2))
+        if b0 & 0x70:
+            raise WebSocketError(1002) # no extensions were negotiated
+        if bool(b1 & 0x80) == self.client:
+            raise WebSocketError(1002) # only client frames are masked
+        n = b1 & 0x7f
+        if n == 126:
+            n, = struct.unpack('!H', self._read(2))
+        elif n == 127:
+            n, = struct.unpack('!Q', self._read(8))
+        if n > self.maxMessageSize:
+            raise WebSocketError(1009)
+        key = self._read(4) if b1 & 0x80 else None
+        payload = self._read(n)
+        if key:
+            payload = mask(key, payload)
+        return b0 & 0x80, b0 & 0x0f, payload
+
+    def receive(self):
+        """Return the next message, unicode for text and str for binary, or None
+        once the connection is closed. Pings are answered while waiting."""
+        parts = []
+        size = 0
+        opcode = None
+        try:
+            while True:
+                fin, op, payload = self._readFrame()
+                if op & 0x8:
+                    if not fin or len(payload) > 125:
+                        raise WebSocketError(1002)
+                    if op == OP_PING:
+                        self.sendFrame(encodeFrame(payload, OP_PONG, self._key()))
+                    elif op == OP_CLOSE:
+                        code = struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else 1000
+                        self.close(code)
+                        break
+                    elif op != OP_PONG:
+                        raise WebSocketError(1002)
+                    continue
+
+                if op == OP_CONTINUATION:
+                    if opcode is None:
+                        raise WebSocketError(1002)
+                elif opcode is not None or op not in (OP_TEXT, OP_BINARY):
+                    raise WebSocketError(1002)
+                else:
+                    opcode = op
+
+                parts.append(payload)
+                size += len(payload)
+                if size > self.maxMessageSize:
+                    raise WebSocketError(1009)
+                if fin:
+                    message = ''.join(parts)
+                    if opcode == OP_TEXT:
+                        try:
+                            return message.decode('utf-8')
+                        except UnicodeDecodeError:
+                            raise WebSocketError(1007)
+                    return message
+        except WebSocketError, e:
+            self.close(e.code)
+        except EOFError:
+            self.closed = True
+        if self.client:
+            self.f.close(flush=False)
+        return None
+
+    def sendFrame(self, frame):
+        """Queue an encoded frame without blocking, returning False if the
+        connection is closed or was dropped for falling too far behind"""
+        f = self.f
+        if self.closed or f.fd is None or f.outgoing is None:
+            return False
+        if len(f.outgoing) > self.maxBuffered:
+            self.closed = True
+            del f.outgoing[:]
+            self._shutdown(socket.SHUT_RDWR) # wakes up the reader with eof
+            return False
+        f.outgoing.extend(frame)
+        f.flush(block=False)
+        return True
+
+    def send(self, message, binary=False):
+        "Send a message and wait until it has been written"
+        if not self.sendFrame(encodeMessage(message, binary, self._key())):
+            raise ValueError('closed')
+        self.f.flush()
+
+    def ping(self, data=''):
+        "Send a ping, the pong is consumed by receive"
+        self.sendFrame(encodeFrame(data, OP_PING, self._key()))
+
+    def close(self, code=1000, reason=''):
+        """Send a close frame and shut down our side of the connection. The
+        peer answers by closing, after which receive returns None."""
+        if self.closed:
+            return
+        frame = encodeFrame(struct.pack('!H', code) + reason.encode('utf-8'), OP_CLOSE, self._key())
+        if self.sendFrame(frame):
+            self.f.flush()
+        self.closed = True
+        self._shutdown(socket.SHUT_WR)
+
+    def _shutdown(self, how):
+        if self.f.fd is None:
+            return
+        try:
+            socket.fromfd(self.f.fd, socketFamily(self.f.fd), socket.SOCK_STREAM).shutdown(how)
+        except socket.error:
+            pass
+
+def broadcast(websockets, message, binary=False):
+    "Send message to every websocket without blocking, returning how many it was queued for"
+    frame = encodeMessage(message, binary)
+    n = 0
+    for ws in websockets:
+        n += ws.sendFrame(frame)
+    return n
+
+def accept(request, handler, protocol=None):
+    "Answer a upgrade request with a response running handler(websocket) on the connection"
+    headers = request.headers
+    key = headers.get('sec-websocket-key', '')
+    try:
+        validKey = len(base64.b64decode(key)) == 16
+    except TypeError:
+        validKey = False
+    if (request.method != 'GET' or not validKey
+            or 'websocket' not in headers.get('upgrade', '').lower()
+            or 'upgrade' not in headers.get('connection', '').lower()):
+        return 400, [], ''
+    if headers.get('sec-websocket-version') != '13':
+        return 400, [('Sec-WebSocket-Version', '13')], ''
+
+    response = [('Upgrade', 'websocket'), ('Connection', 'Upgrade'),
+        ('Sec-WebSocket-Accept', acceptKey(key))]
+    if protocol:
+        response.append(('Sec-WebSocket-Protocol', protocol))
+    return 101, response, lambda f:handler(WebSocket(f, request))
+
+def connect(address, path='/', headers=(), timeout=None, resolver=None):
+    "Open a client WebSocket to (host, port)"
+    f = ScheduledFile.connectTcp(address, timeout, resolver)
+    key = base64.b64encode(os.urandom(16))
+    writeRequest(f, '%s:%d' % tuple(address[:2]), 'GET', path, [('Upgrade', 'websocket'),
+        ('Connection', 'Upgrade'), ('Sec-WebSocket-Key', key),
+        ('Sec-WebSocket-Version', '13')] + list(headers))
+    try:
+        response = readResponse(f)
+    except (EOFError, HTTPError):
+        f.close()
+        raise
+    if response.status != 101 or response.headers.get('sec-websocket-accept') != acceptKey(key):
+        f.close()
+        raise HTTPError(502)
+    return WebSocket(f, client=True)
@@ -0,0 +1,167 @@
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY ERIK GORSET, AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"a WSGI server running on the naglfar scheduler"
+
+import os
+import sys
+import stat
+import urllib
+from cStringIO import StringIO
+
+import http
+
+"""
+Applications are called in the connection's coroutine by the native HTTP
+server, so requests are parsed without BaseHTTPServer and connections are kept
+alive. The response is collected in ScheduledFile.outgoing, which means the
+chunks of an iterable response are coalesced and written with as few writes as
+possible. wsgi.file_wrapper hands regular files to ScheduledFile.sendfile.
+
+The request body is read before the application is called, and is limited by
+maxBodySize.
+"""
+
+# the server frames the response itself, only keeping the application's length
+hopHeaders = frozenset(['transfer-encoding', 'connection', 'keep-alive'])
+
+class FileWrapper(object):
+    "wsgi.file_wrapper which lets the server use sendfile for regular files"
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'fileno') and hasattr(filelike, 'tell'):
+            try:
+                regular = stat.S_ISREG(os.fstat(filelike.fileno()).st_mode)
+            except (OSError, IOError, ValueError):
+                regular = False
+            if regular:
+                self.fileno = filelike.fileno
+                self.tell = filelike.tell
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+class ResponseBody(object):
+    "An application result with its first chunk read, so start_response has been called"
+    def __init__(self, result, written):
+        self.result = result
+        self.written = written # data from the write callable
+        self.iterator = iter(result)
+        self.first = ''
+        for chunk in self.iterator:
+            if chunk:
+                self.first = chunk
+                break
+
+    def __iter__(self):
+        chunk = self.first
+        while True:
+            if self.written:
+                for i in self.written:
+                    yield i
+                del self.written[:]
+            yield chunk
+            try:
+                chunk = self.iterator.next()
+            except StopIteration:
+                break
+        for i in self.written:
+            yield i
+        del self.written[:]
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+class WSGIServer(http.HTTPServer):
+    "HTTP/1.1 server calling a WSGI application in a new coroutine for each connection"
+
+    def __init__(self, server_address, app, bind_and_activate=True):
+        self.app = app
+        http.HTTPServer.__init__(self, server_address, self.wsgiHandler, bind_and_activate)
+        host, port = self.server_address[:2]
+        self.baseEnviron = {
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'SCRIPT_NAME': '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+
+    def makeEnviron(self, request):
+        environ = dict(self.baseEnviron)
+        path, separator, query = request.path.partition('?')
+        environ['REQUEST_METHOD'] = request.method
+        environ['PATH_INFO'] = urllib.unquote(path)
+        environ['QUERY_STRING'] = query
+        environ['SERVER_PROTOCOL'] = request.version
+        environ['CONTENT_LENGTH'] = str(len(request.body))
+        environ['wsgi.input'] = StringIO(request.body)
+        if request.client_address:
+            environ['REMOTE_ADDR'] = request.client_address[0]
+        for name, value in request.headers.iteritems():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    def wsgiHandler(self, request):
+        response = []
+        written = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if sent:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif response:
+                raise AssertionError('start_response called twice')
+            response[:] = status, headers
+            return written.append
+        sent = False
+
+        result = self.app(self.makeEnviron(request), start_response)
+        if isinstance(result, FileWrapper) and hasattr(result, 'fileno') and not written:
+            body = result
+        elif isinstance(result, (list, tuple)):
+            body = ''.join(written) + ''.join(result)
+        else:
+            body = ResponseBody(result, written)
+        if not response:
+            raise AssertionError('start_response was not called')
+        sent = True
+
+        status, headers = response
+        return status, [i for i in headers if i[0].lower() not in hopHeaders], body
@@ -24,6 +24,7 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import os
 import sys
+import json
 import errno
 import socket
 import unittest
@@ -97,6 +98,1152 @@ class Tests(unittest.TestCase):
         for i in xrange(10):
             testScheduledServer(i)
 
+    def _yield(self):
+        c = Channel()
+        go(c.write, None)
+        c.read()
+
+    def _httpServer(self, **vargs):
+        import BaseHTTPServer
+        from naglfar.core import TestHandler
+        class ScheduledHTTPServer(ScheduledMixIn, BaseHTTPServer.HTTPServer):
+            pass
+        for key, value in vargs.items():
+            setattr(ScheduledHTTPServer, key, value)
+        httpd = ScheduledHTTPServer(('127.0.0.1', 0), TestHandler)
+        go(httpd.serve_forever)
+        return httpd, TestHandler.waiters
+
+    def _get(self, address, path):
+        client = ScheduledFile.connectTcp(address)
+        client.write('GET %s HTTP/1.0\r\n\r\n' % path)
+        return client
+
+    def testRejectResponse(self):
+        reject = 'HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n'
+        httpd, waiters = self._httpServer(maxConnections=1, rejectResponse=reject)
+        address = httpd.server_address
+
+        waiter = self._get(address, '/wait')
+        while not waiters:
+            self._yield()
+        self.assertEquals(self._get(address, '/').read(), reject)
+        self.assertEquals((httpd.naccepted, httpd.nrejected, httpd.nconnections), (1, 1, 1))
+
+        for i in waiters:
+            i.write(1)
+        del waiters[:]
+        self.assertTrue(waiter.read().endswith('\r\n\r\n1'))
+        waiter.close()
+        while httpd.nconnections:
+            self._yield()
+
+    def testPausedAccept(self):
+        httpd, waiters = self._httpServer(maxConnections=1)
+        address = httpd.server_address
+
+        waiter = self._get(address, '/wait')
+        while not waiters:
+            self._yield()
+        status = self._get(address, '/')
+        for i in xrange(10):
+            self._yield()
+        self.assertTrue(httpd._acceptPaused)
+        self.assertEquals(httpd.naccepted, 1)
+
+        for i in waiters:
+            i.write(0)
+        del waiters[:]
+        waiter.read()
+        self.assertTrue(status.read().endswith('\r\n\r\n0'))
+        self.assertEquals((httpd.naccepted, httpd.nrejected, httpd.nshed), (2, 0, 0))
+
+    def testAcceptQueue(self):
+        httpd, waiters = self._httpServer(maxAcceptQueue=2)
+        # the kernel completes all five connects before the server wakes up,
+        # so they arrive in one burst
+        clients = [socket.create_connection(httpd.server_address) for i in xrange(5)]
+        while httpd.naccepted + httpd.nshed < 5:
+            self._yield()
+        self.assertEquals((httpd.naccepted, httpd.nshed, httpd.nrejected), (2, 3, 0))
+
+        closed = []
+        for sock in clients:
+            sock.setblocking(False)
+            try:
+                closed.append(sock.recv(1) == '')
+            except socket.error, e:
+                self.assertEquals(e.errno, errno.EAGAIN) # still waiting for a request
+                closed.append(False)
+        self.assertEquals(sorted(closed), [False, False, True, True, True])
+        for sock in clients:
+            sock.close()
+        while httpd.nconnections:
+            self._yield()
+        self.assertEquals(httpd.statsSnapshot()['pending'], 0)
+
+    def testScheduledRequests(self):
+        import SocketServer
+        import StringIO
+        class Server(ScheduledMixIn, SocketServer.TCPServer):
+            timeout = 0.05
+            def finish_request(self, request, client_address):
+                if request.read(1) == 'x':
+                    raise ZeroDivisionError
+                request.write('ok')
+            def handle_timeout(self):
+                self.timedOut = True
+        server = Server(('127.0.0.1', 0), None)
+        served = Channel()
+        go(lambda:(server.serve_forever(poll_interval=0.01), served.write('done')))
+
+        # handle_request waits on the accept callback instead of blocking in select
+        server.handle_request()
+        self.assertTrue(server.timedOut)
+        handled = Channel()
+        go(lambda:(server.handle_request(), handled.write(server.naccepted)))
+        client = ScheduledFile.connectTcp(server.server_address)
+        client.write('a')
+        self.assertEquals(handled.read(), 1)
+        self.assertEquals(client.read(), 'ok')
+        client.close()
+
+        # get_request hands back the connection the accept callback took
+        requested = Channel()
+        go(lambda:requested.write(server.get_request()))
+        client = ScheduledFile.connectTcp(server.server_address)
+        client.write('a')
+        request, client_address = requested.read()
+        self.assertEquals(client_address[0], '127.0.0.1')
+        self.assertTrue(isinstance(request, ScheduledFile))
+        self.assertEquals(client.read(), 'ok')
+        client.close()
+
+        # a failing request is reported, and its connection still counted as done
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            client = ScheduledFile.connectTcp(server.server_address)
+            client.write('x')
+            self.assertEquals(client.read(), '')
+            client.close()
+            while server.nconnections:
+                self._yield()
+            self.assertTrue('ZeroDivisionError' in sys.stderr.getvalue())
+            self.assertTrue('Exception happened during processing' in sys.stdout.getvalue())
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEquals(server.npending, 0)
+
+        # shutdown returns at once, ending serve_forever and the accepting
+        server.shutdown()
+        self.assertEquals(served.read(), 'done')
+        server.shutdown()
+        naccepted = server.naccepted
+        client = socket.create_connection(server.server_address)
+        for i in xrange(10):
+            self._yield()
+        self.assertEquals(server.naccepted, naccepted)
+        client.close()
+        server.server_close()
+
+    def testAccept4(self):
+        import fcntl
+        from naglfar.accept4 import accept4
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        client = socket.create_connection(server.getsockname())
+        fd, address = accept4(server)
+        try:
+            self.assertEquals(address, client.getsockname())
+            self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+            self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+            client.sendall('hello')
+            self.assertEquals(os.read(fd, 5), 'hello')
+        finally:
+            os.close(fd)
+            client.close()
+            server.close()
+
+    def _httpNative(self, handler):
+        httpd = http.HTTPServer(('127.0.0.1', 0), handler)
+        go(httpd.serve_forever)
+        return ScheduledFile.connectTcp(httpd.server_address)
+
+    def _readResponse(self, client):
+        head = http.readDelimited(client, '\r\n\r\n', 65536)
+        lines = head.split('\r\n')
+        headers = http.parseHeaders(lines[1:])
+        return lines[0], headers, http.readBody(client, headers, 2**20)
+
+    def testHttpPipelining(self):
+        def handler(request):
+            if request.path == '/chunked':
+                return 200, [], iter(['a', '', 'bc'])
+            elif request.path == '/fail':
+                1/0
+            return 200, [('X-Method', request.method)], request.path + request.body
+
+        client = self._httpNative(handler)
+        client.write('GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+            'POST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\nfoo'
+            'POST /c HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nba\r\n1;x=y\r\nr\r\n0\r\n\r\n'
+            'GET /chunked HTTP/1.1\r\n\r\n')
+        self.assertEquals(self._readResponse(client), ('HTTP/1.1 200 OK', {'x-method': 'GET', 'content-length': '2'}, '/a'))
+        self.assertEquals(self._readResponse(client)[2], '/bfoo')
+        self.assertEquals(self._readResponse(client)[2], '/cbar')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((headers['transfer-encoding'], body), ('chunked', 'abc'))
+
+        client.write('GET /d HTTP/1.0\r\n\r\n')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((headers['connection'], body), ('close', '/d'))
+        self.assertEquals(client.read(), '')
+        client.close()
+
+        # a failing request keeps the pipelined responses before it
+        client = self._httpNative(handler)
+        client.write('GET /a HTTP/1.1\r\n\r\nGET /fail HTTP/1.1\r\n\r\n')
+        import StringIO
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertEquals(self._readResponse(client)[2], '/a')
+            self.assertEquals(self._readResponse(client)[0], 'HTTP/1.1 500 Internal Server Error')
+            self.assertTrue('ZeroDivisionError' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+        client.close()
+
+    def testHttpErrors(self):
+        def handler(request):
+            if request.path == '/file':
+                return 200, [], open(__file__)
+            raise ZeroDivisionError
+        client = self._httpNative(handler)
+        client.write('GET /file HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((headers['connection'], body), ('keep-alive', open(__file__).read()))
+
+        client.write('GET /fail HTTP/1.1\r\n\r\n')
+        import StringIO
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertEquals(self._readResponse(client)[0], 'HTTP/1.1 500 Internal Server Error')
+        finally:
+            sys.stderr = stderr
+        client.close()
+
+        client = self._httpNative(handler)
+        client.write('BOGUS\r\n\r\n')
+        self.assertEquals(self._readResponse(client)[0], 'HTTP/1.1 400 Bad Request')
+        client.close()
+
+    def testHttpStatus(self):
+        def upgraded(f):
+            f.write('hi')
+            f.close()
+        def handler(request):
+            if request.path == '/upgrade':
+                return '101 Switching Protocols', [('Upgrade', 'x')], upgraded
+            return '204 No Content', [], 'ignored'
+        # a status given as a string is framed like its code
+        client = self._httpNative(handler)
+        client.write('GET /empty HTTP/1.1\r\n\r\nGET /upgrade HTTP/1.1\r\n\r\n')
+        self.assertEquals(client.read(), 'HTTP/1.1 204 No Content\r\n\r\n'
+            'HTTP/1.1 101 Switching Protocols\r\nUpgrade: x\r\n\r\nhi')
+        client.close()
+
+    def testHttpIdleTimeout(self):
+        httpd = http.HTTPServer(('127.0.0.1', 0), lambda request:(200, [], 'ok'))
+        httpd.idleTimeout = 0.05
+        go(httpd.serve_forever)
+        # a kept-alive connection is closed once it has waited too long for
+        # its next request, and so is one which never sends any
+        client = ScheduledFile.connectTcp(httpd.server_address)
+        client.write('GET / HTTP/1.1\r\n\r\n')
+        self.assertEquals(self._readResponse(client)[2], 'ok')
+        self.assertEquals(client.read(), '')
+        client.close()
+        client = ScheduledFile.connectTcp(httpd.server_address)
+        self.assertEquals(client.read(), '')
+        client.close()
+        while httpd.nconnections:
+            self._yield()
+
+    def testWsgi(self):
+        def app(environ, start_response):
+            path = environ['PATH_INFO']
+            if path == '/file':
+                start_response('200 OK', [('Content-Length', '10')])
+                return environ['wsgi.file_wrapper'](open(__file__))
+            elif path == '/sized':
+                start_response('200 OK', [('Content-Length', environ['QUERY_STRING'])])
+                return iter(['ab', 'cd'])
+            elif path == '/echo':
+                start_response('201 Created', [('Content-Type', 'text/plain')])
+                return [environ['wsgi.input'].read(), environ['QUERY_STRING']]
+            def generator():
+                write = start_response('200 OK', [])
+                write('a')
+                yield 'b'
+                write('c')
+                yield 'd'
+            return generator()
+
+        class Server(wsgi.WSGIServer):
+            collectStats = True
+        httpd = Server(('127.0.0.1', 0), app)
+        httpd.maxBodySize = 10
+        go(httpd.serve_forever)
+        client = ScheduledFile.connectTcp(httpd.server_address)
+
+        client.write('POST /echo?x=1 HTTP/1.1\r\nContent-Length: 3\r\n\r\nfoo')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((status, headers['content-type'], body), ('HTTP/1.1 201 Created', 'text/plain', 'foox=1'))
+
+        client.write('GET /gen HTTP/1.1\r\n\r\n')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((headers['transfer-encoding'], body), ('chunked', 'abcd'))
+
+        # the application's Content-Length is kept, and no more is sent
+        client.write('GET /file HTTP/1.1\r\n\r\n')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((headers['content-length'], body), ('10', open(__file__).read(10)))
+        client.write('GET /sized?3 HTTP/1.1\r\n\r\n')
+        status, headers, body = self._readResponse(client)
+        self.assertEquals((headers, body), ({'content-length': '3'}, 'abc'))
+        self.assertEquals(httpd.stats.statuses, {200: 3, 201: 1})
+
+        client.write('POST /echo HTTP/1.1\r\nContent-Length: 11\r\n\r\nfoo')
+        self.assertEquals(self._readResponse(client)[0], 'HTTP/1.1 413 Request Entity Too Large')
+        client.close()
+
+        # a body shorter than its length closes the connection
+        client = ScheduledFile.connectTcp(httpd.server_address)
+        client.write('GET /sized?5 HTTP/1.1\r\n\r\n')
+        self.assertEquals(client.read(), 'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nabcd')
+        client.close()
+
+    def testHttpClient(self):
+        def handler(request):
+            if request.path == '/close':
+                return 200, [('Connection', 'close')], 'bye'
+            elif request.path == '/chunked':
+                return 200, [], iter(['x', 'y'])
+            return 200, [], request.method + request.path + request.body
+        httpd = http.HTTPServer(('127.0.0.1', 0), handler)
+        go(httpd.serve_forever)
+        address = httpd.server_address
+        pool = http.ConnectionPool(maxPerHost=1)
+
+        self.assertEquals(pool.get(address, '/a').body, 'GET/a')
+        self.assertEquals(pool.request(address, 'POST', '/b', body='foo').body, 'POST/bfoo')
+        self.assertEquals(pool.get(address, '/chunked').body, 'xy')
+        responses = pool.pipeline(address, [('GET', '/c', (), ''), ('HEAD', '/d', (), ''), ('GET', '/e', (), '')])
+        self.assertEquals([i.body for i in responses], ['GET/c', '', 'GET/e'])
+        self.assertEquals((pool.nconnect, httpd.naccepted), (1, 1))
+
+        # concurrent callers wait for the single connection
+        done = Channel()
+        for i in xrange(3):
+            go(lambda i=i:done.write(pool.get(address, '/%s' % i).body))
+        self.assertEquals(sorted(done.read() for i in xrange(3)), ['GET/0', 'GET/1', 'GET/2'])
+        self.assertEquals(pool.nconnect, 1)
+
+        # a connection closed by the server isn't reused
+        response = pool.get(address, '/close')
+        self.assertEquals((response.body, response.keepAlive), ('bye', False))
+        self.assertEquals(pool.get(address, '/f').body, 'GET/f')
+        self.assertEquals(pool.nconnect, 2)
+
+        # neither is one which was closed while idle
+        f, reused = pool.acquire(address)
+        pool.release(address, f)
+        a, b = self._pair()
+        pool.connections[address] += 1
+        pool.release(address, a)
+        b.close()
+        self.assertEquals(pool.acquire(address), (f, True))
+        self.assertTrue(a.closed)
+        pool.release(address, f)
+        pool.close()
+
+    def testTimers(self):
+        order = Channel()
+        for i in (0.03, 0.01, 0.02):
+            go(lambda i=i:(goSleep(i), order.write(i)))
+        self.assertEquals([order.read() for i in xrange(3)], [0.01, 0.02, 0.03])
+
+        c = Channel()
+        self.assertRaises(Timeout, c.read, 0.01)
+        go(c.write, 42)
+        self.assertEquals(c.read(1), 42)
+        self.assertEquals(c.waiting, [])
+
+        timer = goAfter(0.01, lambda:c.write('cancelled'))
+        goCancel(timer)
+        goAfter(0.02, lambda:c.write('done'))
+        self.assertEquals(c.read(), 'done')
+
+        # cancelled timers are no reason to keep polling, so a process with
+        # nothing else to do returns from the scheduler
+        import select
+        import subprocess
+        script = '''if 1:
+            import sys, select
+            for name in %r: # use the same backend as we do
+                if hasattr(select, name):
+                    delattr(select, name)
+            sys.path.insert(0, %r)
+            from naglfar import *
+            def main():
+                c = Channel()
+                go(c.write, 1)
+                c.read(5)
+            go(main)
+            scheduler.switch()
+            print 'drained'
+        ''' % ([i for i in ('epoll', 'kqueue') if not hasattr(select, i)], os.path.dirname(os.path.abspath(__file__)))
+        p = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+        for i in xrange(500):
+            if p.poll() is not None:
+                break
+            goSleep(0.01)
+        else:
+            p.kill()
+        self.assertEquals(p.stdout.read(), 'drained\n')
+
+    def _dnsServer(self, records, truncate=False):
+        "Answer records over UDP, or only over TCP if truncate is set"
+        import struct
+        from naglfar.core import _waitFor, _goRead
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.setblocking(False)
+        queries = []
+
+        def answer(data, truncated=False):
+            ident, = struct.unpack_from('!H', data)
+            end = dns.skipName(data, 12)
+            qtype, = struct.unpack_from('!H', data, end)
+            labels, offset = [], 12
+            while offset < end - 1:
+                labels.append(data[offset+1:offset+1+ord(data[offset])])
+                offset += 1 + ord(data[offset])
+            name = '.'.join(labels)
+            queries.append((name, qtype))
+            answers = [] if truncated else records.get((name, qtype), [])
+            flags = 0x8180 | (dns.FLAG_TC if truncated else 0)
+            reply = struct.pack('!HHHHHH', ident, flags, 1, len(answers), 0, 0) + data[12:end+4]
+            for address in answers:
+                rdata = socket.inet_pton(dns.families[qtype], address)
+                reply += struct.pack('!HHHIH', 0xc00c, qtype, dns.CLASS_IN, 60, len(rdata)) + rdata
+            return reply
+
+        @go
+        def runner():
+            while True:
+                data, address = dns._recvfrom(server)
+                server.sendto(answer(data, truncate), address)
+
+        if truncate:
+            listener = socket.socket()
+            listener.bind(server.getsockname())
+            listener.listen(5)
+            listener.setblocking(False)
+            @go
+            def tcpRunner():
+                while True:
+                    _waitFor(_goRead, listener.fileno())
+                    sock = listener.accept()[0]
+                    f = ScheduledFile.fromSocket(sock)
+                    sock.close()
+                    length, = struct.unpack('!H', f.read(2))
+                    reply = answer(f.read(length))
+                    f.write(struct.pack('!H', len(reply)) + reply)
+                    f.close()
+        return server.getsockname(), queries
+
+    def testResolver(self):
+        address, queries = self._dnsServer({('www.example.test', dns.TYPE_A): ['127.0.0.1']})
+        resolver = dns.Resolver([address[0]], {'alias.test': [(socket.AF_INET, '127.0.0.2')]}, port=address[1])
+
+        self.assertEquals(resolver.resolve('www.example.test'), [(socket.AF_INET, '127.0.0.1')])
+        self.assertEquals(resolver.resolve('WWW.example.test'), [(socket.AF_INET, '127.0.0.1')])
+        self.assertEquals(sorted(queries), [('www.example.test', dns.TYPE_A), ('www.example.test', dns.TYPE_AAAA)])
+        self.assertEquals(resolver.resolve('alias.test'), [(socket.AF_INET, '127.0.0.2')])
+        self.assertEquals(resolver.resolve('::1'), [(socket.AF_INET6, '::1')])
+        self.assertRaises(dns.DNSError, resolver.resolve, 'missing.test')
+
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        client = ScheduledFile.connectTcp(('www.example.test', server.getsockname()[1]), resolver=resolver)
+        server.accept()[0].sendall('hello')
+        self.assertEquals(client.read(5), 'hello')
+        client.close()
+        server.close()
+
+        # short names get the search domains first, unlike absolute ones
+        resolver = dns.Resolver([address[0]], {}, port=address[1], search=['example.test'], ndots=1)
+        self.assertEquals(resolver.names('www'), ['www.example.test', 'www'])
+        self.assertEquals(resolver.names('www.example'), ['www.example', 'www.example.example.test'])
+        self.assertEquals(resolver.names('www.'), ['www'])
+        self.assertEquals(resolver.resolve('www'), [(socket.AF_INET, '127.0.0.1')])
+        del queries[:]
+        self.assertRaises(dns.DNSError, resolver.resolve, 'missing')
+        self.assertEquals(sorted(set(name for name, qtype in queries)), ['missing', 'missing.example.test'])
+
+        # truncated replies are retried over TCP
+        address, queries = self._dnsServer({('big.test', dns.TYPE_A): ['127.0.0.3']}, truncate=True)
+        resolver = dns.Resolver([address[0]], {}, port=address[1], search=[])
+        self.assertEquals(resolver.resolve('big.test', socket.AF_INET), [(socket.AF_INET, '127.0.0.3')])
+        self.assertEquals(queries, [('big.test', dns.TYPE_A)] * 2)
+
+        # a nameserver that doesn't answer fails every waiter, and isn't cached
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        resolver = dns.Resolver(['127.0.0.1'], {}, timeout=0.05, attempts=1, port=silent.getsockname()[1], search=[])
+        results = Channel()
+        for i in xrange(2):
+            @go
+            def lookup():
+                try:
+                    results.write(resolver.query('silent.test', dns.TYPE_A))
+                except dns.DNSError, e:
+                    results.write(e)
+        self.assertTrue(all(isinstance(results.read(), dns.DNSError) for i in xrange(2)))
+        self.assertEquals(resolver.cache, {})
+        try:
+            resolver.resolve('silent.test')
+        except dns.DNSError, e:
+            self.assertEquals(e.args[0], socket.EAI_AGAIN)
+        else:
+            self.fail('no error')
+        silent.close()
+
+    def testConnectFirst(self):
+        from naglfar.core import goConnectFirst
+        server = socket.socket(socket.AF_INET)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        port = server.getsockname()[1]
+        # nothing listens on ::1, so the IPv4 address wins
+        fd = goConnectFirst([(socket.AF_INET6, '::1'), (socket.AF_INET, '127.0.0.1')], port)
+        self.assertEquals(server.accept()[1][0], '127.0.0.1')
+        goClose(fd)
+
+        # the losing attempts are closed, whether they connected or not
+        fds = len(os.listdir('/proc/self/fd'))
+        fd = goConnectFirst([(socket.AF_INET, '127.0.0.1')] * 2, port, delay=0)
+        goClose(fd)
+        fd = goConnectFirst([(socket.AF_INET, '10.255.255.1'), (socket.AF_INET, '127.0.0.1')], port, delay=0.01)
+        goClose(fd)
+        goSleep(0.01)
+        self.assertEquals(len(os.listdir('/proc/self/fd')), fds)
+        server.close()
+        self.assertRaises(socket.error, goConnectFirst, [(socket.AF_INET, '127.0.0.1')], port)
+
+    def testDatagram(self):
+        from naglfar import mmsg
+        a = ScheduledDatagram.bind(('127.0.0.1', 0), batchSize=8)
+        b = ScheduledDatagram.bind(('127.0.0.1', 0))
+        address = a.sock.getsockname()
+
+        b.sendto('hello', address)
+        self.assertEquals(a.recvfrom(), ('hello', b.sock.getsockname()))
+
+        messages = [(str(i), address) for i in xrange(20)]
+        go(b.sendBatch, messages)
+        received = []
+        while len(received) < 20:
+            batch = a.recvBatch()
+            self.assertTrue(0 < len(batch) <= 8)
+            received.extend(batch)
+        self.assertEquals([i[0] for i in received], [i[0] for i in messages])
+        self.assertEquals(set(i[1] for i in received), set([b.sock.getsockname()]))
+        self.assertEquals((a.nread, b.nwrite), (35, 35))
+
+        # the fallback behaves the same
+        mmsg._sendLoop(b.sock, messages[:3])
+        self.assertEquals([i[0] for i in mmsg._recvLoop(a.sock, 8, 100)], ['0', '1', '2'])
+        a.close()
+        b.close()
+
+    def testFdPassing(self):
+        a, b = self._pair()
+        r, w = os.pipe()
+        a.sendFds([w, r], 'x')
+        a.write('after')
+        fds = b.recvFds()
+        self.assertEquals(len(fds), 2)
+        self.assertEquals(b.read(6), 'xafter')
+        os.write(fds[0], 'through the copy')
+        self.assertEquals(os.read(r, 100), 'through the copy')
+        for i in fds + [r, w]:
+            os.close(i)
+        a.close()
+        self.assertEquals(b.recvFds(), [])
+        b.close()
+
+    def testUnixServer(self):
+        import tempfile
+        import SocketServer
+        path = os.path.join(tempfile.mkdtemp(), 'socket')
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                fd, = self.request.recvFds()
+                self.request.read(1) # the byte the fd was attached to
+                os.write(fd, self.request.readline())
+                os.close(fd)
+        class Server(ScheduledUnixMixIn, SocketServer.UnixStreamServer):
+            socketMode = 0600
+        server = Server(path, Handler)
+        go(server.serve_forever)
+
+        r, w = os.pipe()
+        client = ScheduledFile.connectUnix(path)
+        client.sendFds([w])
+        client.write('hello\n')
+        self.assertEquals(goRead(r)(), 'hello\n')
+        client.close()
+        goClose(r)
+        os.close(w)
+        self.assertEquals(os.stat(path).st_mode & 0777, 0600)
+        server.server_close()
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(os.path.dirname(path))
+
+    def _certificate(self):
+        import tempfile
+        import subprocess
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'cert.pem')
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                '-subj', '/CN=localhost', '-keyout', path, '-out', path], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('openssl is needed to make a certificate')
+        return path
+
+    def testTls(self):
+        import ssl
+        certificate = self._certificate()
+        class Server(tls.ScheduledSSLMixIn, http.HTTPServer):
+            sslContext = tls.serverContext(certificate)
+        httpd = Server(('127.0.0.1', 0), lambda request:(200, [], open(__file__)))
+        go(httpd.serve_forever)
+
+        context = ssl.create_default_context(cafile=certificate)
+        for i in xrange(2):
+            client = tls.SSLScheduledFile.connectTls(('localhost', httpd.server_address[1]), context)
+            client.write('GET / HTTP/1.1\r\n\r\n')
+            self.assertEquals(self._readResponse(client)[2], open(__file__).read())
+            client.close()
+        self.assertEquals(httpd.sslContext.session_stats()['accept_good'], 2)
+
+        # python 2 clients can't resume sessions, so openssl checks that the server does
+        import tempfile
+        import subprocess
+        output = tempfile.TemporaryFile()
+        try:
+            p = subprocess.Popen(['openssl', 's_client', '-connect', '127.0.0.1:%d' % httpd.server_address[1],
+                '-reconnect', '-tls1_2'], stdin=open(os.devnull), stdout=output, stderr=subprocess.STDOUT)
+        except OSError:
+            pass
+        else:
+            while p.poll() is None:
+                goSleep(0.01)
+            output.seek(0)
+            self.assertTrue('Reused,' in output.read())
+            self.assertTrue(httpd.sslContext.session_stats()['hits'] >= 1)
+
+        # the socket keeps its family through fromFd
+        class Server6(Server):
+            address_family = socket.AF_INET6
+        httpd6 = Server6(('::1', 0), lambda request:(200, [], 'six'))
+        go(httpd6.serve_forever)
+        client = tls.SSLScheduledFile.connectTls(('::1', httpd6.server_address[1]), context, 'localhost')
+        self.assertEquals(client.sslsock.family, socket.AF_INET6)
+        client.write('GET / HTTP/1.1\r\n\r\n')
+        self.assertEquals(self._readResponse(client)[2], 'six')
+        client.close()
+
+        # a reader and a large write share the connection, and both wait for
+        # the handshake to read from the server
+        echo = Server(('127.0.0.1', 0), lambda request:(200, [], request.body))
+        go(echo.serve_forever)
+        client = tls.SSLScheduledFile.wrap(socket.create_connection(echo.server_address), context,
+            server_hostname='localhost')
+        responses = Channel()
+        go(lambda:responses.write(self._readResponse(client)[2]))
+        big = 'x' * 2**19
+        client.write('POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(big))
+        client.write(big)
+        client.flush()
+        self.assertEquals(responses.read(), big)
+        client.close()
+
+        # the handshake fails, which the server treats as eof
+        client = ScheduledFile.connectTcp(httpd.server_address)
+        client.write('GET / HTTP/1.1\r\n\r\n')
+        self.assertEquals(client.read(), '')
+        client.close()
+        while httpd.nconnections:
+            self._yield()
+        os.unlink(certificate)
+        os.rmdir(os.path.dirname(certificate))
+
+    def testWebSocket(self):
+        subscribers = []
+        def echo(ws):
+            subscribers.append(ws)
+            while True:
+                message = ws.receive()
+                if message is None:
+                    break
+                ws.send(message, binary=isinstance(message, str))
+            subscribers.remove(ws)
+        def handler(request):
+            return websocket.accept(request, echo)
+        httpd = http.HTTPServer(('127.0.0.1', 0), handler)
+        go(httpd.serve_forever)
+        address = httpd.server_address
+
+        clients = [websocket.connect(address, '/') for i in xrange(3)]
+        ws = clients[0]
+        ws.send(u'hello \xe6')
+        self.assertEquals(ws.receive(), u'hello \xe6')
+        data = os.urandom(70000)
+        ws.send(data, binary=True)
+        self.assertEquals(ws.receive(), data)
+
+        # a fragmented message with a ping in the middle
+        key = 'abcd'
+        ws.f.write(chr(websocket.OP_TEXT) + chr(0x80 | 3) + key + websocket.mask(key, 'foo'))
+        ws.f.write(websocket.encodeFrame('ping', websocket.OP_PING, key))
+        ws.f.write(websocket.encodeFrame('bar', websocket.OP_CONTINUATION, key))
+        self.assertEquals(ws.f.read(6), chr(0x80 | websocket.OP_PONG) + chr(4) + 'ping')
+        self.assertEquals(ws.receive(), u'foobar')
+
+        while len(subscribers) < 3:
+            self._yield()
+        self.assertEquals(websocket.broadcast(subscribers, u'event'), 3)
+        for client in clients:
+            self.assertEquals(client.receive(), u'event')
+
+        # unmasked client frames are a protocol error
+        ws.f.write(websocket.encodeFrame('foo'))
+        self.assertEquals(ws.f.read(4), chr(0x80 | websocket.OP_CLOSE) + chr(2) + '\x03\xea')
+        self.assertEquals(ws.f.read(), '')
+        ws.f.close()
+
+        for client in clients[1:]:
+            client.close()
+            self.assertEquals(client.receive(), None)
+        self.assertTrue(clients[1].f.closed)
+
+        client = ScheduledFile.connectTcp(address)
+        client.write('GET / HTTP/1.1\r\n\r\n')
+        self.assertEquals(self._readResponse(client)[0], 'HTTP/1.1 400 Bad Request')
+        client.close()
+        while httpd.nconnections:
+            self._yield()
+
+    def testSync(self):
+        lock = sync.Lock()
+        log = []
+        def worker(name):
+            with lock:
+                log.append(name)
+                self._yield()
+                log.append(name)
+        lock.acquire()
+        for name in 'abc':
+            go(worker, name)
+        self._yield()
+        self.assertEquals(len(lock.waiters), 3)
+        go(lambda:log.append(lock.acquire(timeout=0.01)))
+        goSleep(0.02)
+        self.assertEquals(log, [False])
+        self.assertEquals(len(lock.waiters), 3) # the timed out waiter is gone
+        import StringIO
+        out = StringIO.StringIO()
+        sync.report(out)
+        self.assertTrue('Lock held by' in out.getvalue())
+        lock.release()
+        while lock.locked():
+            self._yield()
+        self.assertEquals(log, [False, 'a', 'a', 'b', 'b', 'c', 'c'])
+        self.assertRaises(RuntimeError, lock.release)
+
+        # at most 2 coroutines at a time
+        semaphore = sync.Semaphore(2)
+        group = sync.WaitGroup()
+        active = []
+        def limited():
+            with semaphore:
+                active.append(len(semaphore.holders))
+                goSleep(0.001)
+            group.done()
+        for i in xrange(6):
+            group.add()
+            go(limited)
+        self.assertTrue(group.wait(1))
+        self.assertEquals(len(active), 6)
+        self.assertEquals(max(active), 2)
+        self.assertEquals(semaphore.value, 2)
+        self.assertRaises(ValueError, semaphore.release)
+
+        event = sync.Event()
+        self.assertFalse(event.wait(0.001))
+        results = []
+        for i in xrange(3):
+            go(lambda:results.append(event.wait()))
+        self._yield()
+        event.set()
+        self.assertTrue(event.wait())
+        self._yield()
+        self.assertEquals(results, [True] * 3)
+
+        condition = sync.Condition()
+        items = []
+        def consumer():
+            with condition:
+                results.append(condition.waitFor(lambda:items))
+        go(consumer)
+        self._yield()
+        with condition:
+            self.assertFalse(condition.wait(0.001))
+            items.append(1)
+            condition.notifyAll()
+        self._yield()
+        self.assertEquals(results[-1], [1])
+        self.assertFalse(condition.lock.locked())
+
+    def testChannelClose(self):
+        a = Channel(maxsize=2)
+        written = []
+        @go
+        def w():
+            for i in xrange(5):
+                a.write(i)
+                written.append(i)
+            a.close()
+        self._yield()
+        self.assertEquals(written, [0, 1]) # blocked until there's room
+        self.assertEquals(a.read(), 0)
+        self._yield()
+        self.assertEquals(written, [0, 1, 2])
+        self.assertEquals(list(a.iterateWaiting(2)), [[1, 2], [3, 4]])
+        self.assertEquals(written, [0, 1, 2, 3, 4])
+        self.assertRaises(EOFError, a.read)
+        self.assertRaises(ValueError, a.write, 5)
+        self.assertEquals(a.readWaiting(True), [])
+
+        # a read makes room for one writer, so only one is woken
+        b = Channel(maxsize=1)
+        for i in xrange(4):
+            go(b.write, i)
+        self._yield()
+        self.assertEquals(len(b.writers), 3)
+        self.assertEquals(b.read(), 0)
+        self.assertEquals(len(b.writers), 2)
+        self._yield()
+        self.assertEquals(b.readWaiting(), [1])
+        self.assertEquals(b.readWaiting(True), [2])
+        self.assertEquals(b.read(), 3)
+
+    def testPipeline(self):
+        def parse(line):
+            key, value = line.split('=')
+            return None if key == 'skip' else (key, int(value))
+        totals = {}
+        def store(items):
+            for key, value in items:
+                totals[key] = totals.get(key, 0) + value
+            return [len(items)]
+        p = pipeline.Pipeline(maxsize=4).stage(parse, n=3).stage(store, batch=True, batchSize=10)
+        @go
+        def feed():
+            for i in xrange(100):
+                p.write('%s=%d' % ('ab'[i % 2], i))
+            p.write('skip=1')
+            p.write('broken')
+            p.write('a=0')
+            p.close()
+        import StringIO
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertEquals(sum(p), 101)
+            p.join()
+            self.assertTrue('ValueError: need more than 1 value to unpack' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(totals, dict(a=sum(xrange(0, 100, 2)), b=sum(xrange(1, 100, 2))))
+        parseStats, storeStats = p.stats()
+        self.assertEquals(parseStats['processed'], 103)
+        self.assertEquals(parseStats['errors'], 1)
+        self.assertEquals(storeStats['processed'], 101)
+        self.assertEquals(storeStats['running'], 0)
+
+        results = Channel()
+        pool = goPool(4, lambda x:x * 2, Channel(), results)
+        for i in xrange(10):
+            pool.input.write(i)
+        pool.input.close()
+        self.assertEquals(sorted(results), range(0, 20, 2))
+
+    def testAsyncio(self):
+        import time
+        import heapq
+        import select
+
+        # just enough of asyncio for the bridge, polling with select, so the
+        # bridge is tested without asyncio or trollius installed
+        class Handle(object):
+            def __init__(self, callback, args):
+                self.callback, self.args, self.cancelled = callback, args, False
+            def cancel(self):
+                self.cancelled = True
+
+        class StubLoop(object):
+            def __init__(self):
+                self.readers, self.writers, self.ready, self.timers = {}, {}, [], []
+            def call_soon(self, callback, *args):
+                self.ready.append(Handle(callback, args))
+                return self.ready[-1]
+            def call_later(self, delay, callback, *args):
+                handle = Handle(callback, args)
+                heapq.heappush(self.timers, (time.time() + delay, id(handle), handle))
+                return handle
+            def add_reader(self, fd, callback, *args):
+                self.remove_reader(fd)
+                self.readers[fd] = Handle(callback, args)
+            def add_writer(self, fd, callback, *args):
+                self.remove_writer(fd)
+                self.writers[fd] = Handle(callback, args)
+            def remove_reader(self, fd):
+                return self._remove(self.readers, fd)
+            def remove_writer(self, fd):
+                return self._remove(self.writers, fd)
+            def _remove(self, handles, fd):
+                handle = handles.pop(fd, None)
+                if handle:
+                    handle.cancel()
+                return handle is not None
+            def run_until_complete(self, future):
+                while not future.done():
+                    timeout = None
+                    if self.ready:
+                        timeout = 0
+                    elif self.timers:
+                        timeout = max(0, self.timers[0][0] - time.time())
+                    readable, writable, _ = select.select(list(self.readers), list(self.writers), [], timeout)
+                    self.ready.extend(self.readers[fd] for fd in readable)
+                    self.ready.extend(self.writers[fd] for fd in writable)
+                    while self.timers and self.timers[0][0] <= time.time():
+                        self.ready.append(heapq.heappop(self.timers)[2])
+                    ready, self.ready = self.ready, []
+                    for handle in ready:
+                        if not handle.cancelled:
+                            handle.callback(*handle.args)
+                return future.result()
+            def close(self):
+                pass
+
+        class StubFuture(object):
+            def __init__(self, loop):
+                self.loop, self.callbacks, self.outcome = loop, [], None
+            def done(self):
+                return self.outcome is not None
+            def cancelled(self):
+                return False
+            def set_result(self, result):
+                self._done((result, None))
+            def set_exception(self, exception):
+                self._done((None, exception))
+            def _done(self, outcome):
+                self.outcome = outcome
+                for callback in self.callbacks:
+                    self.loop.call_soon(callback, self)
+            def add_done_callback(self, callback):
+                if self.done():
+                    self.loop.call_soon(callback, self)
+                else:
+                    self.callbacks.append(callback)
+            def result(self):
+                result, exception = self.outcome
+                if exception is not None:
+                    raise exception
+                return result
+
+        class stub(object):
+            Future = StubFuture
+            @staticmethod
+            def ensure_future(awaitable, loop=None):
+                return awaitable
+
+        runs = [(stub, StubLoop)]
+        if aio.asyncio is not None:
+            runs.append((aio.asyncio, aio.asyncio.new_event_loop))
+        real = aio.asyncio
+        for asyncio, newLoop in runs:
+            aio.asyncio = asyncio
+            loop = newLoop()
+            bridge = aio.install(loop)
+            try:
+                httpd = http.HTTPServer(('127.0.0.1', 0), lambda request:(200, [], 'hi ' + request.path))
+                bridge.go(httpd.serve_forever)
+                responses = Channel()
+                def client():
+                    f = ScheduledFile.connectTcp(httpd.server_address)
+                    f.write('GET /x HTTP/1.0\r\n\r\n')
+                    responses.write(f.read())
+                    f.close()
+                bridge.go(client)
+                self.assertTrue(loop.run_until_complete(bridge.read(responses)).endswith('\r\n\r\nhi /x'))
+
+                future = asyncio.Future(loop=loop)
+                results = Channel()
+                bridge.go(lambda:results.write(bridge.wait(future)))
+                loop.call_later(0.01, future.set_result, 'done')
+                self.assertEquals(loop.run_until_complete(bridge.read(results)), 'done')
+                self.assertRaises(Timeout, loop.run_until_complete, bridge.read(Channel(), 0.01))
+
+                # only the modules listed in rebound are patched
+                from naglfar import core, dns, tls
+                for module in core, dns, tls:
+                    self.assertEquals(module._goRead, bridge._goRead)
+                self.assertFalse(hasattr(http, '_goRead'))
+            finally:
+                bridge.uninstall()
+                loop.close()
+                aio.asyncio = real
+            self.assertEquals(core._goRead, bridge.originals['_goRead'])
+            self.assertEquals(dns._goRead, bridge.originals['_goRead'])
+
+    def testProfiler(self):
+        import time
+        import signal
+        import tempfile
+        def spin(seconds):
+            end = time.time() + seconds
+            while time.time() < end:
+                pass
+        done = Channel()
+        def spinner():
+            spin(0.1)
+            done.write(None)
+        def sleeper():
+            goSleep(0.05)
+            spin(0.05)
+            done.write(None)
+        p = profiler.Profiler(interval=0.001)
+        p.start()
+        go(spinner)
+        go(sleeper)
+        done.read()
+        done.read()
+        p.stop()
+
+        summary = dict((row[0].rpartition('.')[2], row[1:]) for row in p.summary())
+        switches, running, wall, cpu = summary['spinner']
+        self.assertTrue(running >= 0.1)
+        self.assertTrue(wall >= 0.05)
+        self.assertTrue(summary['sleeper'][0] >= 2) # switched out while sleeping
+        self.assertTrue(any(line.startswith('go:') and '.spinner;tests.py:spinner;tests.py:spin ' in line
+            for line in p.collapsed()))
+        self.assertTrue(any(';core.py:_ioCore ' in line for line in p.collapsed()))
+        self.assertTrue(p.collapsed(cpu=True))
+
+        # stacks deeper than maxDepth are cut, but keep their origin
+        def deep(n):
+            if n:
+                return deep(n - 1)
+            spin(0.05)
+            done.write(None)
+        p = profiler.Profiler(interval=0.001, maxDepth=8)
+        p.start()
+        go(deep, 20)
+        done.read()
+        p.stop()
+        stacks = [line for line in p.collapsed() if 'tests.py:spin ' in line]
+        self.assertTrue(stacks)
+        for line in stacks:
+            self.assertTrue(line.startswith('go:') and '.deep;...;' in line, line)
+            self.assertEquals(line.count(';'), 9)
+
+        # the signal interrupts poll, which must be retried
+        path = tempfile.mktemp()
+        profiler.toggleOnSignal(signal.SIGUSR2, path)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            goSleep(0.01)
+            self.assertTrue(profiler.profiler.running)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            goSleep(0.01)
+            self.assertEquals(profiler.profiler, None)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+            profiler.stop()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def testStats(self):
+        h = stats.Histogram()
+        for i in xrange(1, 10001):
+            h.record(i / 1e6)
+        self.assertEquals(h.count, 10000)
+        for p, expected in (50, 0.005), (99, 0.0099), (100, 0.01):
+            self.assertTrue(abs(h.percentile(p) - expected) / expected < 1 / 32.0, (p, h.percentile(p)))
+        self.assertEquals(h.percentile(0.01), 1e-6)
+        other = stats.Histogram()
+        other.record(3600)
+        h.merge(other)
+        self.assertEquals(h.snapshot()['max'], 3600)
+        self.assertTrue(len(h.counts) < 1000)
+
+        class Server(http.HTTPServer):
+            collectStats = True
+            statsPath = '/_stats'
+        def handler(request):
+            if request.path == '/slow':
+                goSleep(0.05)
+            return 200, [], 'x' * 100
+        httpd = Server(('127.0.0.1', 0), handler)
+        go(httpd.serve_forever)
+        pool = http.ConnectionPool()
+        for i in xrange(3):
+            self.assertEquals(pool.get(httpd.server_address, '/').status, 200)
+        pool.close()
+        while httpd.nconnections:
+            self._yield()
+
+        response = pool.get(httpd.server_address, '/_stats')
+        snapshot = json.loads(response.body)
+        pool.close()
+        self.assertEquals(snapshot['requests'], 3) # the stats request is still running
+        self.assertEquals(snapshot['statuses'], {'200': 3})
+        self.assertEquals(snapshot['requestTime']['count'], 3)
+        self.assertEquals(snapshot['completedConnections'], 1)
+        self.assertEquals(snapshot['open'], 1)
+        self.assertTrue(snapshot['bytesOut'] > 300)
+        self.assertTrue(snapshot['bytesIn'] > 0)
+        self.assertEquals(snapshot['queueTime']['count'], 2)
+
+        # requests are timed until the response is written, not just buffered,
+        # so a pipelined request waits for the slow one after it
+        httpd.stats.requestTime = stats.Histogram()
+        client = ScheduledFile.connectTcp(httpd.server_address)
+        client.write('GET / HTTP/1.1\r\n\r\nGET /slow HTTP/1.1\r\n\r\n')
+        self.assertEquals([self._readResponse(client)[2] for i in xrange(2)], ['x' * 100] * 2)
+        client.close()
+        self.assertEquals(httpd.stats.requestTime.count, 2)
+        self.assertTrue(httpd.stats.requestTime.min >= 0.04)
+
     def testUntil(self):
         c, d = self._pair()
         c.write('aafoobar')
@@ -293,6 +1440,22 @@ class Tests(unittest.TestCase):
         a.close()
         self.assertEquals(list(b.readObjectStream()), [1, 2])
 
+    def testReadObjects(self):
+        a, b = self._pair3()
+        a.write(''.join(objects.dumpstream(range(10))) + objects.dumps('partial')[:-1])
+        self.assertEquals(b.readObjects(), range(10))
+        a.write('l')
+        self.assertEquals(b.readObject(), 'partial')
+        a.write(objects.dumps(1) + objects.dumps(2)[:-1])
+        a.close()
+        self.assertEquals(b.readObjects(), [1])
+        self.assertRaises(EOFError, b.readObjects)
+
+        a, b = self._pair3()
+        a.close()
+        self.assertEquals(b.readObjects(), [])
+        self.assertRaises(EOFError, b.readObject)
+
     def testSize(self):
         self.assertEquals(objects.unpackHeader1(0), (32, 32, 0))
         self.assertEquals(objects.unpackHeader1(int('11111111', 2)), (28, 28, 3))
@@ -325,6 +1488,366 @@ class Tests(unittest.TestCase):
         data = ''.join(objects.marshal([obj]))
         self.assertEquals(list(objects.unmarshal([data])), [obj])
 
+    def testUnmarshalChunks(self):
+        elements = [(0, objects.TYPE_BYTES, 'x' * 300), (1, objects.TYPE_INTEGER, -5),
+            (2, objects.TYPE_TUPLE, (0, 1)), (3, objects.TYPE_BYTES, ''), (70000, objects.TYPE_INTEGER, 1<<40)]
+        data = ''.join(objects.marshal(elements))
+        for size in 1, 2, 3, 7, 64, 1000:
+            chunks = [data[i:i+size] for i in xrange(0, len(data), size)]
+            self.assertEquals(list(objects.unmarshal(chunks)), elements)
+        self.assertEquals(list(objects.unmarshal([bytearray(data), ''])), elements)
+        self.assertEquals(objects.unmarshalBlock(data), elements)
+        self.assertEquals(objects.unmarshalBlock(buffer('xx' + data), 2), elements)
+        self.assertRaises(ValueError, objects.unmarshalBlock, data[:-1])
+
+    def testIdWidths(self):
+        for ids in (0, 255), (256, 1), (65536, 2), (1 << 32, 3), (1 << 64 - 1, 0):
+            data = objects.marshalData(objects.TYPE_TUPLE, ids)
+            self.assertEquals(objects.unmarshalData(objects.TYPE_TUPLE, data, 0, len(data)), ids)
+        self.assertRaises(ValueError, objects.marshalData, objects.TYPE_TUPLE, (1 << 64,))
+        obj = range(70000) # more than 65535 ids
+        self.assertEquals(objects.loads(objects.dumps(obj)), obj)
+
+    def testExtendedTypes(self):
+        import array
+        obj = [None, True, False, 1, 1.0, -0.0, 1e300, (1,), (True,), (1.0,), {2.5: [None]}]
+        out = objects.loads(objects.dumps(obj))
+        self.assertEquals(out, obj)
+        self.assertEquals([type(i) for i in out], [type(i) for i in obj])
+        self.assertEquals(str(out[5]), '-0.0')
+        self.assertEquals(type(out[8][0]), bool)
+        self.assertEquals(len(objects.dumps(None)), 5)
+
+        b = bytearray('abc')
+        out = objects.loads(objects.dumps([b, b]))
+        self.assertEquals(out, [b, b])
+        self.assertTrue(out[0] is out[1])
+
+        data = objects.dumps([array.array('d', [1.5, -2.5]), buffer('xyz'), memoryview('qq')])
+        doubles, raw, view = objects.loads(data)
+        if objects.numpy is None:
+            self.assertEquals(doubles.dtype[1:], 'f8')
+            self.assertEquals(doubles.shape, (2,))
+            self.assertEquals(doubles.toarray(), array.array('d', [1.5, -2.5]))
+            self.assertEquals((raw.dtype, raw.shape, raw.data[:]), ('|u1', (3,), 'xyz'))
+            self.assertEquals(view.data[:], 'qq')
+        else:
+            self.assertEquals(list(doubles), [1.5, -2.5])
+            self.assertEquals(raw.tostring(), 'xyz')
+        self.assertRaises(NotImplementedError, objects.dumps, array.array('u', u'x'))
+
+        # 64 bit integers are 'l' to array, as python 2 has no 'q'
+        longs = array.array('l', [1, -2, 3])
+        out = objects.loads(objects.dumps(longs))
+        if objects.numpy is None:
+            self.assertEquals(out.dtype[1:], 'i%d' % longs.itemsize)
+            self.assertEquals(out.toarray(), longs)
+        else:
+            self.assertEquals(list(out), [1, -2, 3])
+
+    def testNumpy(self):
+        numpy = objects.numpy
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+        arrays = [numpy.arange(12, dtype='int64').reshape(3, 4), numpy.array([1.5, -2.5], dtype='>f4'),
+            numpy.zeros(0, dtype='uint8'), numpy.arange(10)[::3]]
+        out = objects.loads(objects.dumps(arrays))
+        for a, b in zip(arrays, out):
+            self.assertEquals((b.dtype, b.shape), (a.dtype, a.shape))
+            self.assertTrue(numpy.array_equal(a, b))
+        self.assertRaises(NotImplementedError, objects.dumps, numpy.array([None]))
+
+    def testColumnar(self):
+        Row = collections.namedtuple('Row', 'id name score flags')
+        rows = [Row(i, 'name%d' % i, i * 0.5, [i] if i % 2 else None) for i in xrange(20)]
+        dicts = [{'id': i - 10, 'name': u'n\xe5vn%d' % i, 'big': 1 << 70 if i == 3 else i} for i in xrange(20)]
+        for obj in rows, dicts, [rows, dicts], [(1, 2)] * 10 + [(1, 2, 3)], [(i,) for i in xrange(7)]:
+            data = objects.dumps(obj, columnar=True)
+            self.assertEquals(objects.loads(data), obj)
+            self.assertTrue(len(data) <= len(objects.dumps(obj)))
+
+        out = objects.loads(objects.dumps(rows, columnar=True))
+        self.assertEquals(type(out), objects.Rows)
+        self.assertEquals(out.rows[3], None)
+        self.assertEquals(out[3], tuple(rows[3]))
+        self.assertTrue(out[3] is out[3])
+        self.assertEquals(out[-2:], rows[-2:])
+        self.assertEquals(objects.loads(objects.dumps(dicts, columnar=True))[5]['name'], u'n\xe5vn5')
+        self.assertEquals(type(objects.loads(objects.dumps(rows))), list)
+
+    def testCompression(self):
+        stats = objects.CompressionStats()
+        compression = objects.Compression('zlib', threshold=100, stats=stats)
+        big = ['compressible %d' % (i % 10) for i in xrange(5000)]
+        data = objects.dumps(big, compression=compression)
+        self.assertEquals(objects.parseHeader(data).id, objects.CODEC_ZLIB)
+        self.assertTrue(len(data) * 10 < len(objects.dumps(big)))
+        self.assertEquals(objects.loads(data), big)
+        for small in 'x' * 90, os.urandom(1000): # below the threshold, and incompressible
+            data = objects.dumps(small, compression=compression)
+            self.assertEquals(objects.parseHeader(data).id, objects.CODEC_NONE)
+            self.assertEquals(data, objects.dumps(small))
+        snapshot = stats.snapshot()
+        self.assertEquals((snapshot['frames'], snapshot['compressed']), (3, 1))
+        self.assertEquals(snapshot['compressTime']['count'], 2)
+        self.assertTrue(snapshot['ratio'] > 1)
+
+        decompressChunk = objects.decompressChunk
+        objects.decompressChunk = 7
+        try:
+            frames = ''.join(objects.dumpstream([big, 1, big], compression=compression))
+            self.assertEquals(list(objects.loadstream([frames], stats)), [big, 1, big])
+        finally:
+            objects.decompressChunk = decompressChunk
+        self.assertEquals(stats.decompressTime.count, 2)
+        self.assertRaises(ValueError, objects.Compression, 'nonexistent')
+        self.assertRaises(ValueError, objects.loadFrame, 3 if 3 not in objects.codecs else 4, '')
+
+        a, b = self._pair3()
+        a.compression = compression
+        a.writeObject(big)
+        a.writeObject('small')
+        a.close()
+        self.assertEquals(list(b.readObjectStream()), [big, 'small'])
+
+    def testSession(self):
+        writer, reader = objects.Session(size=8), objects.Session(size=8)
+        message = lambda i:{'method': 'call%d' % (i % 3), 'args': [i, 'x' * 200], 'trace': False}
+        sizes = []
+        for i in xrange(100):
+            data = objects.dumps(message(i), session=writer)
+            sizes.append(len(data))
+            self.assertEquals(list(objects.loadstream([data], session=reader)), [message(i)])
+        self.assertEquals(writer.atoms, reader.atoms)
+        self.assertTrue(sizes[-1] < sizes[0] - 10)
+        self.assertTrue('x' * 200 not in writer.ids) # longer than maxLength
+
+        # the root can be an atom, and the least recently used atoms are evicted
+        for obj in 'call1', ['a%d' % i for i in xrange(10)], 'call1', ['a%d' % i for i in xrange(12)]:
+            data = objects.dumps(obj, session=writer)
+            self.assertEquals(list(objects.loadstream([data], session=reader)), [obj])
+            self.assertEquals(writer.atoms, reader.atoms)
+        self.assertEquals(len(writer.atoms), 8)
+        self.assertRaises(ValueError, objects.loads, data)
+
+        a, b = self._pair3()
+        a.useSession = True
+        a.compression = objects.Compression(threshold=0)
+        @go
+        def client():
+            for i in xrange(3):
+                a.writeObject(message(i))
+            a.writeObject('plain')
+            a.close()
+        self.assertEquals(list(b.readObjectStream()), [message(i) for i in xrange(3)] + ['plain'])
+        self.assertEquals(a.writeSession.atoms, b.readSession.atoms)
+
+    def testEncodingCache(self):
+        cache = objects.EncodingCache(minLength=4)
+        config = tuple((u'key%d' % i, i, (i * 0.5, None, True)) for i in xrange(50))
+        for i in xrange(5):
+            for obj in config, {'a': [1, config], 'b': config}, ('x', i, config), (i, i, i, config, [i]):
+                self.assertEquals(objects.loads(objects.dumps(obj, cache=cache)), obj)
+        snapshot = cache.snapshot()
+        # config is cached the second time, and the tuples made for each dump never are
+        self.assertEquals(snapshot['misses'], 2 + 5)
+        self.assertEquals(snapshot['uncacheable'], 0)
+        self.assertEquals(snapshot['entries'], 1)
+        self.assertTrue(snapshot['hits'] >= 18)
+
+        # cached tuples are spliced into the ones holding them, bytes shared
+        outer, holder = (config, 'a', 'b', config), (config, [1], 1, 2)
+        for i in xrange(3):
+            obj = {'outer': outer, 'config': config, 'holder': holder}
+            self.assertEquals(objects.loads(objects.dumps(obj, cache=cache)), obj)
+        entry = cache.entries[id(outer)]
+        self.assertTrue(cache.entries[id(config)].rest[0] in entry.rest)
+        self.assertTrue(entry.size < cache.entries[id(config)].size / 4)
+        self.assertEquals(cache.uncacheable, 2) # the holder, after it was first seen
+
+        out = objects.loads(objects.dumps({'a': [1, config], 'b': config}, cache=cache))
+        self.assertTrue(out['a'][1] is out['b'])
+        self.assertEquals(type(out['a'][1][0][0]), unicode)
+
+        small = objects.EncodingCache(maxBytes=2000, minLength=4)
+        tuples = [tuple(range(i, i + 100)) for i in xrange(10)]
+        for t in tuples + tuples:
+            self.assertEquals(objects.loads(objects.dumps(t, cache=small)), t)
+        self.assertEquals(small.hits, 0)
+        self.assertTrue(small.evictions >= 5 and small.size <= small.maxBytes)
+        self.assertRaises(ValueError, objects.dumps, config, session=objects.Session(), cache=cache)
+
+        # tuples seen once aren't kept alive, and only maxSeen are remembered
+        ledger = objects.EncodingCache(minLength=4, maxSeen=10)
+        for i in xrange(100):
+            big = (i, 'x' * 100000, [i], i)
+            objects.dumps(big, cache=ledger)
+            self.assertEquals(sys.getrefcount(big), 2)
+        self.assertEquals((len(ledger.entries), ledger.size), (0, 0))
+        kept = [(i, i, i, i) for i in xrange(100)]
+        for t in kept:
+            objects.dumps(t, cache=ledger)
+        self.assertEquals(len(ledger.seen), 10)
+
+    def testRPC(self):
+        from naglfar import rpc
+        seen = []
+        def slow(n):
+            goSleep(n * 0.01)
+            return n
+        def wait():
+            while not rpc.cancelled():
+                goSleep(0.01)
+            seen.append('cancelled')
+        def fail():
+            raise KeyError('boom')
+        methods = {'add': lambda a, b=0: a + b, 'slow': slow, 'wait': wait, 'fail': fail,
+            'unencodable': lambda:object()}
+        server = rpc.RPCServer(('127.0.0.1', 0), methods)
+        go(server.serve_forever)
+        address = server.server_address
+
+        client = rpc.Client.connect(address)
+        self.assertEquals(client.call('add', 1, b=2), 3)
+
+        # answered in reverse order, on one connection
+        results = Channel()
+        for i in xrange(10, 0, -1):
+            go(lambda i=i:results.write((i, client.call('slow', i))))
+        self.assertEquals([results.read() for i in xrange(10)], [(i, i) for i in xrange(1, 11)])
+
+        try:
+            client.call('fail')
+        except rpc.RemoteError, e:
+            self.assertEquals(e.name, 'KeyError')
+        else:
+            self.fail()
+        self.assertRaises(rpc.RemoteError, client.call, 'nonexistent')
+
+        self.assertRaises(Timeout, client.call, 'slow', 100, timeout=0.02)
+        call = client.start('wait')
+        call.cancel() # arrives with the request, so it never starts
+        self.assertRaises(rpc.Cancelled, call.result)
+        goSleep(0.05)
+        self.assertEquals(seen, [])
+        call = client.start('wait')
+        goSleep(0.05)
+        call.cancel()
+        for i in xrange(100):
+            if seen:
+                break
+            goSleep(0.01)
+        self.assertEquals(seen, ['cancelled'])
+        self.assertEquals(client.pending, {})
+        self.assertEquals(client.call('add', 5), 5)
+
+        # bad results, arguments and requests don't take the server down
+        self.assertRaises(rpc.RemoteError, client.call, 'unencodable')
+        self.assertRaises(NotImplementedError, client.call, 'add', object())
+        self.assertEquals(client.pending, {})
+        raw = ObjectFile.connectTcp(address)
+        raw.writeObject((rpc.REQUEST, 1))
+        self.assertEquals(raw.readObjects(), []) # closed by the server
+        raw.close()
+        self.assertEquals(client.call('add', 6), 6)
+
+        # replies still come after the client has shut down its side
+        raw = ObjectFile.connectTcp(address)
+        raw.writeObject((rpc.REQUEST, 1, 'slow', (2,), {}, None))
+        raw.flush()
+        sock = socket.fromfd(raw.fd, socket.AF_INET, socket.SOCK_STREAM)
+        sock.shutdown(socket.SHUT_WR)
+        sock.close()
+        self.assertEquals(raw.readObjects(), [(rpc.RESULT, 1, 2)])
+        raw.close()
+
+        call = client.start('slow', (100,))
+        client.close()
+        self.assertRaises(rpc.ConnectionLost, call.result)
+
+        # a malformed response closes the client, failing the calls in flight
+        for junk in ['junk', (1,), (rpc.RESULT, [1], 2), (rpc.ERROR, 1, 'boom'), (rpc.RESULT, 1)]:
+            a, b = self._pair3()
+            broken = rpc.Client(a)
+            call = broken.start('add', (1,))
+            b.readObject()
+            b.writeObject(junk)
+            b.flush()
+            self.assertRaises(rpc.ConnectionLost, call.result)
+            self.assertTrue(broken.closed)
+            self.assertEquals(broken.pending, {})
+            b.close()
+
+        pool = rpc.ClientPool()
+        self.assertTrue(pool.get(address) is pool.get(address))
+        self.assertEquals(pool.call(address, 'add', 2, 2), 4)
+        pool.get(address).close()
+        self.assertEquals(pool.call(address, 'add', 3, 3), 6)
+        self.assertEquals(pool.nconnect, 2)
+        pool.close()
+
+    def testDumpFile(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'dump')
+            index = path + '.idx'
+            objs = [(i, 'x' * i, range(i), {u'key': i}) for i in xrange(100)]
+            with open(path, 'wb') as f:
+                f.writelines(objects.dumpstream(objs))
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals(len(dump), 100)
+                self.assertEquals(dump.scanned, 100)
+                self.assertEquals(dump[7], objs[7])
+                self.assertEquals(dump[-1], objs[-1])
+                self.assertEquals(dump[10:20:3], objs[10:20:3])
+                self.assertEquals(list(dump), objs)
+                self.assertRaises(IndexError, lambda:dump[100])
+
+            # append a frame and half of the next one
+            frames = ''.join(objects.dumpstream(['more', 'partial' * 1000], compression=objects.Compression()))
+            with open(path, 'ab') as f:
+                f.write(frames[:-3])
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals(dump.scanned, 1)
+                self.assertEquals(len(dump), 101)
+                self.assertEquals(dump[100], 'more')
+            with open(path, 'ab') as f:
+                f.write(frames[-3:])
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals(dump.scanned, 1)
+                self.assertEquals(dump[-2:], ['more', 'partial' * 1000])
+
+            # eight bytes for each offset, whatever the platform
+            self.assertEquals(os.path.getsize(index), objects._indexHeader.size + 8 * 102)
+
+            # rewritten in place with other frames, longer than the index says
+            objs = [(i, 'y' * 2 * i) for i in xrange(150)]
+            with open(path, 'wb') as f:
+                f.writelines(objects.dumpstream(objs))
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals((dump.scanned, list(dump)), (150, objs))
+
+            # a sidecar cut short is ignored, and so is one for a replaced file
+            with open(index, 'r+b') as f:
+                f.truncate(os.path.getsize(index) - 3)
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals((dump.scanned, len(dump)), (150, 150))
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals((dump.scanned, len(dump)), (0, 150))
+            with open(path + '.new', 'wb') as f:
+                f.writelines(objects.dumpstream(objs))
+            os.rename(path + '.new', path)
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals((dump.scanned, len(dump)), (150, 150))
+
+            open(path, 'wb').close() # rewritten, so the index is stale
+            with objects.DumpFile(path, index) as dump:
+                self.assertEquals(len(dump), 0)
+        finally:
+            shutil.rmtree(directory)
+
     def testInt(self):
         for x in xrange(-10, 10):
             self.assertEquals(objects.bytesToInt(objects.intToBytes(x)), x)